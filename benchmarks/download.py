@@ -0,0 +1,225 @@
+"""Benchmark of the CPU time spent sending large blob downloads.
+
+Creates a temporary storage directory with a few large blobs, and then
+downloads them, whole and as byte ranges, in-process through a minimal
+WSGI server which, like gunicorn, sends a body given to its
+'wsgi.file_wrapper' with 'os.sendfile' from the current offset of the
+file, and copies any other body in Python. The responses are sent over
+a socket pair and discarded by a reader thread. The CPU time of the
+serving thread, and the wall time, per GB sent are output as JSON, so
+that runs can be compared; e.g. run it before and after a change.
+
+Examples, from the top directory of the repository:
+$ python benchmarks/download.py --output after.json
+$ python benchmarks/download.py --no-file-wrapper --output python.json
+$ python benchmarks/download.py --setting DOWNLOAD_DROP_CACHE_SIZE=33554432
+"""
+
+import os
+import random
+import shutil
+import socket
+import threading
+import time
+
+import click
+
+import utils
+
+CASES = ["full", "range_head", "range_tail"]
+BUFFER_SIZE = 1024 * 1024
+
+
+class SendfileWrapper:
+    "File wrapper of the server, marking a body to be sent with 'os.sendfile'."
+
+    def __init__(self, file, buffer_size=BUFFER_SIZE):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        while True:
+            data = self.file.read(self.buffer_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+class Server:
+    "Serve requests to the app, writing the responses to the socket."
+
+    def __init__(self, app, sock, file_wrapper):
+        self.app = app
+        self.sock = sock
+        self.file_wrapper = file_wrapper
+
+    def request(self, path, headers):
+        "Send the response to a GET request. Return the number of body bytes."
+        import werkzeug.test
+
+        environ = werkzeug.test.EnvironBuilder(
+            path=path,
+            base_url=f"http://{self.app.config['SERVER_NAME']}",
+            headers=headers,
+        ).get_environ()
+        if self.file_wrapper:
+            environ["wsgi.file_wrapper"] = SendfileWrapper
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        body = self.app(environ, start_response)
+        try:
+            status, headers = started
+            if not status.startswith(("200", "206")):
+                raise ValueError(f"Unexpected status {status} for {path}.")
+            lines = [f"HTTP/1.1 {status}"] + [f"{k}: {v}" for k, v in headers]
+            self.sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            length = int(dict(headers)["Content-Length"])
+            if isinstance(body, SendfileWrapper):
+                return self.sendfile(body.file, length)
+            sent = 0
+            for chunk in body:
+                self.sock.sendall(chunk)
+                sent += len(chunk)
+            return sent
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def sendfile(self, file, count):
+        "Send the number of bytes from the current offset of the file."
+        offset = file.tell()
+        sent = 0
+        while sent < count:
+            n = os.sendfile(
+                self.sock.fileno(), file.fileno(), offset + sent, count - sent
+            )
+            if n == 0:
+                break
+            sent += n
+        return sent
+
+
+def drain(sock):
+    "Read and discard everything from the socket until it is closed."
+    while sock.recv(BUFFER_SIZE):
+        pass
+
+
+def get_requests(case, filenames, size, count):
+    "Return the list of paths and headers to request for the case."
+    half = size // 2
+    if case == "full":
+        headers = {}
+    elif case == "range_head":
+        headers = {"Range": f"bytes=0-{half - 1}"}
+    else:
+        headers = {"Range": f"bytes={size - half}-"}
+    return [(f"/blob/{filenames[i % len(filenames)]}", headers) for i in range(count)]
+
+
+def run_case(server, requests):
+    "Serve the requests. Return the statistics per GB sent."
+    cpu = time.thread_time()
+    wall = time.perf_counter()
+    sent = sum([server.request(path, headers) for path, headers in requests])
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+    gigabytes = sent / 1e9
+    return {
+        "requests": len(requests),
+        "bytes": sent,
+        "cpu_s_per_gb": round(cpu / gigabytes, 4),
+        "wall_s_per_gb": round(wall / gigabytes, 4),
+        "gb_per_s": round(gigabytes / wall, 3),
+    }
+
+
+@click.command()
+@click.option("--blobs", type=int, default=4, show_default=True)
+@click.option(
+    "--size", type=int, default=64 * 1024 * 1024, show_default=True, help="Bytes."
+)
+@click.option(
+    "--requests",
+    "n_requests",
+    type=int,
+    default=32,
+    show_default=True,
+    help="Requests per case.",
+)
+@click.option(
+    "--file-wrapper/--no-file-wrapper",
+    default=True,
+    show_default=True,
+    help="Give the server's file wrapper to the app, as gunicorn does.",
+)
+@click.option(
+    "--case",
+    "cases",
+    multiple=True,
+    type=click.Choice(CASES),
+    help="Case to benchmark; repeat for several. Default all.",
+)
+@click.option(
+    "--setting",
+    "settings",
+    multiple=True,
+    help="Setting for the app as KEY=VALUE; repeat for several.",
+)
+@click.option("--output", help="File to write the JSON results to; else stdout.")
+def main(blobs, size, n_requests, file_wrapper, cases, settings, output):
+    "Benchmark the CPU time spent sending large blob downloads."
+    try:
+        settings = dict([s.split("=", 1) for s in settings])
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    if blobs < 1 or size < 2 or n_requests < 1:
+        raise click.BadParameter("Blobs, size and requests must be positive.")
+    app, dirpath = utils.get_app(settings)
+    try:
+        users, filenames = utils.seed(app, 1, blobs, [(size, 1)], random.Random(0))
+        results = {
+            "meta": utils.get_meta(
+                benchmark="download",
+                blobs=blobs,
+                size=size,
+                requests=n_requests,
+                file_wrapper=file_wrapper,
+                settings=settings,
+            ),
+            "cases": {},
+        }
+        reader, writer = socket.socketpair()
+        thread = threading.Thread(target=drain, args=(reader,), daemon=True)
+        thread.start()
+        try:
+            server = Server(app, writer, file_wrapper)
+            # Warm up, so that all cases read the files from the page cache,
+            # unless the setting to drop large files from it applies.
+            run_case(server, get_requests("full", filenames, size, blobs))
+            for case in cases or CASES:
+                requests = get_requests(case, filenames, size, n_requests)
+                result = run_case(server, requests)
+                results["cases"][case] = result
+                click.echo(
+                    f"{case:12} {result['cpu_s_per_gb']:>10} CPU s/GB"
+                    f"  {result['gb_per_s']:>10} GB/s",
+                    err=True,
+                )
+        finally:
+            writer.close()
+            thread.join()
+            reader.close()
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+    utils.write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""End-to-end benchmark of the main endpoints.
+
+Creates a temporary storage directory, seeds it with users and blobs,
+and then times requests to each endpoint, either in-process using the
+Flask test client, or over HTTP to a locally started gunicorn server
+(which requires the 'gunicorn' package). The throughput and latency
+percentiles per endpoint are output as JSON, so that runs can be compared.
+
+Examples, from the top directory of the repository:
+$ python benchmarks/e2e.py --output before.json
+$ python benchmarks/e2e.py --mode gunicorn --concurrency 16 --workers 4
+$ python benchmarks/e2e.py --setting BLOB_CACHE_SIZE=67108864 --endpoint download
+"""
+
+import functools
+import http.client
+import importlib.util
+import itertools
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import click
+
+import utils
+
+ENDPOINTS = ["download", "upload", "info_json", "all_json", "search", "home"]
+
+
+class Workload:
+    "Produce the requests for each endpoint, given the seeded data."
+
+    def __init__(self, users, filenames, sizes):
+        self.users = users
+        self.filenames = filenames
+        self.sizes = sizes
+        self.counter = itertools.count()
+
+    def get_request(self, endpoint, rng):
+        "Return method, path, body and headers for a request to the endpoint."
+        filename = rng.choice(self.filenames)
+        if endpoint == "download":
+            return "GET", f"/blob/{filename}", None, {}
+        elif endpoint == "upload":
+            user = rng.choice(self.users)
+            size = utils.pick_size(self.sizes, rng)
+            content = utils.get_content(size, True, rng)
+            path = f"/blob/upload{next(self.counter)}.txt"
+            return "PUT", path, content, {"x-accesskey": user["accesskey"]}
+        elif endpoint == "info_json":
+            return "GET", f"/blob/{filename}/info.json", None, {}
+        elif endpoint == "all_json":
+            return "GET", "/blobs/all.json", None, {}
+        elif endpoint == "search":
+            term = f"number {rng.randrange(len(self.filenames))}."
+            return "GET", f"/blobs/search?term={term.replace(' ', '+')}", None, {}
+        elif endpoint == "home":
+            return "GET", "/", None, {}
+        raise ValueError(f"Unknown endpoint '{endpoint}'.")
+
+
+class TestClient:
+    "Send requests in-process using the Flask test client."
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        response = self.client.open(path, method=method, data=body, headers=headers)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class HttpClient:
+    "Send requests over a persistent HTTP connection."
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(self, method, path, body, headers):
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self.connection.close()
+
+
+def run_endpoint(endpoint, workload, get_client, n_requests, concurrency, seed):
+    """Send the given number of requests to the endpoint, divided between
+    concurrent client threads. Return the statistics.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(number, count):
+        rng = random.Random(f"{seed}-{endpoint}-{number}")
+        client = get_client()
+        try:
+            for _ in range(count):
+                request = workload.get_request(endpoint, rng)
+                started = time.perf_counter()
+                try:
+                    status = client.request(*request)
+                except (OSError, http.client.HTTPException):
+                    status = None
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    if status is None or status >= 400:
+                        errors.append(status)
+        finally:
+            client.close()
+
+    counts = [n_requests // concurrency] * concurrency
+    for number in range(n_requests % concurrency):
+        counts[number] += 1
+    threads = [
+        threading.Thread(target=worker, args=(number, count))
+        for number, count in enumerate(counts)
+        if count
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    result = {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+    result.update(utils.get_percentiles(latencies))
+    return result
+
+
+def start_gunicorn(workers, threads):
+    """Start a gunicorn server for the app on a free local port, using the
+    settings in the environment. Return the process and the port.
+    """
+    if importlib.util.find_spec("gunicorn") is None:
+        raise click.ClickException("The 'gunicorn' package is not installed.")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        [p for p in [utils.ROOT, env.get("PYTHONPATH")] if p]
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            f"--bind=127.0.0.1:{port}",
+            f"--workers={workers}",
+            f"--threads={threads}",
+            "--worker-class=gthread",
+            "blobserver.main:app",
+        ],
+        env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise click.ClickException("The gunicorn server failed to start.")
+        try:
+            client = HttpClient(port)
+            if client.request("GET", "/status", None, {}) == http.client.OK:
+                client.close()
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise click.ClickException("The gunicorn server did not respond.")
+
+
+@click.command()
+@click.option(
+    "--mode",
+    type=click.Choice(["inprocess", "gunicorn"]),
+    default="inprocess",
+    show_default=True,
+    help="Call the app in-process, or over HTTP to a gunicorn server.",
+)
+@click.option("--users", type=int, default=5, show_default=True)
+@click.option("--blobs", type=int, default=200, show_default=True)
+@click.option(
+    "--sizes",
+    default=utils.DEFAULT_SIZES,
+    show_default=True,
+    help="Blob size distribution as 'size:weight' items.",
+)
+@click.option(
+    "--requests", type=int, default=200, show_default=True, help="Per endpoint."
+)
+@click.option("--warmup", type=int, default=10, show_default=True, help="Per endpoint.")
+@click.option("--concurrency", type=int, default=4, show_default=True)
+@click.option("--workers", type=int, default=2, show_default=True, help="Gunicorn.")
+@click.option("--threads", type=int, default=4, show_default=True, help="Gunicorn.")
+@click.option(
+    "--endpoint",
+    "endpoints",
+    type=click.Choice(ENDPOINTS),
+    multiple=True,
+    help="Endpoint to benchmark; repeat for several. Default all.",
+)
+@click.option(
+    "--setting",
+    "settings",
+    multiple=True,
+    help="Setting for the app as KEY=VALUE; repeat for several.",
+)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--output", help="File to write the JSON results to; else stdout.")
+@click.option("--keep", is_flag=True, help="Keep the storage directory.")
+def main(
+    mode,
+    users,
+    blobs,
+    sizes,
+    requests,
+    warmup,
+    concurrency,
+    workers,
+    threads,
+    endpoints,
+    settings,
+    seed,
+    output,
+    keep,
+):
+    "Benchmark the main endpoints of the app end-to-end."
+    try:
+        sizes = utils.parse_sizes(sizes)
+        settings = dict([s.split("=", 1) for s in settings])
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    if users < 1 or blobs < 1 or concurrency < 1:
+        raise click.BadParameter("Users, blobs and concurrency must be positive.")
+    app, dirpath = utils.get_app(settings)
+    process = None
+    try:
+        started = time.perf_counter()
+        seeded = utils.seed(app, users, blobs, sizes, random.Random(seed))
+        click.echo(
+            f"Seeded {users} users, {blobs} blobs"
+            f" in {time.perf_counter() - started:.1f} s.",
+            err=True,
+        )
+        workload = Workload(*seeded, sizes)
+        if mode == "gunicorn":
+            process, port = start_gunicorn(workers, threads)
+            get_client = functools.partial(HttpClient, port)
+        else:
+            get_client = functools.partial(TestClient, app)
+        results = {
+            "meta": utils.get_meta(
+                benchmark="e2e",
+                mode=mode,
+                users=users,
+                blobs=blobs,
+                sizes=sizes,
+                requests=requests,
+                concurrency=concurrency,
+                workers=workers if mode == "gunicorn" else None,
+                threads=threads if mode == "gunicorn" else None,
+                settings=settings,
+                seed=seed,
+            ),
+            "endpoints": {},
+        }
+        for endpoint in endpoints or ENDPOINTS:
+            if warmup:
+                run_endpoint(endpoint, workload, get_client, warmup, 1, seed)
+            result = run_endpoint(
+                endpoint, workload, get_client, requests, concurrency, seed
+            )
+            results["endpoints"][endpoint] = result
+            click.echo(
+                f"{endpoint:10} {result['throughput']:>8} req/s"
+                f"  p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms"
+                f"  p99 {result['p99_ms']:>8} ms  errors {result['errors']}",
+                err=True,
+            )
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        if keep:
+            click.echo(f"Storage directory: {dirpath}", err=True)
+        else:
+            shutil.rmtree(dirpath, ignore_errors=True)
+    utils.write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
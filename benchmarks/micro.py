@@ -0,0 +1,163 @@
+"""Microbenchmarks of Python functions on the hot paths of requests.
+
+Each case times a single function call on realistic data, using a
+temporary storage directory seeded with users and blobs where the
+database is needed. The time per call is output as JSON, so that runs
+can be compared.
+
+Examples, from the top directory of the repository:
+$ python benchmarks/micro.py --output before.json
+$ python benchmarks/micro.py --case get_time --case diff
+"""
+
+import copy
+import random
+import shutil
+import statistics
+import timeit
+
+import click
+
+import utils
+
+DESCRIPTION = """# Sample data set
+
+Measurements from the *second* sequencing run, **not yet** quality checked.
+See the [protocol](https://example.com/protocol) for details.
+
+- Instrument: NovaSeq 6000
+- Read length: 2 x 150 bp
+- Samples: 96, of which `4` are controls
+
+| Sample | Reads | Comment |
+|--------|-------|---------|
+"""
+DESCRIPTION += "".join(f"| S{i} | {i * 1234567} | ok |\n" for i in range(40))
+
+
+def get_cases(users, filenames):
+    """Return the cases as a dict of name to a function without arguments.
+    Must be called within an app context, in which the cases are run.
+    """
+    import flask
+
+    import blobserver.blob
+    import blobserver.user
+    from blobserver import utils as blobserver_utils
+
+    data = blobserver.blob.get_blob_data(filenames[0])
+    changed = copy.deepcopy(data)
+    changed["description"] = DESCRIPTION
+    changed["size"] += 1
+    changed["sha256"] = "0" * 64
+    saver = blobserver.blob.BlobSaver(copy.deepcopy(data))
+    row = list(flask.g.db.execute("SELECT * FROM blobs LIMIT 1"))[0]
+    content_1k = random.Random(0).randbytes(1024)
+    content_1m = random.Random(0).randbytes(1024 * 1024)
+    username = users[0]["username"]
+
+    def set_content(content):
+        saver = blobserver.blob.BlobSaver()
+        return lambda: saver.set_content(content)
+
+    def rows_to_dicts():
+        rows = flask.g.db.execute("SELECT * FROM blobs")
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    return {
+        "get_time": blobserver_utils.get_time,
+        "saver_init": lambda: blobserver.blob.BlobSaver(data),
+        "deepcopy": lambda: copy.deepcopy(data),
+        "diff": lambda: saver.diff(data, changed),
+        "row_to_dict": lambda: dict(zip(row.keys(), row)),
+        "rows_to_dicts": rows_to_dicts,
+        "markdown": lambda: blobserver_utils.markdown(DESCRIPTION),
+        "get_user": lambda: blobserver.user.get_user(username),
+        "get_blob_data": lambda: blobserver.blob.get_blob_data(filenames[-1]),
+        "set_content_1k": set_content(content_1k),
+        "set_content_1m": set_content(content_1m),
+    }
+
+
+def time_case(function, repeat):
+    """Time the function; the number of calls per repeat is chosen to take
+    at least 0.2 seconds. Return the statistics in microseconds per call.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "calls": number,
+        "best_us": round(min(times), 3),
+        "median_us": round(statistics.median(times), 3),
+        "stdev_us": round(statistics.stdev(times), 3) if len(times) > 1 else None,
+    }
+
+
+@click.command()
+@click.option("--users", type=int, default=10, show_default=True)
+@click.option("--blobs", type=int, default=200, show_default=True)
+@click.option("--repeat", type=int, default=5, show_default=True)
+@click.option(
+    "--case",
+    "cases",
+    multiple=True,
+    help="Case to benchmark; repeat for several. Default all.",
+)
+@click.option(
+    "--setting",
+    "settings",
+    multiple=True,
+    help="Setting for the app as KEY=VALUE; repeat for several.",
+)
+@click.option("--output", help="File to write the JSON results to; else stdout.")
+def main(users, blobs, repeat, cases, settings, output):
+    "Benchmark Python functions on the hot paths of requests."
+    try:
+        settings = dict([s.split("=", 1) for s in settings])
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    if users < 1 or blobs < 1 or repeat < 1:
+        raise click.BadParameter("Users, blobs and repeat must be positive.")
+    app, dirpath = utils.get_app(settings)
+    try:
+        seeded = utils.seed(
+            app, users, blobs, utils.parse_sizes("1024"), random.Random(0)
+        )
+        import flask
+
+        from blobserver import utils as blobserver_utils
+
+        with app.app_context():
+            flask.g.db = blobserver_utils.get_db()
+            flask.g.current_user = None
+            available = get_cases(*seeded)
+            for name in cases:
+                if name not in available:
+                    raise click.BadParameter(f"No such case '{name}'.")
+            results = {
+                "meta": utils.get_meta(
+                    benchmark="micro",
+                    users=users,
+                    blobs=blobs,
+                    repeat=repeat,
+                    settings=settings,
+                ),
+                "cases": {},
+            }
+            for name in cases or available:
+                result = time_case(available[name], repeat)
+                results["cases"][name] = result
+                click.echo(
+                    f"{name:15} {result['best_us']:>12} us"
+                    f"  median {result['median_us']:>12} us",
+                    err=True,
+                )
+            flask.g.db.close()
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+    utils.write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"Utilities for benchmarks."
+
+import json
+import os
+import os.path
+import platform
+import sys
+import tempfile
+import time
+
+# Allow running the benchmarks from a checkout without installing.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SIZES = "1024:70,65536:25,1048576:5"
+PASSWORD = "benchmark-password"
+
+
+def parse_sizes(value):
+    """Parse a size distribution given as comma-separated 'size:weight' items.
+    Return a list of (size, weight) tuples.
+    """
+    result = []
+    for item in value.split(","):
+        size, _, weight = item.partition(":")
+        result.append((int(size), float(weight or 1)))
+    if not result or any(s < 0 or w <= 0 for s, w in result):
+        raise ValueError("Invalid size distribution.")
+    return result
+
+
+def get_app(settings=None):
+    """Return the app using a new, empty temporary storage directory.
+    The given settings are set as environment variables, which therefore
+    must be done before the app is imported. Return also the dirpath.
+    """
+    dirpath = tempfile.mkdtemp(prefix="blobserver-benchmark-")
+    os.environ["STORAGE_DIRPATH"] = dirpath
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+    for key, value in (settings or {}).items():
+        os.environ[key] = str(value)
+    import blobserver.main
+
+    return blobserver.main.app, dirpath
+
+
+def seed(app, n_users, n_blobs, sizes, rng):
+    """Create the given number of users and blobs. Blob sizes are drawn from
+    the distribution. Every other blob is text-like, the rest random bytes.
+    Return the list of users, each a dict with username and accesskey,
+    and the list of blob filenames.
+    """
+    import flask
+
+    import blobserver.blob
+    import blobserver.user
+    from blobserver import constants
+    from blobserver import utils
+
+    users = []
+    filenames = []
+    with app.app_context():
+        flask.g.db = utils.get_db()
+        flask.g.current_user = None
+        for number in range(n_users):
+            with blobserver.user.UserSaver() as saver:
+                saver.set_username(f"user{number}")
+                saver.set_email(f"user{number}@example.com")
+                saver.set_password(PASSWORD)
+                saver.set_role(constants.USER)
+                saver.set_status(constants.ENABLED)
+                saver.set_quota(None)
+            users.append(dict(username=saver["username"], accesskey=saver["accesskey"]))
+        for number in range(n_blobs):
+            user = users[number % len(users)]
+            flask.g.current_user = blobserver.user.get_user(user["username"])
+            text = number % 2 == 0
+            filename = f"blob{number}.{'txt' if text else 'bin'}"
+            with blobserver.blob.BlobSaver() as saver:
+                saver["filename"] = filename
+                saver["description"] = f"Benchmark blob number {number}."
+                saver["username"] = user["username"]
+                saver.set_content(get_content(pick_size(sizes, rng), text, rng))
+            filenames.append(filename)
+        flask.g.db.close()
+    return users, filenames
+
+
+def pick_size(sizes, rng):
+    "Return a size drawn from the distribution."
+    return rng.choices([s for s, w in sizes], weights=[w for s, w in sizes])[0]
+
+
+def get_content(size, text, rng):
+    "Return content of the given size; text lines, or random bytes."
+    if text:
+        line = b"chr%d\t%d\tACGTACGTTGCA\tsample annotation\n" % (
+            rng.randrange(1, 23),
+            rng.randrange(10**8),
+        )
+        return (line * (size // len(line) + 1))[:size]
+    return rng.randbytes(size)
+
+
+def get_percentiles(latencies):
+    "Return summary statistics in milliseconds for the list of seconds."
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    result = {"mean_ms": round(1000 * sum(latencies) / len(latencies), 3)}
+    for percent in (50, 95, 99):
+        index = min(len(latencies) - 1, round(percent / 100 * (len(latencies) - 1)))
+        result[f"p{percent}_ms"] = round(1000 * latencies[index], 3)
+    result["max_ms"] = round(1000 * latencies[-1], 3)
+    return result
+
+
+def get_meta(**parameters):
+    "Return information about the run, for comparing results."
+    from blobserver import constants
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "blobserver": constants.VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": parameters,
+    }
+
+
+def write_results(results, filepath):
+    "Write the results as JSON to the file, or to stdout if none."
+    if filepath:
+        with open(filepath, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
@@ -15,6 +15,7 @@ blueprint = flask.Blueprint("about", __name__)
 
 
 @blueprint.route("/software")
+@utils.page_cached
 def software():
     "Show software versions."
     return flask.render_template("about/software.html", software=get_software())
@@ -0,0 +1,361 @@
+"""ASGI application serving the Flask app, for an asyncio server such as
+uvicorn, so that slow clients and long downloads do not occupy threads.
+
+The Flask app handles each request in a bounded pool of threads, but
+only for as long as it takes to decide the response; the transfer of the
+response body, and of the request body, is done by the event loop:
+
+- A request body is received before the Flask app is called; in memory
+  up to the read-ahead size, and beyond that into a temporary file.
+  If the body is larger than the read-ahead size, the limit on its size
+  is first decided in the thread pool, without receiving more of it.
+  An upload which will be rejected, e.g. one not allowed for the user,
+  or exceeding the quota, is not received further, and the Flask app
+  is called at once to produce the rejection.
+- A response from a file, as given by 'flask.send_file' for blob
+  downloads, also for a byte range, is sent by the event loop, reading
+  the file in the thread pool, or with zero copy if the server supports
+  the ASGI extension 'http.response.zerocopysend'. The file is closed,
+  and the callbacks of the response called, when the transfer is done.
+- Any other response body is iterated in the thread pool, a chunk at
+  a time, and sent by the event loop.
+
+Usage, from the directory containing the 'blobserver' package:
+$ uvicorn blobserver.asgi:app --workers 2
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import os
+import re
+import sys
+import tempfile
+
+import werkzeug.exceptions
+
+import blobserver.blob
+import blobserver.main
+
+CHUNK_SIZE = 256 * 1024
+CONTENT_RANGE_RX = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class FileWrapper:
+    """Marker for a file to be sent as a response body by the event loop.
+    Given to the Flask app as 'wsgi.file_wrapper'. It is also iterable,
+    in case the app reads it itself.
+    """
+
+    def __init__(self, file, buffer_size=CHUNK_SIZE):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(self.buffer_size)
+        if data:
+            return data
+        raise StopIteration()
+
+    def close(self):
+        self.file.close()
+
+
+class RequestBody(io.RawIOBase):
+    """The request body, read by the Flask app in a worker thread from
+    the file into which it was received. If the body was not received
+    to its end, since it was to be rejected, reading beyond the part
+    received is as if the client had disconnected.
+    """
+
+    def __init__(self, file, complete):
+        self.file = file
+        self.complete = complete
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(len(buffer))
+        if not data and not self.complete:
+            raise werkzeug.exceptions.ClientDisconnected()
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class Application:
+    "ASGI application calling the WSGI app of Flask for HTTP requests."
+
+    def __init__(self, wsgi_app, threads, read_ahead, get_body_limit=None):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.read_ahead = read_ahead
+        self.get_body_limit = get_body_limit
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.handle(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type '{scope['type']}'.")
+
+    async def lifespan(self, receive, send):
+        "Create the thread pool at startup, and shut it down at shutdown."
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.get_executor()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.executor:
+                    self.executor.shutdown(wait=True)
+                    self.executor = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def get_executor(self):
+        "Return the thread pool, creating it if required."
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix="asgi"
+            )
+        return self.executor
+
+    async def run(self, function, *args):
+        "Run the function in the thread pool."
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), function, *args)
+
+    async def handle(self, scope, receive, send):
+        "Receive the body, call the Flask app, and send its response."
+        environ = get_environ(scope, io.BytesIO())
+        body = await self.receive_body(environ, receive)
+        if body is None:  # The client disconnected.
+            return
+        environ["wsgi.input"] = body
+        wrappers = []
+
+        def file_wrapper(file, buffer_size=CHUNK_SIZE):
+            wrappers.append(FileWrapper(file, buffer_size))
+            return wrappers[-1]
+
+        environ["wsgi.file_wrapper"] = file_wrapper
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        try:
+            iterable = await self.run(self.wsgi_app, environ, start_response)
+        finally:
+            body.close()
+        try:
+            status, headers = started
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [
+                        (k.lower().encode("latin-1"), v.encode("latin-1"))
+                        for k, v in headers
+                    ],
+                }
+            )
+            file_range = get_file_range(scope, status, headers, wrappers)
+            if file_range:
+                await self.send_file(scope, send, wrappers[0].file, *file_range)
+            else:
+                await self.send_iterable(send, iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                await self.run(iterable.close)
+
+    async def receive_body(self, environ, receive):
+        """Receive the request body, up to its limit as decided by the Flask
+        app if it is larger than the read-ahead size. Return it as a stream
+        for the Flask app, or None if the client disconnected.
+        """
+        file = tempfile.SpooledTemporaryFile(max_size=self.read_ahead)
+        try:
+            size = 0
+            more_body = True
+            limit = None
+            decided = self.get_body_limit is None
+            while more_body:
+                if size >= self.read_ahead and not decided:
+                    limit = await self.run(self.get_body_limit, environ)
+                    decided = True
+                    declared = environ.get("CONTENT_LENGTH")
+                    if limit is not None and declared and int(declared) > limit:
+                        break
+                if limit is not None and size > limit:
+                    break
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    file.close()
+                    return None
+                chunk = message.get("body", b"")
+                if size + len(chunk) > self.read_ahead:
+                    # Written to disk; not in the event loop.
+                    await self.run(file.write, chunk)
+                else:
+                    file.write(chunk)
+                size += len(chunk)
+                more_body = message.get("more_body", False)
+            file.seek(0)
+        except BaseException:
+            file.close()
+            raise
+        return RequestBody(file, not more_body)
+
+    async def send_file(self, scope, send, file, offset, count):
+        """Send the given byte range of the file; with zero copy if the server
+        supports it, else reading chunks in the thread pool. Only files
+        in the file system can be sent with zero copy.
+        """
+        try:
+            fd = file.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            fd = None
+        if fd is not None and "http.response.zerocopysend" in scope.get(
+            "extensions", {}
+        ):
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "offset": offset,
+                    "count": count,
+                    "more_body": False,
+                }
+            )
+            return
+        more_body = True
+        while count > 0:
+            if fd is None:
+                chunk = await self.run(read_at, file, offset, min(count, CHUNK_SIZE))
+            else:
+                chunk = await self.run(os.pread, fd, min(count, CHUNK_SIZE), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            count -= len(chunk)
+            more_body = count > 0
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": more_body}
+            )
+        # End the response if the file was empty, or shorter than declared.
+        if more_body:
+            await send({"type": "http.response.body", "body": b""})
+
+    async def send_iterable(self, send, iterable):
+        "Send the chunks of the response body, iterated in the thread pool."
+        iterator = iter(iterable)
+        while True:
+            chunk = await self.run(next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        await send({"type": "http.response.body", "body": b""})
+
+
+def read_at(file, offset, size):
+    "Read the given number of bytes at the offset of the file-like object."
+    file.seek(offset)
+    return file.read(size)
+
+
+def get_environ(scope, body):
+    "Return the WSGI environment for the request in the ASGI scope."
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        if key not in environ:
+            environ[key] = value
+        elif key == "HTTP_COOKIE":
+            environ[key] = f"{environ[key]}; {value}"
+        else:
+            environ[key] = f"{environ[key]},{value}"
+    # Without a declared length, e.g. if chunked, read the body to its end.
+    if "CONTENT_LENGTH" not in environ:
+        environ["wsgi.input_terminated"] = True
+    return environ
+
+
+def get_file_range(scope, status, headers, wrappers):
+    """Return the offset and the number of bytes to send from the file given
+    to the file wrapper, if the response is to be sent from it; else None.
+    The file may have been wrapped more than once, but must be the only one.
+    The byte range is the one given in the response headers.
+    """
+    if len(set([id(w.file) for w in wrappers])) != 1 or scope["method"] == "HEAD":
+        return None
+    headers = {k.lower(): v for k, v in headers}
+    try:
+        count = int(headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+    if status.startswith("200"):
+        return (0, count)
+    elif status.startswith("206"):
+        match = CONTENT_RANGE_RX.match(headers.get("content-range", ""))
+        if match and int(match.group(2)) - int(match.group(1)) + 1 == count:
+            return (int(match.group(1)), count)
+    return None
+
+
+flask_app = blobserver.main.app
+
+
+def get_body_limit(environ):
+    """Return the maximum size of the body of the request as decided by
+    the Flask app before receiving it, or None if not limited.
+    See 'blobserver.blob.get_body_limit'.
+    """
+    with flask_app.request_context(environ):
+        blobserver.main.prepare()
+        return blobserver.blob.get_body_limit()
+
+
+app = Application(
+    flask_app,
+    threads=flask_app.config["ASGI_THREADS"],
+    read_ahead=flask_app.config["ASGI_READ_AHEAD"],
+    get_body_limit=get_body_limit,
+)
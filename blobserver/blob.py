@@ -1,17 +1,66 @@
 "Blob serve, information (metadata) display, upload and update."
 
+import collections
+import contextlib
+import datetime
+import fcntl
 import hashlib
 import html
 import http.client
+import io
+import json
+import mimetypes
 import os
 import os.path
+import re
+import shutil
+import string
+import tempfile
+import threading
+import time
 
 import flask
+import werkzeug.exceptions
+import werkzeug.wsgi
 
+from blobserver import cache
+from blobserver import compression
 from blobserver import constants
+from blobserver import metrics
+from blobserver import storage
+from blobserver import tracing
 from blobserver import utils
 import blobserver.user
 
+DIGEST_NAMES = ["md5", "sha256", "sha512"]
+CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # From 'linux/fs.h'; in module 'fcntl' only from Python 3.12.
+CONTENT_RANGE_RX = re.compile(r"^bytes +(\d+)-(\d+)/(\d+|\*)$")
+DIGESTS_LOCK_FILENAME = "_digests.lock"
+
+# For comparing filenames regardless of case, as done in the database.
+ASCII_LOWERCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Hash states of recently written blobs, allowing digests to be extended
+# when appending instead of re-reading the whole file. Per-process only.
+HASH_STATES_MAX = 256
+_hash_states = collections.OrderedDict()
+_hash_states_lock = threading.Lock()
+
+# Blobs whose digests are being recomputed, with the data to recompute
+# them for next; at most one thread per blob. Per-process only.
+_digests_pending = {}
+_digests_pending_lock = threading.Lock()
+
+# Download counts of blobs that may be compressed for download, to find
+# those worth a variant compressed in advance, and the limit on the number
+# of concurrent compressions on the fly. Per-process only.
+DOWNLOAD_COUNTS_MAX = 1024
+_download_counts = collections.OrderedDict()
+_variants_in_progress = set()
+_download_counts_lock = threading.Lock()
+_compressions = None
+
 
 def init(app):
     "Initialize the database; create blob table."
@@ -34,6 +83,36 @@ def init(app):
             "CREATE UNIQUE INDEX IF NOT EXISTS"
             " blobs_filename_index ON blobs (filename)"
         )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS reservations"
+            "(iuid TEXT PRIMARY KEY,"
+            " username TEXT NOT NULL COLLATE NOCASE,"
+            " size INTEGER NOT NULL,"
+            " created TEXT NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS verifications"
+            "(iuid TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " verified TEXT NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs_inline"
+            "(iuid TEXT PRIMARY KEY,"
+            " content BLOB NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs_compressed"
+            "(iuid TEXT PRIMARY KEY,"
+            " encoding TEXT NOT NULL,"
+            " offsets TEXT NOT NULL)"
+        )
+    with app.app_context():
+        recover_journals(app, db)
+    # Digests cleared by range writes may not have been recomputed.
+    rows = list(db.execute("SELECT COUNT(*) FROM blobs WHERE sha256=''"))
+    if rows[0][0]:
+        threading.Thread(target=recover_digests, args=(app,), daemon=True).start()
 
 
 blueprint = flask.Blueprint("blob", __name__)
@@ -57,26 +136,41 @@ def upload():
                 saver["filename"] = infile.filename
                 saver["description"] = flask.request.form.get("description")
                 saver["username"] = flask.g.current_user["username"]
-                saver.set_content(infile.read())
+                saver.set_content_file(infile.stream)
         except ValueError as error:
             return utils.error(error)
         return flask.redirect(flask.url_for("blob.info", filename=saver["filename"]))
 
 
-@blueprint.route("/<filename>", methods=["GET", "PUT", "DELETE"])
+@blueprint.route("/<filename>", methods=["GET", "PUT", "PATCH", "DELETE"])
 def blob(filename):
     """Web: Return the blob itself.
     API: Create a new blob (PUT), update an existing blob (PUT),
+    write a byte range into or append to an existing blob (PATCH),
     or delete an existing blob (DELETE).
     """
     if utils.http_GET() or utils.http_HEAD():
-        data = get_blob_data(filename)
+        data, content = get_cached_blob(filename)
         if not data:
             # Just send error code; appropriate for programmatic use.
             flask.abort(http.client.NOT_FOUND)
-        return flask.send_from_directory(
-            flask.current_app.config["STORAGE_DIRPATH"], filename
-        )
+        if data["inline"] is not None:
+            return send_content(data, data["inline"])
+        compressible = is_download_compressible(data)
+        encoding = get_download_encoding(data, compressible)
+        if content is not None and not encoding:
+            response = send_content(data, content)
+        elif data["encoding"]:
+            response = send_compressed(data, encoding)
+        else:
+            response = None
+            if encoding:
+                response = send_encoded(data, encoding)
+            if not response:
+                response = send_file(data)
+        if compressible or data["encoding"]:
+            response.vary.add("Accept-Encoding")
+        return response
 
     elif utils.http_PUT():
         data = get_blob_data(filename)
@@ -84,25 +178,64 @@ def blob(filename):
         if data:
             if not allow_update(data):
                 flask.abort(http.client.UNAUTHORIZED)
-            try:
-                with BlobSaver(data) as saver:
-                    saver.set_content(flask.request.data)
-            except ValueError:
-                flask.abort(http.client.BAD_REQUEST)
-            return ("", http.client.OK)
         # Cannot create a new blob unless logged in.
         elif not flask.g.current_user:
             flask.abort(http.client.UNAUTHORIZED)
-        # Create a new blob; the filename is given in the URL.
+        # Check the quota before reading the body, if its size is declared.
+        size = flask.request.content_length
+        if size is None:
+            added = None
         else:
+            added = size - (data["size"] if data else 0)
+        try:
+            with reserved_quota(added) as allowance:
+                if allowance is None:
+                    limit = None
+                else:
+                    limit = allowance + (data["size"] if data else 0)
+                with BlobSaver(data) as saver:
+                    if not data:  # Create a new blob; filename given in the URL.
+                        saver["filename"] = filename
+                        saver["username"] = flask.g.current_user["username"]
+                    saver.set_content_file(flask.request.stream, limit=limit)
+        except QuotaExceeded:
+            flask.abort(http.client.REQUEST_ENTITY_TOO_LARGE)
+        except ValueError:
+            flask.abort(http.client.BAD_REQUEST)
+        if data:
+            return ("", http.client.OK)
+        else:
+            return ("", http.client.CREATED)
+
+    elif utils.http_PATCH():
+        data = get_blob_data(filename)
+        if not data:
+            flask.abort(http.client.NOT_FOUND)
+        if not allow_update(data):
+            flask.abort(http.client.UNAUTHORIZED)
+        content = flask.request.data
+        with storage.locked_file(data):
+            # Re-read within the lock; another request may just have written.
+            data = get_blob_data(filename)
+            if_match = flask.request.if_match
+            if if_match and not if_match.contains(get_etag(data)):
+                flask.abort(http.client.PRECONDITION_FAILED)
             try:
-                with BlobSaver() as saver:
-                    saver["filename"] = filename
-                    saver.set_content(flask.request.data)
-                    saver["username"] = flask.g.current_user["username"]
+                offset = get_patch_offset(data, content)
+            except ValueError:
+                flask.abort(http.client.REQUESTED_RANGE_NOT_SATISFIABLE)
+            try:
+                with BlobSaver(data) as saver:
+                    saver.set_range(offset, content)
+            except QuotaExceeded:
+                flask.abort(http.client.REQUEST_ENTITY_TOO_LARGE)
             except ValueError:
                 flask.abort(http.client.BAD_REQUEST)
-            return ("", http.client.CREATED)
+        if not saver["sha256"]:
+            schedule_digests(saver.doc)
+        response = flask.make_response("", http.client.OK)
+        response.set_etag(get_etag(saver.doc))
+        return response
 
     elif utils.http_DELETE():
         data = get_blob_data(filename)
@@ -158,6 +291,7 @@ def description(filename):
 
 
 @blueprint.route("/<filename>/info", methods=["GET", "POST", "DELETE"])
+@utils.page_cached
 def info(filename):
     "Web: Display the information about the blob. Delete."
     data = get_blob_data(filename)
@@ -186,6 +320,26 @@ def info_json(filename):
     data = get_blob_data(filename)
     if not data:
         flask.abort(http.client.NOT_FOUND)
+    # The digests may be set, and the description and owner changed,
+    # without changing the modified timestamp; any change adds a log item.
+    # Some log items are shown only to logged-in users.
+    rows = list(
+        flask.g.db.execute(
+            "SELECT MAX(timestamp) FROM logs WHERE iuid=?", (data["iuid"],)
+        )
+    )
+    etag = utils.get_etag(
+        data["iuid"],
+        data["modified"],
+        data["sha256"],
+        data["description"],
+        data["username"],
+        rows[0][0],
+        bool(flask.g.current_user),
+    )
+    response = utils.check_not_modified(etag)
+    if response:
+        return response
     result = {
         "$id": flask.request.url,
         "href": flask.url_for("blob.blob", filename=filename, _external=True),
@@ -198,7 +352,9 @@ def info_json(filename):
             log.pop("remote_addr", None)
             log.pop("user_agent", None)
     result["logs"] = logs
-    return flask.jsonify(result)
+    response = flask.jsonify(result)
+    response.set_etag(etag)
+    return response
 
 
 @blueprint.route("/<filename>/update", methods=["GET", "POST"])
@@ -227,7 +383,7 @@ def update(filename):
                         saver["username"] = username
                 infile = flask.request.files.get("file")
                 if infile:
-                    saver.set_content(infile.read())
+                    saver.set_content_file(infile.stream)
         except ValueError as error:
             return utils.error(error)
         return flask.redirect(flask.url_for("blob.info", filename=saver["filename"]))
@@ -267,19 +423,18 @@ def copy(filename):
         return flask.render_template("blob/copy.html", data=data)
 
     elif utils.http_POST():
-        filepath = os.path.join(
-            flask.current_app.config["STORAGE_DIRPATH"], data["filename"]
-        )
         try:
-            with open(filepath, "rb") as infile:
-                content = infile.read()
-            with BlobSaver() as saver:
-                saver["filename"] = flask.request.form.get("filename")
-                saver["description"] = flask.request.form.get("description")
-                saver["username"] = flask.g.current_user["username"]
-                saver.set_content(content)
+            # No range writes into the source while it is being copied.
+            with storage.locked_file(data):
+                with BlobSaver() as saver:
+                    saver["filename"] = flask.request.form.get("filename")
+                    saver["description"] = flask.request.form.get("description")
+                    saver["username"] = flask.g.current_user["username"]
+                    saver.set_copy(data)
         except ValueError as error:
             return utils.error(error)
+        if not saver["sha256"]:
+            schedule_digests(saver.doc)
         return flask.redirect(flask.url_for("blob.info", filename=saver["filename"]))
 
 
@@ -297,19 +452,207 @@ def logs(filename):
     )
 
 
+class QuotaExceeded(ValueError):
+    "The user's quota cannot accommodate the blob."
+
+
 class BlobSaver(utils.BaseSaver):
     "Save the blob."
 
     LOG_EXCLUDE_PATHS = [["content"], ["modified"]]  # Exclude from log info.
+    CACHE_NAMESPACES = ["blobs"]
+
+    def prepare(self):
+        """No range write or its journal yet, no source to copy, no upload file,
+        and no compression of it. No locked files, and no file to remove.
+        """
+        self.range = None
+        self.journal = None
+        self.source = None
+        self.tmppath = None
+        self.compressed = None
+        self.locks = contextlib.ExitStack()
+        self.filepath = None
+        self.obsolete = None
+
+    def __exit__(self, etyp, einst, etb):
+        """Roll back any range write if saving failed, else discard its journal.
+        Remove any upload file that was not moved into place.
+        If the content of an existing blob is replaced, its file is locked
+        before the transaction, and until the change has been committed,
+        so that a range write never sees the new file with the old data.
+        For a range write, the caller holds the lock.
+        """
+        try:
+            with self.locks:
+                if (
+                    etyp is None
+                    and self.original
+                    and self.is_content_replaced()
+                    and not self.range
+                ):
+                    self.filepath = self.locks.enter_context(
+                        storage.locked_file(self.original)
+                    )
+                return super().__exit__(etyp, einst, etb)
+        except Exception:
+            if self.journal:
+                self.journal.rollback()
+            raise
+        finally:
+            if self.journal:
+                self.journal.remove()
+            if self.tmppath:
+                try:
+                    os.remove(self.tmppath)
+                except FileNotFoundError:
+                    pass
+
+    def add_log(self):
+        """Add the log entry, which commits the changes; a range write
+        must not be rolled back after that, so its journal is discarded.
+        """
+        super().add_log()
+        if self.journal:
+            self.journal.remove()
+            self.journal = None
+        if self.obsolete:
+            os.remove(self.obsolete)
+            self.obsolete = None
+
+    def is_content_replaced(self):
+        "Is the content replaced as a whole, or set as a copy?"
+        return bool("content" in self.doc or self.source or self.tmppath)
+
+    def lock_file(self, filepath):
+        """Lock the file until the changes have been committed.
+        To be done before a new file is moved into the place of the current.
+        """
+        lockfile = self.locks.enter_context(open(filepath, "rb"))
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
 
     def set_content(self, content):
         "Set the content of the blob, and the parameters determined by it."
         self["content"] = content
         self["size"] = len(content)
-        for name in ["md5", "sha256", "sha512"]:
-            hash = hashlib.new(name)
-            hash.update(content)
-            self[name] = hash.hexdigest()
+        started = time.perf_counter()
+        hashes = {}
+        for name in DIGEST_NAMES:
+            hashes[name] = hashlib.new(name)
+            hashes[name].update(content)
+            self[name] = hashes[name].hexdigest()
+        tracing.record("hash", started, size=len(content))
+        metrics.add("blobserver_hash_seconds_total", time.perf_counter() - started)
+        metrics.add("blobserver_hash_bytes_total", len(content))
+        save_hash_state(self.doc["iuid"], hashes)
+
+    def set_content_file(self, infile, limit=None):
+        """Set the content of the blob by reading the file-like object
+        in chunks into a temporary file, computing the digests on the way.
+        The file is compressed if configured and the content compresses well.
+        Raise QuotaExceeded as soon as the size exceeds the limit, if given.
+        """
+        self.tmppath = os.path.join(
+            flask.current_app.config["STORAGE_DIRPATH"], f"_upload_{utils.get_iuid()}"
+        )
+        hashes = {name: hashlib.new(name) for name in DIGEST_NAMES}
+        size = 0
+        received = time.perf_counter()
+        read_time = 0.0
+        hash_time = 0.0
+        with open(self.tmppath, "wb") as outfile:
+            writer = compression.Writer(outfile)
+            while True:
+                started = time.perf_counter()
+                chunk = infile.read(CHUNK_SIZE)
+                read_time += time.perf_counter() - started
+                if not chunk:
+                    break
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    raise QuotaExceeded("User's quota cannot accommodate the blob.")
+                started = time.perf_counter()
+                for hash in hashes.values():
+                    hash.update(chunk)
+                hash_time += time.perf_counter() - started
+                writer.write(chunk)
+            self.compressed = writer.close()
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        # Reading, hashing and writing of the chunks are interleaved.
+        tracing.record(
+            "receive",
+            received,
+            size=size,
+            read_ms=round(1000 * read_time, 3),
+            hash_ms=round(1000 * hash_time, 3),
+        )
+        self["size"] = size
+        for name in DIGEST_NAMES:
+            self[name] = hashes[name].hexdigest()
+        metrics.add("blobserver_hash_seconds_total", hash_time)
+        metrics.add("blobserver_hash_bytes_total", size)
+        save_hash_state(self.doc["iuid"], hashes)
+
+    def set_range(self, offset, content):
+        """Set the content to be written at the given offset of the blob;
+        at the end of the blob means append. The digests are extended
+        if the hash state is available, otherwise they are cleared
+        and must be recomputed after saving.
+        Content stored inline or compressed is instead replaced as a whole.
+        """
+        self.range = (offset, content)
+        inline = storage.get_inline(self.doc)
+        if inline is not None:
+            self.set_content(
+                inline[:offset] + content + inline[offset + len(content) :]
+            )
+            return
+        if storage.get_compression(self.doc):
+            dirpath = flask.current_app.config["STORAGE_DIRPATH"]
+            with tempfile.TemporaryFile(dir=dirpath) as tmpfile:
+                with storage.open_content(self.doc) as infile:
+                    shutil.copyfileobj(infile, tmpfile, CHUNK_SIZE)
+                tmpfile.seek(offset)
+                tmpfile.write(content)
+                tmpfile.seek(0)
+                self.set_content_file(tmpfile)
+            return
+        size = self.doc["size"]
+        self["size"] = max(size, offset + len(content))
+        hashes = None
+        if offset == size:
+            hashes = get_hash_state(self.doc["iuid"], self.doc["sha256"])
+        if hashes:
+            for name in DIGEST_NAMES:
+                hashes[name].update(content)
+                self[name] = hashes[name].hexdigest()
+            save_hash_state(self.doc["iuid"], hashes)
+        else:
+            for name in DIGEST_NAMES:
+                self[name] = ""
+
+    def set_copy(self, data):
+        """Set the content to be a copy of the given blob.
+        The digests and size are taken from it; the content is not read.
+        A file is copied now, before the transaction that saves the blob,
+        to a temporary file in the storage directory, which is moved into
+        place when saved.
+        """
+        self.source = data
+        for key in DIGEST_NAMES + ["size"]:
+            self[key] = data[key]
+        if storage.is_inline_size(data["size"]) or storage.get_inline(data) is not None:
+            return
+        self.tmppath = os.path.join(
+            flask.current_app.config["STORAGE_DIRPATH"], f"_upload_{utils.get_iuid()}"
+        )
+        copy_file(storage.get_filepath(data), self.tmppath)
+        self.compressed = storage.get_compression(data)
+
+    def get_added_size(self):
+        "Return the number of bytes that the blob content will add."
+        return self.doc.get("size", 0) - self.original.get("size", 0)
 
     def rename(self, filename):
         "Rename the blob."
@@ -318,37 +661,46 @@ class BlobSaver(utils.BaseSaver):
             raise ValueError("Filename may not contain path specification.")
         if get_blob_data(filename):
             raise ValueError("A blob with the given filename already exists.")
-        filepath = os.path.join(flask.current_app.config["STORAGE_DIRPATH"], filename)
-        if os.path.exists(filepath):
+        if os.path.exists(storage.get_filepath(dict(self.doc, filename=filename))):
             raise ValueError("A file with the given filename already exists.")
-        os.rename(
-            os.path.join(
-                flask.current_app.config["STORAGE_DIRPATH"], self.doc["filename"]
-            ),
-            filepath,
-        )
+        with storage.locked_file(self.doc) as filepath:
+            # Content stored inline is keyed by IUID; nothing to rename.
+            if filepath:
+                # Keep the file in the same layout; it may not have been migrated.
+                os.rename(filepath, os.path.join(os.path.dirname(filepath), filename))
         self["filename"] = filename
 
     def finalize(self):
-        "Finalize modifications of the blob."
+        """Finalize modifications of the blob. The quota is checked against
+        the current usage and the reservations of other uploads, in the
+        transaction that will commit the blob, so that they cannot
+        jointly exceed the quota.
+        """
         for key in ["filename", "username"]:
             if not self.doc.get(key):
                 raise ValueError(f"Invalid blob: {key} not set.")
         check_filename(self.doc["filename"])
-        if flask.g.current_user["quota"]:
-            if (
-                len(self.doc.get("content", [])) + flask.g.current_user["blobs_size"]
-                > flask.g.current_user["quota"]
-            ):
-                raise ValueError("User's quota cannot accommodate the blob.")
+        user = flask.g.current_user
+        if user["quota"]:
+            db = flask.g.db
+            if not db.in_transaction:
+                db.execute("BEGIN IMMEDIATE")
+            rows = list(
+                db.execute(
+                    "SELECT SUM(size) FROM reservations WHERE username=? AND iuid!=?",
+                    (user["username"], flask.g.get("reservation") or ""),
+                )
+            )
+            used = blobserver.user.user_blobs_size(user) + (rows[0][0] or 0)
+            if self.get_added_size() + used > user["quota"]:
+                db.rollback()
+                raise QuotaExceeded("User's quota cannot accommodate the blob.")
 
     def upsert(self):
         "Update or insert the blob information into the database."
         cursor = flask.g.db.cursor()
-        if "content" in self.doc:  # The content has changed; insert or update.
-            filepath = os.path.join(
-                flask.current_app.config["STORAGE_DIRPATH"], self.doc["filename"]
-            )
+        # The content has changed, or is a copy; insert or update.
+        if self.is_content_replaced():
             rows = list(
                 cursor.execute(
                     "SELECT COUNT(*) FROM blobs WHERE" " iuid=?", (self.doc["iuid"],)
@@ -356,7 +708,7 @@ class BlobSaver(utils.BaseSaver):
             )
             if rows[0][0] == 0:
                 # Defensive paranoid check.
-                if os.path.exists(filepath):
+                if os.path.exists(storage.get_filepath(self.doc)):
                     raise ValueError(
                         "Cannot overwrite existing non-blobserver"
                         " file; use another filename."
@@ -379,6 +731,7 @@ class BlobSaver(utils.BaseSaver):
                     f"INSERT INTO blobs ({fields}) VALUES ({args})",
                     [self.doc.get(k) for k in keys],
                 )
+                self.write_content(None)
             else:
                 # Username included, to allow admin to change user of blob.
                 keys = [
@@ -394,8 +747,23 @@ class BlobSaver(utils.BaseSaver):
                 assigns = ",".join([f"{k}=?" for k in keys])
                 values = [self.doc.get(k) for k in keys] + [self.doc["iuid"]]
                 cursor.execute(f"UPDATE blobs SET {assigns} WHERE iuid=?", values)
-            with open(filepath, "wb") as outfile:
-                outfile.write(self.doc["content"])
+                if self.range:
+                    # Rewrite of inline or compressed content for a range write;
+                    # the caller holds the lock.
+                    filepath = storage.get_filepath(self.doc)
+                    if not os.path.exists(filepath):
+                        filepath = None
+                    self.write_content(filepath)
+                else:
+                    self.write_content(self.filepath)
+        elif self.range:  # Part of the content has changed; write in place.
+            keys = ["md5", "sha256", "sha512", "size", "modified"]
+            assigns = ",".join([f"{k}=?" for k in keys])
+            values = [self.doc.get(k) for k in keys] + [self.doc["iuid"]]
+            cursor.execute(f"UPDATE blobs SET {assigns} WHERE iuid=?", values)
+            self.journal = PatchJournal(self.doc)
+            self.journal.write(*self.range)
+            storage.remove_variants(self.doc)
         else:  # Filename or description has changed; only update is relevant.
             cursor.execute(
                 "UPDATE blobs SET filename=?, description=?,"
@@ -408,18 +776,753 @@ class BlobSaver(utils.BaseSaver):
                 ),
             )
 
+    @tracing.traced
+    def write_content(self, filepath):
+        """Write the new content to the file for the blob, or store it inline
+        in the database if it is small enough. The given path of the current
+        file, if any, is removed when the content moved into the database
+        has been committed.
+        """
+        storage.remove_variants(self.doc)
+        if storage.is_inline_size(self.doc["size"]):
+            storage.set_inline(self.doc, self.get_content())
+            storage.set_compression(self.doc, None)
+            self.obsolete = filepath
+            return
+        storage.delete_inline(self.doc)
+        if not filepath:
+            filepath = storage.get_new_filepath(self.doc)
+        if self.tmppath:
+            self.lock_file(self.tmppath)
+            os.replace(self.tmppath, filepath)
+        else:
+            with open(filepath, "wb") as outfile:
+                writer = compression.Writer(outfile)
+                writer.write(self.get_content())
+                self.compressed = writer.close()
+        storage.set_compression(self.doc, self.compressed)
+
+    def get_content(self):
+        "Return the new content as bytes; it should be small."
+        if self.source:
+            infile = storage.open_content(self.source)
+        elif self.tmppath:
+            infile = open(self.tmppath, "rb")
+            if self.compressed:
+                infile = compression.Reader(infile, *self.compressed)
+        else:
+            return self.doc["content"]
+        with infile:
+            return infile.read()
+
+
+class PatchJournal:
+    """Undo journal for an in-place write into a blob file.
+    The original bytes of the range and the original size are saved
+    before the write, so that a failed or interrupted write can be undone.
+    The journal records the new modified timestamp of the blob; if the
+    database has it, the write was committed and must not be undone.
+    """
+
+    def __init__(self, data):
+        self.filepath = storage.get_filepath(data)
+        self.journalpath = os.path.join(
+            flask.current_app.config["STORAGE_DIRPATH"], f"_journal_{data['iuid']}"
+        )
+        self.header = dict(
+            iuid=data["iuid"], filename=data["filename"], modified=data["modified"]
+        )
+
+    def write(self, offset, content):
+        "Save the original bytes to the journal, then write the new bytes."
+        with open(self.filepath, "r+b") as outfile:
+            outfile.seek(offset)
+            original = outfile.read(len(content))
+            self.header["offset"] = offset
+            self.header["size"] = os.fstat(outfile.fileno()).st_size
+            with open(self.journalpath, "wb") as journalfile:
+                journalfile.write(json.dumps(self.header).encode("utf-8"))
+                journalfile.write(b"\n")
+                journalfile.write(original)
+                journalfile.flush()
+                os.fsync(journalfile.fileno())
+            outfile.seek(offset)
+            outfile.write(content)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def rollback(self):
+        "Restore the original bytes and size of the blob file."
+        with open(self.journalpath, "rb") as journalfile:
+            self.header = json.loads(journalfile.readline())
+            original = journalfile.read()
+        with open(self.filepath, "r+b") as outfile:
+            outfile.seek(self.header["offset"])
+            outfile.write(original)
+            outfile.truncate(self.header["size"])
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def remove(self):
+        "Remove the journal; the write has been committed or rolled back."
+        try:
+            os.remove(self.journalpath)
+        except FileNotFoundError:
+            pass
+
+
+def recover_journals(app, db):
+    """Undo range writes interrupted by a crash, unless the database
+    shows that they were committed. Skip blobs currently being written.
+    """
+    dirpath = app.config["STORAGE_DIRPATH"]
+    for name in os.listdir(dirpath):
+        if not name.startswith("_journal_"):
+            continue
+        journal = PatchJournal.__new__(PatchJournal)
+        journal.journalpath = os.path.join(dirpath, name)
+        try:
+            with open(journal.journalpath, "rb") as journalfile:
+                journal.header = json.loads(journalfile.readline())
+        except (OSError, ValueError):
+            continue
+        journal.filepath = storage.get_filepath(journal.header)
+        try:
+            lockfile = open(journal.filepath, "rb")
+        except FileNotFoundError:
+            journal.remove()
+            continue
+        with lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # Being written right now.
+            rows = list(
+                db.execute(
+                    "SELECT modified FROM blobs WHERE iuid=?",
+                    (journal.header["iuid"],),
+                )
+            )
+            if not rows or rows[0][0] != journal.header["modified"]:
+                journal.rollback()
+            journal.remove()
+
+
+@contextlib.contextmanager
+def reserved_quota(size):
+    """Context manager reserving quota for the current user's upload
+    of the given number of bytes, so that concurrent uploads cannot
+    jointly exceed the quota. If the size is None, i.e. not known in
+    advance, all of the remaining quota is reserved. Yields the number
+    of bytes the upload may add, or None if the user has no quota.
+    Raise QuotaExceeded if the quota cannot accommodate the upload.
+    """
+    user = flask.g.current_user
+    if not user["quota"]:
+        yield None
+        return
+    iuid = utils.get_iuid()
+    db = flask.g.db
+    started = time.perf_counter()
+    # Check and reserve atomically with respect to other processes.
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        # Reservations left by crashed processes are stale after a day.
+        db.execute(
+            "DELETE FROM reservations WHERE created<?", (utils.get_time(-86400),)
+        )
+        allowance = get_quota_allowance(user)
+        if size is None:
+            size = allowance
+        elif size > allowance:
+            raise QuotaExceeded("User's quota cannot accommodate the blob.")
+        if size > 0:
+            db.execute(
+                "INSERT INTO reservations (iuid, username, size, created)"
+                " VALUES (?, ?, ?, ?)",
+                (iuid, user["username"], size, utils.get_time()),
+            )
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    tracing.record("reserve_quota", started, size=size)
+    flask.g.reservation = iuid
+    try:
+        yield allowance
+    except BaseException:
+        # Do not commit any changes left uncommitted by the failed upload.
+        db.rollback()
+        raise
+    finally:
+        flask.g.pop("reservation", None)
+        with db:
+            db.execute("DELETE FROM reservations WHERE iuid=?", (iuid,))
+
+
+def get_quota_allowance(user):
+    """Return the number of bytes which the user's blobs may grow by;
+    the quota less the current usage and the reservations of ongoing uploads.
+    """
+    rows = list(
+        flask.g.db.execute(
+            "SELECT SUM(size) FROM reservations WHERE username=?",
+            (user["username"],),
+        )
+    )
+    return user["quota"] - blobserver.user.user_blobs_size(user) - (rows[0][0] or 0)
+
+
+def get_body_limit():
+    """Return the maximum size of the body of the current request, if it is
+    an upload of blob content, as decided before the body is received;
+    0 if the request will be rejected regardless of the body. Return None
+    if there is no limit, or the request is not an upload of blob content.
+    The current user must have been determined. Used by the ASGI application
+    to reject an upload before receiving all of it.
+    """
+    if flask.request.endpoint != "blob.blob" or not utils.http_PUT():
+        return None
+    data = get_blob_data(flask.request.view_args["filename"])
+    if data:
+        if not allow_update(data):
+            return 0
+    elif not flask.g.current_user:
+        return 0
+    if not flask.g.current_user["quota"]:
+        return None
+    limit = get_quota_allowance(flask.g.current_user) + (data["size"] if data else 0)
+    return max(limit, 0)
+
+
+def copy_file(sourcepath, filepath):
+    """Copy the file without passing its content through Python.
+    Make a reflink (copy-on-write clone) if the filesystem supports it,
+    otherwise copy in kernel space, and only as a last resort in user space.
+    """
+    with open(sourcepath, "rb") as infile, open(filepath, "wb") as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return
+        except OSError:
+            pass
+        size = os.fstat(infile.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                try:
+                    count = os.copy_file_range(
+                        infile.fileno(), outfile.fileno(), size - offset, offset, offset
+                    )
+                except (AttributeError, OSError):
+                    count = os.sendfile(
+                        outfile.fileno(), infile.fileno(), offset, size - offset
+                    )
+                if not count:
+                    break
+                offset += count
+        except OSError:
+            infile.seek(offset)
+            outfile.seek(offset)
+            shutil.copyfileobj(infile, outfile, CHUNK_SIZE)
+
+
+def get_patch_offset(data, content):
+    """Return the offset at which to write the content for a PATCH request.
+    If there is a 'Content-Range' header, its start is the offset,
+    otherwise the content is to be appended to the blob.
+    Raise ValueError if the range is invalid, or would leave a hole.
+    """
+    content_range = flask.request.headers.get("Content-Range")
+    if not content_range:
+        return data["size"]
+    match = CONTENT_RANGE_RX.match(content_range.strip())
+    if not match:
+        raise ValueError("Invalid Content-Range header.")
+    start, stop = int(match.group(1)), int(match.group(2))
+    if stop - start + 1 != len(content):
+        raise ValueError("Content-Range does not match the content length.")
+    if start > data["size"]:
+        raise ValueError("Content-Range starts beyond the end of the blob.")
+    return start
+
+
+def send_content(data, content):
+    "Send the content of the blob, given as bytes."
+    return flask.send_file(
+        io.BytesIO(content),
+        download_name=data["filename"],
+        etag=get_etag(data),
+        last_modified=get_last_modified(data),
+    )
+
+
+def send_file(data):
+    """Send the content of the blob from its uncompressed file.
+    Abort with 404 if there is no file for the blob.
+    """
+    for attempt in range(2):
+        try:
+            return send_path(storage.get_filepath(data), etag=get_etag(data))
+        except FileNotFoundError:
+            pass  # May just have been moved to the other layout; try once more.
+    flask.abort(http.client.NOT_FOUND)
+
+
+def send_path(filepath, etag, download_name=None, last_modified=None):
+    """Send the file at the path as is, also for a range request, such that
+    the server can send it with 'os.sendfile' via its 'wsgi.file_wrapper'.
+    The kernel is advised that a large file will be read sequentially.
+    Raise FileNotFoundError if there is no such file.
+    """
+    infile = DownloadFile(filepath)
+    try:
+        size = os.fstat(infile.fileno()).st_size
+        if size >= CHUNK_SIZE:
+            infile.advise("POSIX_FADV_SEQUENTIAL")
+            limit = flask.current_app.config["DOWNLOAD_DROP_CACHE_SIZE"]
+            infile.drop_cache = bool(limit) and size >= limit
+        response = flask.send_file(
+            infile,
+            download_name=download_name or os.path.basename(filepath),
+            etag=etag,
+            last_modified=last_modified or os.fstat(infile.fileno()).st_mtime,
+            conditional=False,
+        )
+        response.content_length = size
+        response = response.make_conditional(
+            flask.request, accept_ranges=True, complete_length=size
+        )
+    except Exception:
+        infile.close()
+        raise
+    # Werkzeug wraps the file to limit it to the range, which the server
+    # can only iterate in Python. Its own file wrapper, given the file
+    # positioned at the start of the range, sends Content-Length bytes.
+    environ = flask.request.environ
+    if response.status_code == http.client.PARTIAL_CONTENT:
+        if "wsgi.file_wrapper" in environ:
+            infile.seek(response.content_range.start)
+            response.response = werkzeug.wsgi.wrap_file(environ, infile, CHUNK_SIZE)
+    return response
+
+
+class DownloadFile(io.FileIO):
+    """File of blob content to download. If so marked, its pages are dropped
+    from the page cache when it is closed, so that downloading a huge file
+    does not evict the content of the frequently downloaded blobs.
+    """
+
+    drop_cache = False
+
+    def advise(self, name):
+        "Give the named advice to the kernel for the file, if possible."
+        try:
+            os.posix_fadvise(self.fileno(), 0, 0, getattr(os, name))
+        except (AttributeError, OSError):
+            pass
+
+    def close(self):
+        if self.drop_cache and not self.closed:
+            self.advise("POSIX_FADV_DONTNEED")
+        super().close()
+
+
+def send_compressed(data, encoding):
+    """Send the content of the blob from its compressed file. Send the file
+    as is if the given encoding is that of the file, otherwise decompress
+    it on the fly. For a range request, only the blocks containing
+    the range are decompressed.
+    """
+    if encoding == data["encoding"]:
+        for attempt in range(2):
+            try:
+                response = send_path(
+                    storage.get_filepath(data),
+                    download_name=data["filename"],
+                    etag=f"{get_etag(data)}-{encoding}",
+                    last_modified=get_last_modified(data),
+                )
+            except FileNotFoundError:
+                pass  # May just have been moved to the other layout; try once more.
+            else:
+                response.headers.set("Content-Encoding", encoding)
+                return response
+        flask.abort(http.client.NOT_FOUND)
+    try:
+        infile = open(storage.get_filepath(data), "rb")
+    except FileNotFoundError:
+        # May just have been moved to the other layout; try once more.
+        infile = open(storage.get_filepath(data), "rb")
+    reader = compression.Reader(infile, data["encoding"], json.loads(data["offsets"]))
+    response = flask.send_file(
+        reader,
+        download_name=data["filename"],
+        etag=get_etag(data),
+        last_modified=get_last_modified(data),
+        conditional=False,
+    )
+    # The server's own file wrapper may not allow seeking, which is
+    # required for a range to be read without decompressing all before it.
+    response.response = werkzeug.wsgi.FileWrapper(reader)
+    response.content_length = data["size"]
+    try:
+        return response.make_conditional(
+            flask.request, accept_ranges=True, complete_length=data["size"]
+        )
+    except werkzeug.exceptions.RequestedRangeNotSatisfiable:
+        reader.close()
+        raise
+
+
+def get_download_encoding(data, compressible):
+    """Return the content encoding in which to send the blob, if any.
+    A compressed file is sent as is if the client accepts its encoding.
+    Otherwise, the content is compressed for download if compressible
+    and the client accepts any of the available encodings.
+    A range request is always served from the original content.
+    """
+    if "Range" in flask.request.headers:
+        return None
+    if data["encoding"]:
+        if not flask.request.accept_encodings[data["encoding"]]:
+            return None
+        if mimetypes.guess_type(data["filename"])[1]:
+            return None
+        return data["encoding"]
+    if compressible:
+        return flask.request.accept_encodings.best_match(compression.get_encodings())
+    return None
+
+
+def is_download_compressible(data):
+    """Is compression of downloads enabled, and is the blob large enough and
+    of a content type that is worth compressing?
+    """
+    if not flask.current_app.config["DOWNLOAD_COMPRESSION"]:
+        return False
+    if data["size"] < compression.MIN_SIZE:
+        return False
+    mimetype, encoding = mimetypes.guess_type(data["filename"])
+    return not encoding and compression.is_compressible_type(mimetype)
+
+
+def send_encoded(data, encoding):
+    """Send the content of the blob compressed in the given encoding.
+    Use the variant compressed in advance, if any, otherwise schedule it
+    to be made if the blob is downloaded frequently, and compress the
+    content on the fly if the limit on concurrent compressions allows.
+    Return None if not possible; the content must then be sent as is.
+    """
+    global _compressions
+    etag = f"{get_etag(data)}-{encoding}"
+    if data["sha256"]:
+        try:
+            response = send_path(
+                storage.get_variant_filepath(data, encoding),
+                download_name=data["filename"],
+                etag=etag,
+                last_modified=get_last_modified(data),
+            )
+        except FileNotFoundError:
+            if (
+                count_download(data, encoding)
+                >= flask.current_app.config["DOWNLOAD_PRECOMPRESS_HITS"]
+            ):
+                schedule_variant(data, encoding)
+        else:
+            response.headers.set("Content-Encoding", encoding)
+            return response
+    with _download_counts_lock:
+        if _compressions is None:
+            _compressions = threading.BoundedSemaphore(
+                flask.current_app.config["DOWNLOAD_COMPRESSION_STREAMS"]
+            )
+    if not _compressions.acquire(blocking=False):
+        return None
+    try:
+        infile = open(storage.get_filepath(data), "rb")
+    except FileNotFoundError:
+        _compressions.release()
+        return None
+    response = flask.send_file(
+        compression.EncodingReader(
+            infile,
+            encoding,
+            compression.STREAM_LEVELS[encoding],
+            on_close=_compressions.release,
+        ),
+        download_name=data["filename"],
+        etag=etag,
+        last_modified=get_last_modified(data),
+    )
+    response.headers.set("Content-Encoding", encoding)
+    return response
+
+
+def count_download(data, encoding):
+    "Count a download of the blob in the encoding; return the current count."
+    key = (data["iuid"], data["sha256"], encoding)
+    with _download_counts_lock:
+        count = _download_counts.get(key, 0) + 1
+        _download_counts[key] = count
+        _download_counts.move_to_end(key)
+        while len(_download_counts) > DOWNLOAD_COUNTS_MAX:
+            _download_counts.popitem(last=False)
+    return count
+
 
-def get_blob_data(filename):
+def schedule_variant(data, encoding):
+    """Make the variant of the blob file compressed in the given encoding
+    in a background thread, unless already in progress.
+    """
+    key = (data["iuid"], data["sha256"], encoding)
+    with _download_counts_lock:
+        if key in _variants_in_progress:
+            return
+        _variants_in_progress.add(key)
+        _download_counts.pop(key, None)
+    thread = threading.Thread(
+        target=make_variant,
+        args=(flask.current_app._get_current_object(), dict(data), encoding),
+        daemon=True,
+    )
+    thread.start()
+
+
+def make_variant(app, data, encoding):
+    """Write the variant of the blob file compressed in the given encoding.
+    Keep it only if the content read has the sha256 digest of the blob data,
+    which is part of the name of the variant file.
+    """
+    with app.app_context():
+        filepath = storage.get_filepath(data)
+        variantpath = storage.get_variant_filepath(data, encoding)
+    tmppath = f"{variantpath}.{utils.get_iuid()}.tmp"
+    hash = hashlib.sha256()
+    compressor = compression.get_compressor(
+        encoding, compression.VARIANT_LEVELS[encoding]
+    )
+    try:
+        os.makedirs(os.path.dirname(variantpath), exist_ok=True)
+        with open(filepath, "rb") as infile, open(tmppath, "wb") as outfile:
+            while True:
+                chunk = infile.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hash.update(chunk)
+                outfile.write(compressor.compress(chunk))
+            outfile.write(compressor.flush())
+        if hash.hexdigest() == data["sha256"]:
+            os.replace(tmppath, variantpath)
+    except OSError:
+        pass
+    finally:
+        try:
+            os.remove(tmppath)
+        except FileNotFoundError:
+            pass
+        with _download_counts_lock:
+            _variants_in_progress.discard((data["iuid"], data["sha256"], encoding))
+
+
+def get_last_modified(data):
+    "Return the modified timestamp of the blob as a datetime."
+    return datetime.datetime.strptime(
+        data["modified"], "%Y-%m-%dT%H:%M:%S.%fZ"
+    ).replace(tzinfo=datetime.timezone.utc)
+
+
+def get_etag(data):
+    """Return the entity tag for the current content of the blob.
+    This is the SHA256 digest, unless it is currently being recomputed.
+    """
+    return data["sha256"] or f"{data['size']}-{data['modified']}"
+
+
+def save_hash_state(iuid, hashes):
+    "Keep copies of the hash objects for the content of the blob."
+    with _hash_states_lock:
+        _hash_states[iuid] = {n: h.copy() for n, h in hashes.items()}
+        _hash_states.move_to_end(iuid)
+        while len(_hash_states) > HASH_STATES_MAX:
+            _hash_states.popitem(last=False)
+
+
+def get_hash_state(iuid, sha256):
+    """Return copies of the hash objects for the content of the blob,
+    if available and valid for the given SHA256 digest of the content.
+    """
+    with _hash_states_lock:
+        hashes = _hash_states.get(iuid)
+        if not hashes or hashes["sha256"].hexdigest() != sha256:
+            return None
+        return {n: h.copy() for n, h in hashes.items()}
+
+
+def schedule_digests(data):
+    """Compute the digests of the blob content in a background thread.
+    If they are already being computed for the blob, that thread instead
+    computes them once more when done, for the latest data.
+    """
+    with _digests_pending_lock:
+        running = data["iuid"] in _digests_pending
+        _digests_pending[data["iuid"]] = dict(data)
+    if running:
+        return
+    thread = threading.Thread(
+        target=run_digests,
+        args=(flask.current_app._get_current_object(), data["iuid"]),
+        daemon=True,
+    )
+    thread.start()
+
+
+def run_digests(app, iuid):
+    "Compute the digests of the blob until its data no longer changes meanwhile."
+    while True:
+        with _digests_pending_lock:
+            data = _digests_pending[iuid]
+        try:
+            update_digests(app, data)
+        except Exception:
+            # Left for the recovery at startup.
+            with _digests_pending_lock:
+                _digests_pending.pop(iuid, None)
+            raise
+        with _digests_pending_lock:
+            if _digests_pending[iuid] is data:
+                del _digests_pending[iuid]
+                return
+
+
+def update_digests(app, data):
+    """Compute the digests of the blob content by reading the file.
+    Update the database only if the blob has not been modified meanwhile.
+    """
+    hashes = {name: hashlib.new(name) for name in DIGEST_NAMES}
+    db = utils.get_db(app)
+    with app.app_context():
+        flask.g.db = db
+        try:
+            with storage.open_content(data) as infile:
+                while True:
+                    chunk = infile.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    for hash in hashes.values():
+                        hash.update(chunk)
+        except OSError:
+            db.close()
+            return
+    with db:
+        cursor = db.execute(
+            "UPDATE blobs SET md5=?, sha256=?, sha512=? WHERE iuid=? AND modified=?",
+            [hashes[n].hexdigest() for n in DIGEST_NAMES]
+            + [data["iuid"], data["modified"]],
+        )
+    db.close()
+    if cursor.rowcount:
+        save_hash_state(data["iuid"], hashes)
+        with app.app_context():
+            cache.invalidate("blobs")
+
+
+def recover_digests(app):
+    """Compute the digests of the blobs for which they were cleared by
+    a range write, but never recomputed; e.g. if the process was stopped.
+    Skipped if another process is already doing this.
+    """
+    lockpath = os.path.join(app.config["STORAGE_DIRPATH"], DIGESTS_LOCK_FILENAME)
+    with open(lockpath, "ab") as lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        db = utils.get_db(app)
+        rows = list(
+            db.execute("SELECT iuid, filename, modified FROM blobs WHERE sha256=''")
+        )
+        db.close()
+        for row in rows:
+            update_digests(app, dict(zip(row.keys(), row)))
+
+
+def get_cached_blob(filename):
+    """Return the data for the blob, including how it is stored, and its
+    content if small enough to be kept in the per-process cache of hot
+    blobs, otherwise None. Return None for the data if not found.
+    """
+    if not flask.current_app.config["BLOB_CACHE_SIZE"]:
+        return get_blob_data(filename, stored=True), None
+    blobs = cache.get_cache("blobs", flask.current_app.config["BLOB_CACHE_SIZE"])
+    return blobs.get(get_filename_key(filename), lambda: load_cached_blob(filename))
+
+
+def load_cached_blob(filename):
+    """Return the data and the content of the blob to be cached, and the size
+    of the content, which is None if it should not be cached.
+    """
+    data = get_blob_data(filename, stored=True)
+    if not data or data["size"] > flask.current_app.config["BLOB_CACHE_ITEM_SIZE"]:
+        return (data, None), None
+    if data["inline"] is not None:
+        content = data["inline"]
+    else:
+        try:
+            with storage.open_content(data) as infile:
+                content = infile.read()
+        except FileNotFoundError:
+            return (data, None), None
+    return (data, content), len(content)
+
+
+@tracing.traced
+def get_blob_data(filename, stored=False):
     """Return the data (not the content) for the blob.
+    If 'stored' is true, also return how the content is stored: the item
+    'inline' is the content if it is stored inline in the database, and
+    the items 'encoding' and 'offsets' are set if the file is compressed;
+    otherwise these are None.
     Return None if not found.
+    The data, or that the blob does not exist, is cached if so configured.
     """
     if filename.startswith("_"):
         return None
-    rows = list(
-        flask.g.db.execute(
-            "SELECT * FROM blobs WHERE filename=? COLLATE NOCASE", (filename,)
-        )
+    entries = flask.current_app.config["BLOB_DATA_CACHE_ENTRIES"]
+    if stored or not entries:
+        return load_blob_data(filename, stored)
+    # Each entry, also for a missing blob, counts as size 1.
+    data = cache.get_cache("blob_data", entries, namespace="blobs").get(
+        get_filename_key(filename), lambda: (load_blob_data(filename), 1)
     )
+    if data:
+        return dict(data)  # The caller may modify it.
+    else:
+        return None
+
+
+def get_filename_key(filename):
+    """Return the key for the filename in the caches. Filenames are unique
+    regardless of the case of ASCII letters, as compared in the database.
+    """
+    return filename.translate(ASCII_LOWERCASE)
+
+
+def load_blob_data(filename, stored=False):
+    "Return the data for the blob from the database, or None if not found."
+    if stored:
+        sql = (
+            "SELECT blobs.*, blobs_inline.content AS inline,"
+            " blobs_compressed.encoding AS encoding,"
+            " blobs_compressed.offsets AS offsets FROM blobs"
+            " LEFT JOIN blobs_inline ON blobs.iuid=blobs_inline.iuid"
+            " LEFT JOIN blobs_compressed ON blobs.iuid=blobs_compressed.iuid"
+            " WHERE filename=? COLLATE NOCASE"
+        )
+    else:
+        sql = "SELECT * FROM blobs WHERE filename=? COLLATE NOCASE"
+    rows = list(flask.g.db.execute(sql, (filename,)))
     if rows:
         return dict(zip(rows[0].keys(), rows[0]))
     else:
@@ -442,13 +1545,17 @@ def delete_blob(data):
     "Delete the blob and its logs."
     with flask.g.db:
         flask.g.db.execute("DELETE FROM logs WHERE iuid=?", (data["iuid"],))
+        flask.g.db.execute("DELETE FROM verifications WHERE iuid=?", (data["iuid"],))
         flask.g.db.execute(
             "DELETE FROM blobs WHERE filename=? COLLATE NOCASE", (data["filename"],)
         )
-        filepath = os.path.join(
-            flask.current_app.config["STORAGE_DIRPATH"], data["filename"]
-        )
-        os.remove(filepath)
+        if storage.get_inline(data) is None:
+            os.remove(storage.get_filepath(data))
+            storage.set_compression(data, None)
+            storage.remove_variants(data)
+        else:
+            storage.delete_inline(data)
+    cache.invalidate("blobs")
 
 
 def check_filename(filename):
@@ -489,7 +1596,7 @@ def get_commands(data):
         return None
     if not allow_update(data):
         return None
-    accesskey = flask.g.current_user.get("accesskey")
+    accesskey = blobserver.user.get_accesskey(flask.g.current_user)
     if not accesskey:
         return None
     content_url = flask.url_for("blob.blob", filename=data["filename"], _external=True)
@@ -1,8 +1,11 @@
 "Lists of blobs."
 
+import http.client
+
 import flask
 
 import blobserver.user
+from blobserver import cache
 from blobserver import constants
 from blobserver import utils
 
@@ -10,6 +13,7 @@ blueprint = flask.Blueprint("blobs", __name__)
 
 
 @blueprint.route("/all")
+@utils.page_cached
 def all():
     "List of all blobs."
     cursor = flask.g.db.cursor()
@@ -21,13 +25,20 @@ def all():
 @blueprint.route("/all.json")
 def all_json():
     "JSON for list of all blobs."
+    etag = utils.get_etag(cache.get_version("blobs"))
+    response = utils.check_not_modified(etag)
+    if response:
+        return response
     cursor = flask.g.db.cursor()
     rows = cursor.execute("SELECT * FROM blobs")
     blobs = [dict(zip(row.keys(), row)) for row in rows]
-    return flask.jsonify(get_blobs_json(blobs))
+    response = flask.jsonify(get_blobs_json(blobs))
+    response.set_etag(etag)
+    return response
 
 
 @blueprint.route("/users")
+@utils.page_cached
 def users():
     "List of number of blobs for the all users, and links to those lists."
     cursor = flask.g.db.cursor()
@@ -53,13 +64,20 @@ def user(username):
 @blueprint.route("/user/<username>.json")
 def user_json(username):
     "JSON for list of all blobs for the given user."
+    # Changes to blobs also change the version for users.
+    etag = utils.get_etag(cache.get_version("users"))
+    response = utils.check_not_modified(etag)
+    if response:
+        return response
     user = blobserver.user.get_user(username)
     if user is None:
         flask.abort(http.client.NOT_FOUND)
     cursor = flask.g.db.cursor()
     rows = cursor.execute("SELECT * FROM blobs WHERE username=?", (username,))
     blobs = [dict(zip(row.keys(), row)) for row in rows]
-    return flask.jsonify(get_blobs_json(blobs))
+    response = flask.jsonify(get_blobs_json(blobs))
+    response.set_etag(etag)
+    return response
 
 
 @blueprint.route("/search")
@@ -83,7 +101,7 @@ def get_commands():
     "Get commands and scripts populated with access key and URLs."
     if not flask.g.current_user:
         return None
-    accesskey = flask.g.current_user.get("accesskey")
+    accesskey = blobserver.user.get_accesskey(flask.g.current_user)
     if not accesskey:
         return None
     url = flask.url_for("blob.blob", filename="blob-filename.ext", _external=True)
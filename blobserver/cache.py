@@ -0,0 +1,350 @@
+"""Caches in the memory of each server process, and a cache shared by all
+server processes on the machine.
+
+Each cache entry records the generation of its namespace at the time it
+was loaded, and is valid only as long as that generation is current.
+A change to any item in the namespace increments its generation counter,
+which is shared by all server processes on the machine through a small
+memory-mapped file in the storage directory. Several caches may share
+the generation counter of a namespace. Invalidating a namespace also
+invalidates the namespaces whose entries are derived from it.
+
+The shared cache is a separate Sqlite3 database file in the storage
+directory, holding JSON-serializable values by namespace and key.
+Its entries also expire after a time-to-live, and the least recently
+used entries are evicted when its total size exceeds the configured
+limit. Any failure to use it is counted, and the value is then loaded
+directly instead.
+"""
+
+import collections
+import fcntl
+import json
+import mmap
+import os
+import os.path
+import sqlite3
+import struct
+import threading
+import time
+
+import flask
+
+GENERATION_FILENAME = "_generation_{}"
+SHARED_FILENAME = "_cache.sqlite3"
+ACCESSED_RESOLUTION = 10.0  # Seconds; the access time of a hit is not updated
+# more often than this, to avoid a database write for every hit.
+
+# Generation counters and caches by name. Per-process.
+_generations = {}
+_caches = {}
+_lock = threading.Lock()
+
+# Namespaces to invalidate along with the given namespace. The data for
+# users includes the number and total size of their blobs, and the pages
+# show both blobs and users.
+DEPENDENT_NAMESPACES = {"blobs": ["users"], "users": ["pages"]}
+
+# Connections to the shared cache database, per thread, and statistics
+# for its namespaces, per process.
+_shared = threading.local()
+_shared_stats = collections.defaultdict(
+    lambda: collections.Counter(hits=0, misses=0, errors=0)
+)
+
+
+class Generation:
+    "Counter shared by all server processes through a memory-mapped file."
+
+    def __init__(self, filepath):
+        self.fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < 8:
+                os.ftruncate(self.fd, 8)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mmap = mmap.mmap(self.fd, 8)
+        self.inode = os.fstat(self.fd).st_ino
+
+    def get(self):
+        "Return the current value of the counter."
+        return struct.unpack_from("Q", self.mmap)[0]
+
+    def increment(self):
+        "Increment the counter, atomically with respect to other processes."
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            struct.pack_into("Q", self.mmap, 0, self.get() + 1)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def get_generation(name):
+    "Return the generation counter for the namespace."
+    try:
+        return _generations[name]
+    except KeyError:
+        pass
+    with _lock:
+        try:
+            return _generations[name]
+        except KeyError:
+            filepath = os.path.join(
+                flask.current_app.config["STORAGE_DIRPATH"],
+                GENERATION_FILENAME.format(name),
+            )
+            generation = _generations[name] = Generation(filepath)
+            return generation
+
+
+def get_version(name):
+    """Return a string identifying the current state of the namespace,
+    for use in HTTP validators. Since the counter starts over if its file
+    is removed, the identity of the file is included.
+    """
+    generation = get_generation(name)
+    return f"{generation.inode}-{generation.get()}"
+
+
+def invalidate(name):
+    """Invalidate all cache entries in the namespace, and in the namespaces
+    that depend on it, in all server processes.
+    """
+    get_generation(name).increment()
+    for dependent in DEPENDENT_NAMESPACES.get(name, []):
+        invalidate(dependent)
+
+
+def get_cache(name, max_size, namespace=None):
+    """Return the cache with the given name, creating it if required.
+    Its entries are invalidated with the namespace, by default its name.
+    """
+    with _lock:
+        try:
+            return _caches[name]
+        except KeyError:
+            cache = _caches[name] = Cache(name, max_size, namespace or name)
+            return cache
+
+
+def get_stats():
+    """Return the statistics for all caches in this process, including
+    the use of the shared cache by namespace.
+    """
+    with _lock:
+        caches = list(_caches.values())
+        shared = {f"shared {n}": dict(s) for n, s in _shared_stats.items()}
+    result = {cache.name: cache.get_stats() for cache in caches}
+    for stats in shared.values():
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    result.update(shared)
+    return result
+
+
+def get_shared(namespace, key, load, ttl=None, cache_none=True):
+    """Return the value for the key in the namespace from the shared cache.
+    If not cached, expired or invalidated, call 'load' to get the value,
+    which must be JSON-serializable, and store it with the given
+    time-to-live in seconds, by default the configured one.
+    A value of None is also cached, unless 'cache_none' is false.
+    """
+    config = flask.current_app.config
+    if not config["SHARED_CACHE_SIZE"]:
+        return load()
+    generation = get_generation(namespace).get()
+    now = time.time()
+    try:
+        db = get_shared_db()
+        rows = list(
+            db.execute(
+                "SELECT value, generation, expires, accessed FROM entries"
+                " WHERE namespace=? AND key=?",
+                (namespace, key),
+            )
+        )
+        if rows and rows[0][1] == generation and rows[0][2] > now:
+            if now - rows[0][3] > ACCESSED_RESOLUTION:
+                db.execute(
+                    "UPDATE entries SET accessed=? WHERE namespace=? AND key=?",
+                    (now, namespace, key),
+                )
+            count_shared(namespace, "hits")
+            return json.loads(rows[0][0])
+    except sqlite3.Error:
+        count_shared(namespace, "errors")
+        return load()
+    count_shared(namespace, "misses")
+    value = load()
+    if value is None and not cache_none:
+        return value
+    if ttl is None:
+        ttl = config["SHARED_CACHE_TTL"]
+    try:
+        put_shared(db, namespace, key, generation, value, now + ttl, now)
+    except sqlite3.Error:
+        count_shared(namespace, "errors")
+    return value
+
+
+def put_shared(db, namespace, key, generation, value, expires, now):
+    """Store the value in the shared cache. Evict expired and invalidated
+    entries in the namespace, and the least recently used entries, if the
+    total size exceeds the limit.
+    """
+    max_size = flask.current_app.config["SHARED_CACHE_SIZE"]
+    value = json.dumps(value)
+    size = len(key) + len(value)
+    if size > max_size:
+        return
+    db.execute(
+        "INSERT OR REPLACE INTO entries"
+        " (namespace, key, generation, value, size, expires, accessed)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (namespace, key, generation, value, size, expires, now),
+    )
+    total = list(db.execute("SELECT SUM(size) FROM entries"))[0][0]
+    if total <= max_size:
+        return
+    db.execute(
+        "DELETE FROM entries WHERE expires<? OR (namespace=? AND generation!=?)",
+        (now, namespace, generation),
+    )
+    total = list(db.execute("SELECT SUM(size) FROM entries"))[0][0] or 0
+    evicted = []
+    for rowid, size in db.execute("SELECT rowid, size FROM entries ORDER BY accessed"):
+        if total <= max_size:
+            break
+        evicted.append((rowid,))
+        total -= size
+    db.executemany("DELETE FROM entries WHERE rowid=?", evicted)
+    count_shared(namespace, "evictions", len(evicted))
+
+
+def get_shared_db():
+    """Return the connection to the shared cache database for this thread,
+    creating the database if required. Writes are not made durable;
+    the contents are only a cache.
+    """
+    filepath = os.path.join(
+        flask.current_app.config["STORAGE_DIRPATH"], SHARED_FILENAME
+    )
+    try:
+        return _shared.dbs[filepath]
+    except AttributeError:
+        _shared.dbs = {}
+    except KeyError:
+        pass
+    db = sqlite3.connect(filepath, timeout=1.0, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS entries"
+        "(namespace TEXT NOT NULL,"
+        " key TEXT NOT NULL,"
+        " generation INTEGER NOT NULL,"
+        " value TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " expires REAL NOT NULL,"
+        " accessed REAL NOT NULL,"
+        " PRIMARY KEY (namespace, key))"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS entries_accessed_index ON entries (accessed)"
+    )
+    _shared.dbs[filepath] = db
+    return db
+
+
+def count_shared(namespace, name, increment=1):
+    "Count the event for the namespace in the shared cache statistics."
+    with _lock:
+        _shared_stats[namespace][name] += increment
+
+
+class Flight:
+    "The loading of a value for a key, which other threads may wait for."
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.loaded = False
+        self.value = None
+
+
+class Cache:
+    """Least-recently-used cache bounded by the total size of its values.
+    When the value for a key must be loaded, only one thread does so,
+    and other threads asking for the same key wait for its result.
+    """
+
+    def __init__(self, name, max_size, namespace):
+        self.name = name
+        self.namespace = namespace
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter(hits=0, misses=0, waits=0, evictions=0)
+
+    def get(self, key, load):
+        """Return the value for the key. If not cached, or cached for an older
+        generation, call 'load' to get the value and its size. The value
+        is cached unless the size is None.
+        """
+        generation = get_generation(self.namespace).get()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+            # A load started for an older generation may give a stale value.
+            flight = self.flights.get((key, generation))
+            if flight is None:
+                flight = self.flights[(key, generation)] = Flight()
+                loader = True
+            else:
+                self.stats["waits"] += 1
+                loader = False
+        if not loader:
+            flight.event.wait()
+            if flight.loaded:
+                return flight.value
+            return load()[0]  # The loading thread failed; try on our own.
+        try:
+            value, size = load()
+            flight.value = value
+            flight.loaded = True
+        finally:
+            with self.lock:
+                del self.flights[(key, generation)]
+                if flight.loaded:
+                    self.put(key, generation, value, size)
+            flight.event.set()
+        return value
+
+    def put(self, key, generation, value, size):
+        "Store the value, evicting the least recently used values to fit it."
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[2]
+        if size is None or size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            old = self.entries.popitem(last=False)[1]
+            self.size -= old[2]
+            self.stats["evictions"] += 1
+        self.entries[key] = (generation, value, size)
+        self.size += size
+
+    def get_stats(self):
+        "Return the statistics for the cache."
+        with self.lock:
+            result = dict(self.stats)
+            result["entries"] = len(self.entries)
+            result["size"] = self.size
+            result["max_size"] = self.max_size
+        return result
@@ -1,21 +1,42 @@
 "Command-line interface to the blobserver instance."
 
+import collections
+import concurrent.futures
 import csv
+import gzip
+import hashlib
 import io
+import itertools
+import json
 import os
 import os.path
+import queue
+import shutil
+import sqlite3
+import sys
 import tarfile
+import tempfile
+import threading
 import time
 
 import click
 import flask
 
+import blobserver.blob
 import blobserver.main
 import blobserver.user
 
+from blobserver import cache
+from blobserver import compression
 from blobserver import constants
+from blobserver import storage
 from blobserver import utils
 
+# Name of the sha256 manifest of all blobs in a dump file.
+MANIFEST_FILENAME = "_manifest.json"
+
+CHUNK_SIZE = 1024 * 1024
+
 
 @click.group()
 def cli():
@@ -110,62 +131,822 @@ def users():
 
 @cli.command()
 @click.option("--tarname", help="Name of the dump tar file.")
-def dump(tarname):
-    "Dump the database and all files to a '.tar.gz' dump file."
+@click.option(
+    "--since",
+    help="Incremental dump: only blobs modified at or after this date or time.",
+)
+@click.option(
+    "--manifest",
+    type=click.File("r"),
+    help="Incremental dump: only blobs whose sha256 differs from this manifest.",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of compression threads.",
+)
+def dump(tarname, since, manifest, threads):
+    """Dump the database and all files to a '.tar.gz' dump file.
+    Content stored inline in the database is dumped with it.
+    Compressed files are dumped decompressed.
+    A '.tar.zst' file requires the 'zstandard' package.
+    The sha256 manifest of all blobs is written to a '.manifest.json' file.
+
+    The database is dumped as it was when the dump started. A file whose
+    content has changed since then is not dumped, since it would not
+    match the database; it is omitted from the manifest, so that the
+    next incremental dump using the manifest includes it.
+
+    To restore from an incremental dump and the dump it is based on,
+    first undump the incremental dump, then the base dump with '--resume';
+    the database of the most recent dump must be the one restored.
+    """
     with blobserver.main.app.app_context():
         if not tarname:
             tarname = "dump_{}.tar.gz".format(time.strftime("%Y-%m-%d"))
-        if tarname.endswith(".gz"):
-            mode = "w:gz"
-        else:
-            mode = "w"
-        outfile = tarfile.open(tarname, mode=mode)
-        dirpath = flask.current_app.config["STORAGE_DIRPATH"]
-        count = 0
-        size = 0
-        for filename in os.listdir(dirpath):
-            info = tarfile.TarInfo(filename)
-            with open(os.path.join(dirpath, filename), "rb") as infile:
-                data = infile.read()
-            info.size = len(data)
-            outfile.addfile(info, io.BytesIO(data))
-            count += 1
-            size += len(data)
-        outfile.close()
-        click.echo(f"Wrote {count} files, {size} bytes to {tarname}")
+        previous = json.load(manifest) if manifest else None
+        started = time.time()
+        with tempfile.TemporaryDirectory() as tmpdirpath:
+            # Consistent snapshot of the database, using the online backup API.
+            snapshotpath = os.path.join(tmpdirpath, constants.SQLITE3_FILENAME)
+            db = flask.g.db = utils.get_db()
+            snapshot = sqlite3.connect(snapshotpath)
+            db.backup(snapshot)
+            snapshot.row_factory = sqlite3.Row
+            rows = list(
+                snapshot.execute(
+                    "SELECT blobs.iuid, filename, sha256, size, modified,"
+                    " blobs.iuid IN (SELECT iuid FROM blobs_inline) AS inline,"
+                    " encoding, offsets FROM blobs"
+                    " LEFT JOIN blobs_compressed ON blobs.iuid=blobs_compressed.iuid"
+                )
+            )
+            # The files in the dump are not compressed.
+            with snapshot:
+                snapshot.execute("DELETE FROM blobs_compressed")
+            snapshot.close()
+            current = {row["filename"]: row["sha256"] for row in rows}
+            if since:
+                rows = [row for row in rows if row["modified"] >= since]
+            if previous is not None:
+                rows = [
+                    row
+                    for row in rows
+                    if previous.get(row["filename"]) != row["sha256"]
+                ]
+            with open(tarname, "wb") as rawfile:
+                outfile = get_compressor(tarname, rawfile, threads)
+                with tarfile.open(fileobj=outfile, mode="w|") as archive:
+                    archive.add(snapshotpath, arcname=constants.SQLITE3_FILENAME)
+                    count = 0
+                    size = 0
+                    for row in rows:
+                        if row["inline"]:
+                            continue  # Content is in the database.
+                        try:
+                            info = add_file(archive, db, row)
+                        except FileNotFoundError:
+                            click.echo(f"Missing file for blob {row['filename']}")
+                            continue
+                        if info is None:
+                            click.echo(
+                                f"Changed since the start; not dumped {row['filename']}"
+                            )
+                            current.pop(row["filename"])
+                            continue
+                        count += 1
+                        size += info.size
+                    data = json.dumps(current).encode("utf-8")
+                    info = tarfile.TarInfo(MANIFEST_FILENAME)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    archive.addfile(info, io.BytesIO(data))
+                outfile.close()
+        db.close()
+        with open(f"{tarname}.manifest.json", "w") as manifestfile:
+            json.dump(current, manifestfile)
+        elapsed = time.time() - started
+        click.echo(
+            f"Wrote {count} files, {size} bytes to {tarname}"
+            f" in {elapsed:.1f} s ({size / (elapsed or 1) / 1e6:.1f} MB/s)"
+        )
+
+
+def add_file(archive, db, row):
+    """Stream the file for the blob into the archive, holding its lock,
+    so that it is not written meanwhile. Return the tar header, or None
+    if the content of the blob has changed since the given row was read.
+    Raise FileNotFoundError if there is no file.
+    """
+    with storage.locked_file(row) as filepath:
+        rows = list(
+            db.execute(
+                "SELECT sha256, size, modified FROM blobs WHERE iuid=?", (row["iuid"],)
+            )
+        )
+        if filepath is None or not rows:
+            return None
+        # The digests are empty while being recomputed after a range write.
+        if (rows[0]["sha256"], rows[0]["size"]) != (row["sha256"], row["size"]) or (
+            not row["sha256"] and rows[0]["modified"] != row["modified"]
+        ):
+            return None
+        with open(filepath, "rb") as infile:
+            # The tar header size is taken from the opened file.
+            info = archive.gettarinfo(arcname=row["filename"], fileobj=infile)
+            if row["encoding"]:
+                infile = compression.Reader(
+                    infile, row["encoding"], json.loads(row["offsets"])
+                )
+                info.size = row["size"]
+            archive.addfile(info, infile)
+    return info
+
+
+def get_compressor(tarname, rawfile, threads):
+    "Return a writable file object compressing into the raw file as appropriate."
+    if tarname.endswith(".gz"):
+        return ParallelGzipWriter(rawfile, threads)
+    elif tarname.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise click.ClickException("The 'zstandard' package is not installed.")
+        compressor = zstandard.ZstdCompressor(threads=threads)
+        return compressor.stream_writer(rawfile, closefd=False)
+    else:
+        return NonClosingWriter(rawfile)
+
+
+class NonClosingWriter:
+    "Pass writes through to the file; leave it to the owner to close it."
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def write(self, data):
+        return self.outfile.write(data)
+
+    def close(self):
+        self.outfile.flush()
+
+
+class ParallelGzipWriter:
+    """Compress the written data into a multi-member gzip file.
+    Fixed-size blocks are compressed as independent gzip members in
+    worker threads, and written to the file in order. The 'zlib' module
+    releases the GIL while compressing, so the threads run in parallel.
+    Any gzip reader decompresses the members as one stream.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, outfile, threads, compresslevel=6):
+        self.outfile = outfile
+        self.compresslevel = compresslevel
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            self.submit(bytes(self.buffer[: self.BLOCK_SIZE]))
+            del self.buffer[: self.BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block):
+        "Compress the block in a worker thread; bound the number pending."
+        self.pending.append(
+            self.executor.submit(gzip.compress, block, self.compresslevel)
+        )
+        while len(self.pending) > self.max_pending:
+            self.outfile.write(self.pending.popleft().result())
+
+    def close(self):
+        "Compress any remaining data, and write out all pending members."
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.outfile.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.outfile.flush()
 
 
 @cli.command()
 @click.argument("input_tarfile", type=click.File("rb"))
-def undump(input_tarfile):
-    "Load a '.tar.gz' dump file; database and all files."
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted undump; skip files already verified.",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of file writer threads.",
+)
+def undump(input_tarfile, resume, threads):
+    """Load a '.tar.gz' dump file; database and all files.
+    Each file is verified against the sha256 digest in the dumped database.
+    A '.tar.zst' file requires the 'zstandard' package.
+    With '--resume', the database already restored is kept. Hence, to
+    restore an incremental dump and its base, undump the incremental
+    dump first, and then the base dump with '--resume'.
+    """
     with blobserver.main.app.app_context():
         # This unfortunately creates an empty master Sqlite3 file.
         flask.g.db = utils.get_db()
-        if blobserver.user.get_users():
+        if blobserver.user.get_users() and not resume:
             raise click.ClickException("Cannot undump to a non-empty database.")
-        with tarfile.open(fileobj=input_tarfile) as infile:
-            # Check that the master Sqlite3 file exists.
-            for item in infile:
-                if item.name == flask.current_app.config["SQLITE3_FILENAME"]:
-                    # Remove the just-created master Sqlite3 file.
-                    flask.g.db.close()
-                    os.remove(flask.current_app.config["SQLITE3_FILEPATH"])
-                    break
-            else:
-                raise click.ClickException("No Sqlite3 master file in the dump file.")
-            nitems = 0
+        if input_tarfile.name.endswith(".gz"):
+            # The 'tarfile' stream mode cannot read multi-member gzip files.
+            input_tarfile = gzip.GzipFile(fileobj=input_tarfile, mode="rb")
+        elif input_tarfile.name.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError:
+                raise click.ClickException("The 'zstandard' package is not installed.")
+            input_tarfile = zstandard.ZstdDecompressor().stream_reader(input_tarfile)
+        dirpath = flask.current_app.config["STORAGE_DIRPATH"]
+        writer = UndumpWriter(dirpath, threads, resume)
+        started = time.time()
+        with tarfile.open(fileobj=input_tarfile, mode="r|*") as infile:
             for item in infile:
+                if not item.isfile():
+                    continue
                 itemfile = infile.extractfile(item)
-                itemdata = itemfile.read()
-                itemfile.close()
-                filepath = os.path.join(
-                    flask.current_app.config["STORAGE_DIRPATH"], item.name
+                if item.name == constants.SQLITE3_FILENAME:
+                    if resume and blobserver.user.get_users():
+                        # Already restored by the interrupted undump.
+                        pass
+                    else:
+                        # Replace the just-created master Sqlite3 file.
+                        flask.g.db.close()
+                        with open(
+                            flask.current_app.config["SQLITE3_FILEPATH"], "wb"
+                        ) as outfile:
+                            shutil.copyfileobj(itemfile, outfile, CHUNK_SIZE)
+                        flask.g.db = utils.get_db()
+                    rows = flask.g.db.execute(
+                        "SELECT iuid, filename, sha256 FROM blobs"
+                    )
+                    writer.set_blobs({row["filename"]: row for row in rows})
+                    writer.verify_inline(flask.g.db)
+                elif (
+                    item.name.startswith("_")
+                    or os.path.basename(item.name) != item.name
+                ):
+                    continue  # Not a blob file; e.g. the manifest.
+                else:
+                    writer.write(item.name, itemfile)
+        writer.close()
+        cache.invalidate("blobs")
+        cache.invalidate("users")
+        if writer.blobs is None:
+            raise click.ClickException("No Sqlite3 master file in the dump file.")
+        elapsed = time.time() - started
+        click.echo(
+            f"{writer.count} files, {writer.size} bytes in {elapsed:.1f} s"
+            f" ({writer.size / (elapsed or 1) / 1e6:.1f} MB/s);"
+            f" {writer.skipped} already present."
+        )
+        for filename in writer.unverified:
+            click.echo(f"Not verified; no digest for {filename}")
+        if writer.corrupt:
+            for filename in writer.corrupt:
+                click.echo(f"Corrupt; digest mismatch for {filename}")
+            raise click.ClickException(f"{len(writer.corrupt)} corrupt files.")
+
+
+class UndumpWriter:
+    """Write files from the dump in parallel worker threads, computing the
+    sha256 digest on the way and checking it against the database.
+    Each file is written under a temporary name, and renamed only if it
+    is correct, so that an interrupted undump can be resumed. The data
+    in memory is bounded by the number of files in progress, each of
+    which is bounded by the size of its queue of chunks.
+    """
+
+    QUEUE_CHUNKS = 8
+
+    def __init__(self, dirpath, threads, resume):
+        self.dirpath = dirpath
+        self.resume = resume
+        self.blobs = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.in_progress = threading.BoundedSemaphore(2 * threads)
+        self.futures = []
+        self.lock = threading.Lock()
+        self.count = 0
+        self.size = 0
+        self.skipped = 0
+        self.corrupt = []
+        self.unverified = []
+        # Files written before the database was read; verified at the end.
+        self.deferred = []
+
+    def set_blobs(self, blobs):
+        "Set the lookup of filename to blob data from the database."
+        self.blobs = blobs
+
+    def verify_inline(self, db):
+        "Verify the content stored inline in the database."
+        try:
+            rows = list(
+                db.execute(
+                    "SELECT filename, sha256, content FROM blobs"
+                    " JOIN blobs_inline ON blobs.iuid=blobs_inline.iuid"
                 )
-                with open(filepath, "wb") as outfile:
-                    outfile.write(itemdata)
-                nitems += 1
-        click.echo(f"{nitems} files in dump file.")
+            )
+        except sqlite3.OperationalError:
+            return  # Dumped before content was stored inline.
+        for row in rows:
+            if hashlib.sha256(row["content"]).hexdigest() != row["sha256"]:
+                self.corrupt.append(row["filename"])
+
+    def write(self, filename, itemfile):
+        "Read the file from the dump and pass it in chunks to a worker thread."
+        if self.blobs and filename in self.blobs:
+            filepath = storage.get_filepath(self.blobs[filename])
+            if not os.path.exists(filepath):
+                filepath = storage.get_new_filepath(self.blobs[filename])
+        else:
+            # Before the database has been read, the layout cannot be used.
+            filepath = os.path.join(self.dirpath, filename)
+        expected = self.get_digest(filename)
+        if self.resume and expected and os.path.exists(filepath):
+            if get_sha256(filepath) == expected:
+                self.skipped += 1
+                return
+        self.in_progress.acquire()
+        chunks = queue.Queue(maxsize=self.QUEUE_CHUNKS)
+        self.futures.append(
+            self.executor.submit(self.worker, filename, filepath, chunks, expected)
+        )
+        try:
+            while True:
+                chunk = itemfile.read(CHUNK_SIZE)
+                chunks.put(chunk)
+                if not chunk:
+                    break
+        except Exception:
+            chunks.put(None)  # Tell the worker to abort.
+            raise
+
+    def get_digest(self, filename):
+        "Return the expected digest, or None if not known."
+        try:
+            return self.blobs[filename]["sha256"] or None
+        except (TypeError, KeyError):
+            return None
+
+    def worker(self, filename, filepath, chunks, expected):
+        """Write the chunks to the file, check the digest and rename if correct.
+        An empty chunk marks the end of the file, None that reading failed.
+        """
+        tmppath = os.path.join(self.dirpath, f"_undump_{filename}")
+        finished = False
+        try:
+            hash = hashlib.sha256()
+            size = 0
+            with open(tmppath, "wb") as outfile:
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        finished = True
+                        raise ValueError(f"Could not read {filename} from dump.")
+                    if not chunk:
+                        finished = True
+                        break
+                    hash.update(chunk)
+                    outfile.write(chunk)
+                    size += len(chunk)
+            with self.lock:
+                self.count += 1
+                self.size += size
+                if self.blobs is None:
+                    self.deferred.append(filename)
+                elif not expected:
+                    self.unverified.append(filename)
+                elif hash.hexdigest() != expected:
+                    self.corrupt.append(filename)
+                    os.remove(tmppath)
+                    return
+            os.replace(tmppath, filepath)
+        except Exception:
+            # Consume the rest of the file, so that the reader is not blocked.
+            while not finished:
+                finished = chunks.get() in (b"", None)
+            try:
+                os.remove(tmppath)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            self.in_progress.release()
+
+    def close(self):
+        "Wait for all workers, then verify any files written before the database."
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        if self.blobs is None:
+            return
+        for filename in self.deferred:
+            expected = self.get_digest(filename)
+            if not expected:
+                self.unverified.append(filename)
+            elif get_sha256(os.path.join(self.dirpath, filename)) != expected:
+                self.corrupt.append(filename)
+
+
+def get_sha256(filepath):
+    "Return the sha256 digest of the file, read in chunks."
+    hash = hashlib.sha256()
+    with open(filepath, "rb") as infile:
+        while True:
+            chunk = infile.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+@cli.command()
+@click.option(
+    "--days",
+    type=int,
+    help="Verify only blobs not verified OK within this number of days."
+    " Also resumes an interrupted run.",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of hashing processes.",
+)
+@click.option(
+    "--max-rate",
+    type=float,
+    help="Maximum total read rate in MB/s, to spare production I/O.",
+)
+@click.option(
+    "--report",
+    type=click.File("w"),
+    default="-",
+    help="File for the JSON report; default standard output.",
+)
+def verify(days, processes, max_rate, report):
+    """Verify the blob files against the digests in the database.
+    Content stored inline in the database is also verified.
+    Report corrupt and missing files, and orphan files not in the database.
+    """
+    with blobserver.main.app.app_context():
+        db = flask.g.db = utils.get_db()
+        dirpath = flask.current_app.config["STORAGE_DIRPATH"]
+        sql = (
+            "SELECT blobs.iuid, filename, md5, sha256, sha512, verified,"
+            " blobs.iuid IN (SELECT iuid FROM blobs_inline) AS inline,"
+            " encoding, offsets FROM blobs"
+            " LEFT JOIN verifications ON blobs.iuid=verifications.iuid"
+            " LEFT JOIN blobs_compressed ON blobs.iuid=blobs_compressed.iuid"
+        )
+        if days is None:
+            rows = list(db.execute(sql))
+        else:
+            rows = list(
+                db.execute(
+                    sql + " WHERE verified IS NULL OR verified<? OR status!='ok'",
+                    (utils.get_time(-days * 86400),),
+                )
+            )
+        result = dict(ok=0, corrupt=[], missing=[], pending=[], orphans=[])
+        # Orphans are checked against all blobs, not just those to verify.
+        filepaths = {
+            storage.get_filepath(row)
+            for row in db.execute(
+                "SELECT iuid, filename FROM blobs"
+                " WHERE iuid NOT IN (SELECT iuid FROM blobs_inline)"
+            )
+        }
+        for filepath in storage.get_filepaths():
+            if filepath not in filepaths:
+                result["orphans"].append(os.path.relpath(filepath, dirpath))
+        rate = max_rate * 1e6 / processes if max_rate else None
+        started = time.time()
+        size = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {
+                pool.submit(
+                    get_file_digests,
+                    storage.get_filepath(row),
+                    rate,
+                    (
+                        (row["encoding"], json.loads(row["offsets"]))
+                        if row["encoding"]
+                        else None
+                    ),
+                ): row
+                for row in rows
+                if not row["inline"]
+            }
+            # Inline content is small; verified right here.
+            results = itertools.chain(
+                ((row, get_inline_digests(row)) for row in rows if row["inline"]),
+                (
+                    (futures[future], future.result())
+                    for future in concurrent.futures.as_completed(futures)
+                ),
+            )
+            with click.progressbar(length=len(rows), file=sys.stderr) as bar:
+                for row, digests in results:
+                    if digests is None:
+                        status = "missing"
+                    elif not row["sha256"]:
+                        status = "pending"
+                    else:
+                        size += digests.pop("size")
+                        if digests == {n: row[n] for n in blobserver.blob.DIGEST_NAMES}:
+                            status = "ok"
+                        else:
+                            status = "corrupt"
+                    if status == "ok":
+                        result["ok"] += 1
+                    else:
+                        result[status].append(row["filename"])
+                    # Commit at once; the write lock must not be held while
+                    # hashing, since that would block uploads. This also
+                    # allows resuming with '--days'.
+                    with db:
+                        db.execute(
+                            "INSERT OR REPLACE INTO verifications"
+                            " (iuid, status, verified) VALUES (?, ?, ?)",
+                            (row["iuid"], status, utils.get_time()),
+                        )
+                    bar.update(1)
+        elapsed = time.time() - started
+        result["elapsed"] = round(elapsed, 1)
+        result["bytes"] = size
+        result["rate"] = round(size / (elapsed or 1) / 1e6, 1)
+        json.dump(result, report, indent=2)
+        report.write("\n")
+        if result["corrupt"] or result["missing"]:
+            raise click.ClickException(
+                f"{len(result['corrupt'])} corrupt and"
+                f" {len(result['missing'])} missing files."
+            )
+
+
+@cli.command("import")
+@click.argument("dirpath", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option("--username", required=True, help="Owner of the imported blobs.")
+@click.option(
+    "--mode",
+    type=click.Choice(["copy", "link", "move"]),
+    default="copy",
+    show_default=True,
+    help="How to put the files into storage; 'link' makes hard links.",
+)
+@click.option("--dry-run", is_flag=True, help="Only report what would be imported.")
+@click.option(
+    "--processes",
+    type=int,
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of hashing processes.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    show_default=True,
+    help="Number of blobs inserted per database transaction.",
+)
+def import_files(dirpath, username, mode, dry_run, processes, batch_size):
+    """Import the files in the directory as blobs.
+    Files smaller than STORAGE_INLINE_LIMIT are stored in the database.
+    Files whose names conflict with existing blobs or files are skipped.
+    The quota of the owner is not checked.
+    """
+    with blobserver.main.app.app_context():
+        flask.g.db = utils.get_db()
+        user = blobserver.user.get_user(username=username)
+        if user is None:
+            raise click.ClickException("No such user.")
+        storagepath = flask.current_app.config["STORAGE_DIRPATH"]
+        existing = {
+            row[0].lower() for row in flask.g.db.execute("SELECT filename FROM blobs")
+        }
+        filenames = []
+        for entry in os.scandir(dirpath):
+            if not entry.is_file():
+                continue
+            try:
+                blobserver.blob.check_filename(entry.name)
+            except ValueError as error:
+                click.echo(f"Invalid: {entry.name}: {error}", err=True)
+                continue
+            if entry.name.lower() in existing or os.path.exists(
+                os.path.join(storagepath, entry.name)
+            ):
+                click.echo(f"Conflict: {entry.name}", err=True)
+                continue
+            existing.add(entry.name.lower())
+            filenames.append(entry.name)
+        if dry_run:
+            click.echo(f"Would import {len(filenames)} files.")
+            return
+        started = time.time()
+        count = 0
+        size = 0
+        blobs = []
+        logs = []
+        inlines = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = pool.map(
+                get_file_digests,
+                [os.path.join(dirpath, f) for f in filenames],
+                chunksize=16,
+            )
+            with click.progressbar(
+                zip(filenames, results), length=len(filenames), file=sys.stderr
+            ) as bar:
+                for filename, digests in bar:
+                    if digests is None:
+                        click.echo(f"Disappeared: {filename}", err=True)
+                        continue
+                    now = utils.get_time()
+                    doc = dict(
+                        iuid=utils.get_iuid(),
+                        filename=filename,
+                        username=user["username"],
+                        created=now,
+                    )
+                    doc.update(digests)
+                    filepath = os.path.join(dirpath, filename)
+                    if storage.is_inline_size(doc["size"]):
+                        with open(filepath, "rb") as infile:
+                            inlines.append((doc["iuid"], infile.read(), filepath))
+                    else:
+                        storagefilepath = storage.get_new_filepath(doc)
+                        if mode == "copy":
+                            blobserver.blob.copy_file(filepath, storagefilepath)
+                        elif mode == "link":
+                            os.link(filepath, storagefilepath)
+                        else:
+                            shutil.move(filepath, storagefilepath)
+                    blobs.append(doc)
+                    logs.append(
+                        dict(
+                            iuid=doc["iuid"],
+                            diff=json.dumps(dict(added=doc)),
+                            user_agent=os.path.basename(sys.argv[0]),
+                            timestamp=now,
+                        )
+                    )
+                    count += 1
+                    size += doc["size"]
+                    if len(blobs) >= batch_size:
+                        insert_blobs(blobs, logs, inlines, mode == "move")
+                        blobs = []
+                        logs = []
+                        inlines = []
+        insert_blobs(blobs, logs, inlines, mode == "move")
+        elapsed = time.time() - started
+        click.echo(
+            f"Imported {count} files, {size} bytes in {elapsed:.1f} s"
+            f" ({count / (elapsed or 1):.1f} files/s,"
+            f" {size / (elapsed or 1) / 1e6:.1f} MB/s)"
+        )
+
+
+def insert_blobs(blobs, logs, inlines, remove):
+    """Insert the blobs, their log entries and their content to be stored
+    inline in one transaction. Remove the files of the inline content
+    afterwards, if so specified.
+    """
+    keys = ["iuid", "filename", "username", "md5", "sha256", "sha512", "size"]
+    with flask.g.db:
+        flask.g.db.executemany(
+            f"INSERT INTO blobs ({','.join(keys)}, created, modified)"
+            f" VALUES ({','.join('?' * len(keys))}, ?, ?)",
+            [[b[k] for k in keys] + [b["created"], b["created"]] for b in blobs],
+        )
+        flask.g.db.executemany(
+            "INSERT INTO logs (iuid, diff, user_agent, timestamp) VALUES (?, ?, ?, ?)",
+            [[e["iuid"], e["diff"], e["user_agent"], e["timestamp"]] for e in logs],
+        )
+        flask.g.db.executemany(
+            "INSERT INTO blobs_inline (iuid, content) VALUES (?, ?)",
+            [i[:2] for i in inlines],
+        )
+    cache.invalidate("blobs")
+    if remove:
+        for iuid, content, filepath in inlines:
+            os.remove(filepath)
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    show_default=True,
+    help="Number of files moved between pauses.",
+)
+@click.option(
+    "--pause",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Seconds to pause between batches, to spare the running server.",
+)
+def migrate(batch_size, pause):
+    """Move the blob files to the layout given by STORAGE_SHARDED.
+    May be run while the server is serving requests.
+    """
+    with blobserver.main.app.app_context():
+        flask.g.db = utils.get_db()
+        sharded = flask.current_app.config["STORAGE_SHARDED"]
+        rows = list(
+            flask.g.db.execute(
+                "SELECT iuid, filename FROM blobs"
+                " WHERE iuid NOT IN (SELECT iuid FROM blobs_inline)"
+            )
+        )
+        count = 0
+        with click.progressbar(rows, file=sys.stderr) as bar:
+            for row in bar:
+                try:
+                    moved = storage.move_file(row, sharded)
+                except FileNotFoundError:
+                    continue  # Blob deleted meanwhile.
+                if moved:
+                    count += 1
+                    if count % batch_size == 0:
+                        time.sleep(pause)
+        if not sharded:
+            # Remove the now empty shard directories.
+            shardspath = os.path.join(
+                flask.current_app.config["STORAGE_DIRPATH"], storage.SHARDS_DIRNAME
+            )
+            for dirpath, dirnames, filenames in os.walk(shardspath, topdown=False):
+                if not filenames and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+        click.echo(f"Moved {count} files.")
+
+
+def get_file_digests(filepath, rate=None, compressed=None):
+    """Return the size and digests of the file, read in chunks.
+    Throttle reading to the given rate in bytes per second, if any.
+    Decompress it if the encoding and seek index are given.
+    Return None if the file does not exist.
+    """
+    hashes = {n: hashlib.new(n) for n in blobserver.blob.DIGEST_NAMES}
+    size = 0
+    started = time.monotonic()
+    try:
+        infile = open(filepath, "rb")
+        if compressed:
+            infile = compression.Reader(infile, *compressed)
+        with infile:
+            while True:
+                chunk = infile.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                for hash in hashes.values():
+                    hash.update(chunk)
+                size += len(chunk)
+                if rate:
+                    delay = size / rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+    except FileNotFoundError:
+        return None
+    result = {n: h.hexdigest() for n, h in hashes.items()}
+    result["size"] = size
+    return result
+
+
+def get_inline_digests(data):
+    """Return the size and digests of the content of the blob stored inline
+    in the database. Return None if there is none.
+    """
+    content = storage.get_inline(data)
+    if content is None:
+        return None
+    result = {
+        n: hashlib.new(n, content).hexdigest() for n in blobserver.blob.DIGEST_NAMES
+    }
+    result["size"] = len(content)
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+"""Compression of blob files, at rest and for downloads.
+
+A compressed blob file consists of independently compressed blocks of
+BLOCK_SIZE bytes of the original content; gzip members or zstd frames.
+The concatenation is itself a valid gzip or zstd stream, so the file can
+be sent as is to a client accepting that encoding. The offsets of the
+blocks in the file are recorded in the database as a seek index, so that
+a byte range of the original content can be read by decompressing only
+the blocks containing it.
+
+Downloads of uncompressed text-like blob files may be compressed for
+clients accepting an encoding; either on the fly, or from a variant file
+compressed in advance for frequently downloaded blobs.
+"""
+
+import zlib
+
+import flask
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 1024 * 1024
+MIN_SIZE = 1024  # Smaller content is not worth compressing for download.
+ENCODINGS = ["gzip", "zstd"]
+
+# Compression levels; fast on the fly, strong for variants made in advance.
+STREAM_LEVELS = {"gzip": 1, "zstd": 1}
+VARIANT_LEVELS = {"gzip": 9, "zstd": 12}
+
+# Content types worth compressing; given as start or end of the type.
+COMPRESSIBLE_TYPES = [
+    "text/",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-sh",
+    "image/svg+xml",
+    "+json",
+    "+xml",
+]
+
+
+def compress(data, encoding):
+    "Return the data compressed as one gzip member or zstd frame."
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression encoding '{encoding}'.")
+
+
+def decompress(data, encoding):
+    "Return the data decompressed from one gzip member or zstd frame."
+    if encoding == "gzip":
+        return zlib.decompress(data, 31)
+    elif encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression encoding '{encoding}'.")
+
+
+def get_encodings():
+    "Return the encodings available for compression, in order of preference."
+    if zstandard:
+        return ["zstd", "gzip"]
+    else:
+        return ["gzip"]
+
+
+def is_compressible_type(mimetype):
+    "Is the content type one that usually compresses well?"
+    if not mimetype:
+        return False
+    for type in COMPRESSIBLE_TYPES:
+        if mimetype.startswith(type) or mimetype.endswith(type):
+            return True
+    return False
+
+
+def get_compressor(encoding, level):
+    "Return a streaming compressor object with methods 'compress' and 'flush'."
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"Unknown compression encoding '{encoding}'.")
+
+
+class Writer:
+    """File-like object writing content to the given file, compressed in
+    blocks with the configured encoding. Whether to compress is decided
+    by a probe on the first block; content that does not compress well
+    enough is written as is.
+    """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.encoding = flask.current_app.config["STORAGE_COMPRESSION"] or None
+        self.percent = flask.current_app.config["STORAGE_COMPRESSION_PERCENT"]
+        self.probed = False
+        self.buffer = bytearray()
+        self.position = 0
+        self.offsets = []
+
+    def write(self, data):
+        "Write the data; compress and write each block as it fills up."
+        if self.probed and not self.encoding:
+            self.outfile.write(data)
+            return
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.write_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+            if not self.encoding:  # Rejected by the probe; write the rest as is.
+                self.outfile.write(self.buffer)
+                self.buffer = bytearray()
+
+    def write_block(self, block):
+        "Compress and write the block, unless compression has been rejected."
+        if not self.encoding:
+            self.outfile.write(block)
+            return
+        compressed = compress(block, self.encoding)
+        if not self.probed:
+            self.probed = True
+            if len(compressed) * 100 > len(block) * self.percent:
+                self.encoding = None
+                self.outfile.write(block)
+                return
+        self.offsets.append(self.position)
+        self.outfile.write(compressed)
+        self.position += len(compressed)
+
+    def close(self):
+        """Write the last block. Return the encoding and the seek index
+        if the content was compressed, otherwise None.
+        The file itself is not closed.
+        """
+        if self.buffer or not self.probed:
+            self.write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        if self.encoding:
+            return (self.encoding, self.offsets)
+        else:
+            return None
+
+
+class Reader:
+    """Read-only file-like object for the original content of a file
+    compressed in blocks. Seeking is cheap; only the block containing
+    the position is decompressed when reading.
+    """
+
+    def __init__(self, infile, encoding, offsets):
+        self.infile = infile
+        self.encoding = encoding
+        self.offsets = offsets
+        self.position = 0
+        self.number = None  # Number of the currently decompressed block.
+        self.block = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        "Set the position in the original content; from the end is not allowed."
+        if whence == 1:
+            position += self.position
+        elif whence != 0:
+            raise ValueError("Seek from the end is not supported.")
+        self.position = position
+        return position
+
+    def read(self, size=-1):
+        "Read at most the given number of bytes; all remaining if negative."
+        result = []
+        while size != 0:
+            number, skip = divmod(self.position, BLOCK_SIZE)
+            if number != self.number:
+                if number >= len(self.offsets):
+                    break
+                self.load(number)
+            if size < 0:
+                chunk = self.block[skip:]
+            else:
+                chunk = self.block[skip : skip + size]
+                size -= len(chunk)
+            if not chunk:
+                break
+            result.append(chunk)
+            self.position += len(chunk)
+        return b"".join(result)
+
+    def load(self, number):
+        "Decompress the block with the given number."
+        self.infile.seek(self.offsets[number])
+        if number + 1 < len(self.offsets):
+            data = self.infile.read(self.offsets[number + 1] - self.offsets[number])
+        else:
+            data = self.infile.read()
+        self.block = decompress(data, self.encoding)
+        self.number = number
+
+    def close(self):
+        self.infile.close()
+
+
+class EncodingReader:
+    """Read-only file-like object compressing the content of the given file
+    on the fly as a single stream, for sending with a Content-Encoding.
+    The function 'on_close', if given, is called when closed.
+    """
+
+    def __init__(self, infile, encoding, level, on_close=None):
+        self.infile = infile
+        self.on_close = on_close
+        self.compressor = get_compressor(encoding, level)
+        self.buffer = b""
+        self.offset = 0  # Position of the unread part of the buffer.
+        self.finished = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        "Read at most the given number of compressed bytes; all if negative."
+        while not self.finished and (size < 0 or len(self.buffer) - self.offset < size):
+            chunk = self.infile.read(BLOCK_SIZE)
+            if chunk:
+                compressed = self.compressor.compress(chunk)
+            else:
+                compressed = self.compressor.flush()
+                self.finished = True
+            self.buffer = self.buffer[self.offset :] + compressed
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        result = self.buffer[self.offset : self.offset + size]
+        self.offset += len(result)
+        return result
+
+    def close(self):
+        if not self.infile.closed:
+            self.infile.close()
+            if self.on_close:
+                self.on_close()
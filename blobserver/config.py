@@ -4,6 +4,7 @@ import json
 import os
 import os.path
 
+from blobserver import compression
 from blobserver import constants
 from blobserver import utils
 
@@ -20,6 +21,8 @@ DEFAULT_SETTINGS = dict(
     LOG_FILEPATH=None,
     LOG_ROTATING=0,  # Number of backup rotated log files, if any.
     LOG_FORMAT="%(levelname)-10s %(asctime)s %(message)s",
+    ACCESS_LOG_FILEPATH=None,  # JSON lines access log, if set.
+    ACCESS_LOG_SAMPLE_RATE=1.0,  # Fraction of successful GETs to log.
     HOST_LOGO=None,  # Name of file in '../site' directory
     HOST_NAME=None,
     HOST_URL=None,
@@ -27,6 +30,32 @@ DEFAULT_SETTINGS = dict(
     SECRET_KEY=None,  # Must be set in 'settings.json'
     SALT_LENGTH=12,
     STORAGE_DIRPATH=None,  # Must be set in 'settings.json'
+    STORAGE_SHARDED=False,  # Blob files in subdirectories keyed by IUID hash.
+    STORAGE_INLINE_LIMIT=0,  # Content smaller than this is kept in the database.
+    STORAGE_COMPRESSION=None,  # 'gzip', or 'zstd' requiring package 'zstandard'.
+    STORAGE_COMPRESSION_PERCENT=80,  # Compress if the probe shrinks to this.
+    DOWNLOAD_COMPRESSION=False,  # Compress text-like downloads if accepted.
+    DOWNLOAD_COMPRESSION_STREAMS=4,  # Max on-the-fly compressions per process.
+    DOWNLOAD_PRECOMPRESS_HITS=10,  # Downloads before making a compressed variant.
+    DOWNLOAD_DROP_CACHE_SIZE=0,  # Drop files this large from the page cache.
+    BLOB_CACHE_SIZE=0,  # Bytes per process for content of hot blobs; 0 disables.
+    BLOB_CACHE_ITEM_SIZE=1024 * 1024,  # Content larger than this is not cached.
+    BLOB_DATA_CACHE_ENTRIES=0,  # Blob data entries per process; 0 disables.
+    SHARED_CACHE_SIZE=0,  # Bytes in the cache shared by processes; 0 disables.
+    SHARED_CACHE_TTL=3600,  # Default time-to-live, in seconds.
+    PAGE_CACHE=False,  # Cache pages for anonymous users of some endpoints.
+    PAGE_CACHE_MAX_AGE=0,  # Seconds browsers may use a page without asking.
+    METRICS=False,  # Collect metrics, and serve them at '/metrics'.
+    SQL_TRACE=False,  # Record the Sqlite3 statements of each request.
+    SQL_TRACE_SLOW_MS=0,  # Log statements slower than this; 0 disables.
+    SQL_TRACE_REPEATED=10,  # Log statements repeated this often as N+1 in debug.
+    TRACING=False,  # Trace requests; see 'tracing.py'.
+    TRACE_SAMPLE_RATE=0.01,  # Fraction of requests to record traces for.
+    TRACE_SLOW_MS=1000,  # Always record requests slower than this; 0 disables.
+    TRACE_FILEPATH=None,  # Default '_traces.json' in the storage directory.
+    TRACE_FILE_SIZE=100 * 1024 * 1024,  # Rotate the trace file at this size.
+    ASGI_THREADS=16,  # Threads for the Flask app when served by 'asgi.py'.
+    ASGI_READ_AHEAD=64 * 1024,  # Request body bytes kept in memory by the ASGI app.
     MOST_RECENT=40,
     MIN_PASSWORD_LENGTH=6,
     PERMANENT_SESSION_LIFETIME=7 * 24 * 60 * 60,  # seconds; 1 week
@@ -66,13 +95,20 @@ def init(app):
                 value = utils.to_bool(value)
             elif isinstance(default, int):
                 value = int(value)
+            elif isinstance(default, float):
+                value = float(value)
         except (KeyError, TypeError, ValueError):
             pass
         else:
             app.config[key] = value
 
     # Clean up filepaths.
-    for key in ["LOG_FILEPATH", "STORAGE_DIRPATH"]:
+    for key in [
+        "LOG_FILEPATH",
+        "ACCESS_LOG_FILEPATH",
+        "STORAGE_DIRPATH",
+        "TRACE_FILEPATH",
+    ]:
         path = app.config[key]
         if not path:
             continue
@@ -95,6 +131,11 @@ def init(app):
         raise ValueError("MIN_PASSWORD_LENGTH must be more than 4 characters")
     if not app.config["STORAGE_DIRPATH"]:
         raise ValueError("STORAGE_DIRPATH has not been set")
+    if app.config["STORAGE_COMPRESSION"]:
+        if app.config["STORAGE_COMPRESSION"] not in compression.ENCODINGS:
+            raise ValueError("STORAGE_COMPRESSION must be 'gzip' or 'zstd'")
+        if app.config["STORAGE_COMPRESSION"] == "zstd" and not compression.zstandard:
+            raise ValueError("STORAGE_COMPRESSION 'zstd' requires 'zstandard'")
 
     # Record dirpaths for access in app.
     app.config["ROOT"] = constants.ROOT
@@ -1,5 +1,10 @@
 "blobserver: Web app to upload and serve blobs (files)."
 
+import http.client
+import os
+import time
+import tracemalloc
+
 import flask
 import flask_cors
 import markupsafe
@@ -11,7 +16,11 @@ import blobserver.user
 import blobserver.site
 import blobserver.blob
 import blobserver.blobs
+from blobserver import cache
 from blobserver import constants
+from blobserver import metrics
+from blobserver import profiler
+from blobserver import tracing
 from blobserver import utils
 
 app = flask.Flask(__name__)
@@ -27,6 +36,8 @@ blobserver.config.init(app)
 utils.init(app)
 blobserver.user.init(app)
 blobserver.blob.init(app)
+metrics.init(app)  # Before 'prepare', to measure all of the request.
+tracing.init(app)
 
 if app.config["REVERSE_PROXY"]:
     app.wsgi_app = ProxyFix(app.wsgi_app)
@@ -45,8 +56,9 @@ def setup_template_context():
 @app.before_request
 def prepare():
     "Open the database connection; get the current user."
+    flask.g.started = time.perf_counter()
     flask.g.db = utils.get_db()
-    user = blobserver.user.get_user(
+    user = blobserver.user.get_cached_user(
         username=flask.session.get("username"),
         accesskey=flask.request.headers.get("x-accesskey"),
     )
@@ -64,9 +76,11 @@ def prepare():
 
 
 app.after_request(utils.log_access)
+app.after_request(utils.report_queries)
 
 
 @app.route("/")
+@utils.page_cached
 def home():
     "Home page."
     blobs = blobserver.blob.get_most_recent_blobs()
@@ -88,12 +102,136 @@ def debug():
     for key, value in sorted(flask.request.environ.items()):
         result.append(f"<tr><td>{key}</td><td>{value}</td></tr>")
     result.append("</table>")
+    result.append(f"<h2>caches in process {os.getpid()}</h2>")
+    result.append("<table>")
+    for name, stats in sorted(cache.get_stats().items()):
+        stats = ", ".join([f"{k}={v}" for k, v in stats.items()])
+        result.append(f"<tr><td>{name}</td><td>{stats}</td></tr>")
+    result.append("</table>")
+    if flask.current_app.config["SQL_TRACE"]:
+        result.append(f"<h2>queries of recent requests in process {os.getpid()}</h2>")
+        result.append("<table>")
+        for summary in reversed(utils.get_recent_queries()):
+            result.append(
+                f"<tr><th>{markupsafe.escape(summary['request'])}</th>"
+                f"<th>{summary['count']} statements,"
+                f" {1000 * summary['time']:.1f} ms</th></tr>"
+            )
+            for sql, elapsed, steps in summary["slowest"]:
+                result.append(
+                    f"<tr><td>{1000 * elapsed:.1f} ms, {steps} steps</td>"
+                    f"<td>{markupsafe.escape(sql)}</td></tr>"
+                )
+            for shape, count in summary["repeated"].items():
+                result.append(
+                    f"<tr><td>repeated {count} times</td>"
+                    f"<td>{markupsafe.escape(shape)}</td></tr>"
+                )
+        result.append("</table>")
+    result.append(f"<h2>profiling in process {os.getpid()}</h2>")
+    result.append("<table>")
+    profile = profiler.get_profiler()
+    if profile:
+        status = ", ".join([f"{k}={v}" for k, v in profile.get_status().items()])
+    else:
+        status = "not started"
+    result.append(f"<tr><td>CPU profiler</td><td>{status}</td></tr>")
+    if tracemalloc.is_tracing():
+        status = f"tracing, {tracemalloc.get_tracemalloc_memory()} bytes overhead"
+    else:
+        status = "not tracing"
+    result.append(f"<tr><td>memory allocations</td><td>{status}</td></tr>")
+    result.append("</table>")
     return markupsafe.Markup("\n".join(result))
 
 
+@app.route("/debug/profile", methods=["GET", "PUT", "DELETE"])
+@utils.admin_required
+def debug_profile():
+    """Admin API: Start the sampling CPU profiler in this server process
+    (PUT), with the number of 'seconds' and the 'interval' in milliseconds
+    as optional query parameters. Stop it (DELETE). Get its samples so far
+    as collapsed stacks, for flamegraph tools (GET).
+    """
+    if utils.http_GET():
+        profile = profiler.get_profiler()
+        if profile is None:
+            flask.abort(http.client.NOT_FOUND)
+        response = flask.make_response(profile.get_collapsed())
+        response.content_type = "text/plain; charset=utf-8"
+        response.headers["Content-Disposition"] = (
+            f'attachment; filename="profile-{os.getpid()}.txt"'
+        )
+        return response
+
+    elif utils.http_PUT():
+        try:
+            profile = profiler.start_profiler(
+                seconds=float(
+                    flask.request.args.get("seconds", profiler.DEFAULT_SECONDS)
+                ),
+                interval=float(
+                    flask.request.args.get("interval", profiler.DEFAULT_INTERVAL)
+                ),
+            )
+        except ValueError as error:
+            flask.abort(http.client.BAD_REQUEST, description=str(error))
+        return flask.jsonify(profile.get_status())
+
+    elif utils.http_DELETE(csrf=False):
+        profile = profiler.stop_profiler()
+        if profile is None:
+            flask.abort(http.client.NOT_FOUND)
+        return flask.jsonify(profile.get_status())
+
+    flask.abort(http.client.METHOD_NOT_ALLOWED)
+
+
+@app.route("/debug/memory", methods=["GET", "PUT", "DELETE"])
+@utils.admin_required
+def debug_memory():
+    """Admin API: Start tracing memory allocations in this server process
+    (PUT), with the number of 'frames' as optional query parameter.
+    Stop it (DELETE). Take a snapshot, and get the growth since the previous
+    snapshot (GET), grouped by 'key', which is 'lineno' (default), 'filename'
+    or 'traceback'.
+    """
+    if utils.http_GET():
+        try:
+            text = profiler.get_memory_growth(
+                key=flask.request.args.get("key", "lineno"),
+                limit=int(flask.request.args.get("limit", profiler.DEFAULT_LIMIT)),
+            )
+        except ValueError as error:
+            flask.abort(http.client.BAD_REQUEST, description=str(error))
+        response = flask.make_response(text)
+        response.content_type = "text/plain; charset=utf-8"
+        return response
+
+    elif utils.http_PUT():
+        try:
+            profiler.start_tracing(
+                frames=int(flask.request.args.get("frames", profiler.DEFAULT_FRAMES))
+            )
+        except ValueError as error:
+            flask.abort(http.client.BAD_REQUEST, description=str(error))
+        return flask.jsonify(dict(pid=os.getpid(), tracing=True))
+
+    elif utils.http_DELETE(csrf=False):
+        profiler.stop_tracing()
+        return flask.jsonify(dict(pid=os.getpid(), tracing=False))
+
+    flask.abort(http.client.METHOD_NOT_ALLOWED)
+
+
 @app.route("/status")
 def status():
     "Return JSON for the current status and some counts for the database."
+    # Changes to blobs and their logs also change the version for users.
+    etag = utils.get_etag(cache.get_version("users"))
+    response = utils.check_not_modified(etag)
+    if response:
+        return response
     cursor = flask.g.db.cursor()
     rows = list(cursor.execute("SELECT COUNT(*) FROM blobs"))
     n_blobs = rows[0][0]
@@ -101,7 +239,23 @@ def status():
     n_users = rows[0][0]
     rows = list(cursor.execute("SELECT COUNT(*) FROM logs"))
     n_logs = rows[0][0]
-    return dict(status="ok", n_blobs=n_blobs, n_users=n_users, n_logs=n_logs)
+    response = flask.jsonify(
+        dict(status="ok", n_blobs=n_blobs, n_users=n_users, n_logs=n_logs)
+    )
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Return the metrics for all server processes in Prometheus text format,
+    if enabled. Access should be restricted in the reverse proxy.
+    """
+    if not flask.current_app.config["METRICS"]:
+        flask.abort(http.client.NOT_FOUND)
+    response = flask.make_response(metrics.collect())
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return response
 
 
 @app.route("/sitemap")
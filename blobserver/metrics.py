@@ -0,0 +1,302 @@
+"""Metrics of the server in the Prometheus text format.
+
+Each server process counts in memory, and writes its counts to a file
+of its own in the directory '_metrics' in the storage directory, at most
+once per FLUSH_INTERVAL seconds, when handling a request. The endpoint
+'/metrics' sums the counts in all the files, so that they are correct
+for all processes. The counts of processes that have exited are merged
+into an archive file, so that the counters never decrease. The gauges
+of processes that have exited are discarded.
+"""
+
+import atexit
+import collections
+import fcntl
+import json
+import os
+import os.path
+import re
+import threading
+import time
+
+import flask
+
+from blobserver import cache
+
+DIRNAME = "_metrics"
+ARCHIVE_FILENAME = "archive.json"
+LOCK_FILENAME = "lock"
+FLUSH_INTERVAL = 1.0  # Seconds.
+
+# Upper bounds of the buckets of histograms, in seconds.
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Type and help text for each metric.
+METRICS = {
+    "blobserver_requests_total": (
+        "counter",
+        "Number of requests handled, by endpoint, method and status.",
+    ),
+    "blobserver_request_duration_seconds": (
+        "histogram",
+        "Time to handle requests, by endpoint.",
+    ),
+    "blobserver_requests_in_flight": (
+        "gauge",
+        "Number of requests being handled.",
+    ),
+    "blobserver_upload_bytes_total": (
+        "counter",
+        "Bytes of content received in requests to blob endpoints.",
+    ),
+    "blobserver_download_bytes_total": (
+        "counter",
+        "Bytes of blob content sent, in responses of known length.",
+    ),
+    "blobserver_hash_seconds_total": (
+        "counter",
+        "Time to compute the digests of uploaded blob content.",
+    ),
+    "blobserver_hash_bytes_total": (
+        "counter",
+        "Bytes of uploaded blob content that were digested.",
+    ),
+    "blobserver_db_queries_total": (
+        "counter",
+        "Number of Sqlite3 statements executed by requests, by endpoint.",
+    ),
+    "blobserver_db_query_seconds_total": (
+        "counter",
+        "Time to execute Sqlite3 statements for requests, by endpoint.",
+    ),
+    "blobserver_cache_hits_total": ("counter", "Number of hits, by cache."),
+    "blobserver_cache_misses_total": ("counter", "Number of misses, by cache."),
+}
+SUFFIXES = ["_bucket", "_sum", "_count"]
+
+# Counts and gauges of this process, by series: the metric name and labels.
+_counters = collections.defaultdict(float)
+_gauges = collections.defaultdict(float)
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flushed = 0.0
+_started = time.time()
+_dirpath = None
+
+
+def init(app):
+    """Collect metrics for the requests of the app, if enabled.
+    The counts of the process are also written when it exits.
+    """
+    global _dirpath
+    if not app.config["METRICS"]:
+        return
+    _dirpath = os.path.join(app.config["STORAGE_DIRPATH"], DIRNAME)
+    os.makedirs(_dirpath, exist_ok=True)
+    atexit.register(flush)
+    app.before_request(start_request)
+    app.after_request(end_request)
+    app.teardown_request(teardown_request)
+
+
+def get_series(name, **labels):
+    "Return the series for the metric name and the labels, as in the output."
+    if not labels:
+        return name
+    labels = ",".join([f'{k}="{escape(v)}"' for k, v in sorted(labels.items())])
+    return f"{name}{{{labels}}}"
+
+
+def escape(value):
+    "Return the value as a string escaped for use as a label value."
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+def add(name, value=1, **labels):
+    "Add to the counter for the metric name and labels, if enabled."
+    if not flask.current_app.config["METRICS"]:
+        return
+    series = get_series(name, **labels)
+    with _lock:
+        _counters[series] += value
+
+
+def observe(name, value, **labels):
+    "Record the value in the histogram for the metric name and labels."
+    with _lock:
+        for bound in BUCKETS:
+            if value <= bound:
+                _counters[get_series(f"{name}_bucket", le=bound, **labels)] += 1
+        _counters[get_series(f"{name}_bucket", le="+Inf", **labels)] += 1
+        _counters[get_series(f"{name}_sum", **labels)] += value
+        _counters[get_series(f"{name}_count", **labels)] += 1
+
+
+def start_request():
+    "Start measuring the request."
+    flask.g.metrics_started = time.perf_counter()
+    with _lock:
+        _gauges["blobserver_requests_in_flight"] += 1
+
+
+def end_request(response):
+    "Record the metrics for the request, which has produced the response."
+    request = flask.request
+    endpoint = request.endpoint or "none"
+    add(
+        "blobserver_requests_total",
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    observe(
+        "blobserver_request_duration_seconds",
+        time.perf_counter() - flask.g.metrics_started,
+        endpoint=endpoint,
+    )
+    if request.blueprint == "blob":
+        if request.method in ("PUT", "POST", "PATCH") and request.content_length:
+            add("blobserver_upload_bytes_total", request.content_length)
+        elif request.method == "GET" and response.status_code in (200, 206):
+            if response.content_length:
+                add("blobserver_download_bytes_total", response.content_length)
+    db = flask.g.get("db")
+    if db is not None and hasattr(db, "queries"):
+        add("blobserver_db_queries_total", db.queries, endpoint=endpoint)
+        add("blobserver_db_query_seconds_total", db.query_time, endpoint=endpoint)
+    return response
+
+
+def teardown_request(exception):
+    "Finish measuring the request, even if it failed; flush if it is time."
+    if flask.g.pop("metrics_started", None) is not None:
+        with _lock:
+            _gauges["blobserver_requests_in_flight"] -= 1
+    if time.monotonic() - _flushed >= FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    """Write the counts and gauges of this process to its file.
+    Skipped if another thread is already doing so.
+    """
+    global _flushed
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _flushed = time.monotonic()
+        for name, stats in cache.get_stats().items():
+            for key in ("hits", "misses"):
+                series = get_series(f"blobserver_cache_{key}_total", cache=name)
+                with _lock:
+                    _counters[series] = stats[key]
+        with _lock:
+            data = dict(counters=dict(_counters), gauges=dict(_gauges))
+        filepath = os.path.join(_dirpath, f"{os.getpid()}-{_started}.json")
+        write_json(filepath, data)
+    finally:
+        _flush_lock.release()
+
+
+def write_json(filepath, data):
+    "Write the data to the file atomically."
+    tmppath = f"{filepath}.tmp"
+    with open(tmppath, "w") as outfile:
+        json.dump(data, outfile)
+    os.replace(tmppath, filepath)
+
+
+def collect():
+    """Return the metrics of all server processes in the Prometheus text
+    format. The files of processes that have exited are merged into the
+    archive file and removed.
+    """
+    flush()
+    dirpath = _dirpath
+    counters = collections.defaultdict(float)
+    gauges = collections.defaultdict(float)
+    with open(os.path.join(dirpath, LOCK_FILENAME), "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        archivepath = os.path.join(dirpath, ARCHIVE_FILENAME)
+        try:
+            with open(archivepath) as infile:
+                archive = json.load(infile)
+        except FileNotFoundError:
+            archive = {}
+        archived = False
+        for filename in sorted(os.listdir(dirpath)):
+            match = re.match(r"(\d+)-[\d.]+\.json$", filename)
+            if not match:
+                continue
+            filepath = os.path.join(dirpath, filename)
+            try:
+                with open(filepath) as infile:
+                    data = json.load(infile)
+            except (OSError, ValueError):
+                continue
+            if is_alive(int(match.group(1))):
+                for series, value in data["gauges"].items():
+                    gauges[series] += value
+                for series, value in data["counters"].items():
+                    counters[series] += value
+            else:
+                for series, value in data["counters"].items():
+                    archive[series] = archive.get(series, 0) + value
+                os.remove(filepath)
+                archived = True
+        if archived:
+            write_json(archivepath, archive)
+    for series, value in archive.items():
+        counters[series] += value
+    return render(counters, gauges)
+
+
+def is_alive(pid):
+    "Is the process with the given pid alive?"
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render(counters, gauges):
+    "Return the series in the Prometheus text format, grouped by metric."
+    series_by_name = collections.defaultdict(list)
+    for series, value in list(counters.items()) + list(gauges.items()):
+        name = series.split("{", 1)[0]
+        if name not in METRICS:
+            for suffix in SUFFIXES:
+                if name.endswith(suffix):
+                    name = name[: -len(suffix)]
+                    break
+        series_by_name[name].append((get_sort_key(series), series, value))
+    # Gauges are output even if no process has recorded them.
+    for name, (type, help) in METRICS.items():
+        if type == "gauge" and name not in series_by_name:
+            series_by_name[name].append(((name, 0.0), name, 0))
+    lines = []
+    for name, (type, help) in METRICS.items():
+        if name not in series_by_name:
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for key, series, value in sorted(series_by_name[name]):
+            if value == int(value):
+                value = int(value)
+            lines.append(f"{series} {value}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def get_sort_key(series):
+    """Return the key for sorting the series, ordering the buckets
+    of a histogram by their upper bound.
+    """
+    match = re.search(r'[{,]le="([^"]+)"', series)
+    if not match:
+        return (series, 0.0)
+    return (series[: match.start()], float(match.group(1)))
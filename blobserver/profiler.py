@@ -0,0 +1,201 @@
+"""Sampling CPU profiler and memory allocation snapshots, for admin.
+
+The profiler is a thread which, while active, periodically records the
+stack of every other thread in the server process, including idle ones.
+The result is given as collapsed stacks, one line per distinct stack
+with the number of samples, which flamegraph tools can read.
+
+Memory snapshots use 'tracemalloc'; each snapshot is compared with the
+previous one, to show where allocated memory has grown.
+
+Nothing runs, and nothing is traced, unless started by an admin.
+Both apply only to the server process which handles the request.
+"""
+
+import collections
+import os.path
+import sys
+import threading
+import time
+import tracemalloc
+
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 600
+DEFAULT_INTERVAL = 10  # Milliseconds between samples.
+MIN_INTERVAL = 1
+DEFAULT_FRAMES = 10  # Number of frames to record for each allocation.
+MAX_FRAMES = 100
+DEFAULT_LIMIT = 50  # Number of statistics to show for a snapshot.
+
+_profiler = None
+_snapshot = None
+_lock = threading.Lock()
+
+
+class Profiler:
+    "Sample the stacks of the threads of the process for a given time."
+
+    def __init__(self, seconds, interval):
+        self.seconds = seconds
+        self.interval = interval
+        self.started = time.time()
+        self.samples = 0
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        deadline = time.monotonic() + self.seconds
+        ident = threading.get_ident()
+        labels = {}
+        while not self.stopped.wait(self.interval / 1000):
+            if time.monotonic() > deadline:
+                break
+            stacks = []
+            for thread, frame in sys._current_frames().items():
+                if thread != ident:
+                    stacks.append(get_stack(frame, labels))
+            with self.lock:
+                self.counts.update(stacks)
+                self.samples += 1
+        self.stopped.set()
+
+    def stop(self):
+        "Stop sampling, and wait for the thread to finish."
+        self.stopped.set()
+        self.thread.join()
+
+    def is_active(self):
+        return not self.stopped.is_set()
+
+    def get_status(self):
+        "Return the parameters and state of the profiler."
+        return dict(
+            pid=os.getpid(),
+            active=self.is_active(),
+            started=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started)),
+            seconds=self.seconds,
+            interval=self.interval,
+            samples=self.samples,
+        )
+
+    def get_collapsed(self):
+        "Return the samples as collapsed stacks, most frequent first."
+        with self.lock:
+            counts = self.counts.most_common()
+        return "".join([f"{stack} {count}\n" for stack, count in counts])
+
+
+def get_stack(frame, labels):
+    """Return the stack of the frame as a string of function labels
+    separated by semicolons, outermost first. The labels of code objects
+    are memoized in the given dict.
+    """
+    result = []
+    while frame is not None:
+        code = frame.f_code
+        try:
+            result.append(labels[code])
+        except KeyError:
+            name = getattr(code, "co_qualname", code.co_name)
+            filename = os.path.basename(code.co_filename)
+            label = labels[code] = f"{name} ({filename})".replace(";", ":")
+            result.append(label)
+        frame = frame.f_back
+    return ";".join(reversed(result))
+
+
+def start_profiler(seconds=DEFAULT_SECONDS, interval=DEFAULT_INTERVAL):
+    """Start the profiler for the given number of seconds, sampling at
+    the given interval in milliseconds. Discard the result of any
+    previous profiler. Raise ValueError if the parameters are invalid
+    or a profiler is already active.
+    """
+    global _profiler
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError(f"Seconds must be more than 0 and at most {MAX_SECONDS}.")
+    if interval < MIN_INTERVAL:
+        raise ValueError(f"Interval must be at least {MIN_INTERVAL} ms.")
+    with _lock:
+        if _profiler and _profiler.is_active():
+            raise ValueError("The profiler is already active.")
+        _profiler = Profiler(seconds, interval)
+        return _profiler
+
+
+def stop_profiler():
+    "Stop the profiler, if active. Return it, or None if never started."
+    with _lock:
+        profiler = _profiler
+    if profiler:
+        profiler.stop()
+    return profiler
+
+
+def get_profiler():
+    "Return the current or most recent profiler, or None."
+    return _profiler
+
+
+def start_tracing(frames=DEFAULT_FRAMES):
+    """Start tracing memory allocations, recording the given number of
+    frames for each. Raise ValueError if the number is invalid.
+    """
+    global _snapshot
+    if not 1 <= frames <= MAX_FRAMES:
+        raise ValueError(f"Frames must be at least 1 and at most {MAX_FRAMES}.")
+    with _lock:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _snapshot = None
+        tracemalloc.start(frames)
+
+
+def stop_tracing():
+    "Stop tracing memory allocations, and discard the snapshot."
+    global _snapshot
+    with _lock:
+        tracemalloc.stop()
+        _snapshot = None
+
+
+def get_memory_growth(key="lineno", limit=DEFAULT_LIMIT):
+    """Take a snapshot of the memory allocations, and return as text
+    the largest differences from the previous snapshot, or the largest
+    allocations if this is the first. The statistics are grouped by
+    'lineno', 'filename' or 'traceback'. Raise ValueError if not tracing.
+    """
+    global _snapshot
+    if key not in ("lineno", "filename", "traceback"):
+        raise ValueError("Key must be 'lineno', 'filename' or 'traceback'.")
+    with _lock:
+        if not tracemalloc.is_tracing():
+            raise ValueError("Memory allocations are not being traced.")
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            ]
+        )
+        previous = _snapshot
+        _snapshot = snapshot
+    size, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"Process {os.getpid()}: traced {size} bytes, peak {peak} bytes.",
+    ]
+    if previous is None:
+        lines.append("Largest allocations; the next snapshot shows the growth.")
+        statistics = snapshot.statistics(key)
+    else:
+        lines.append("Largest growth since the previous snapshot.")
+        statistics = snapshot.compare_to(previous, key)
+    for statistic in statistics[:limit]:
+        lines.append("")
+        lines.append(str(statistic))
+        if key == "traceback":
+            lines.extend(statistic.traceback.format(most_recent_first=True))
+    lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,244 @@
+"""Location of the blob files in the storage directory.
+
+In the flat layout, the file for a blob is located directly in the
+storage directory. In the sharded layout, it is located in a two-level
+subdirectory of the directory '_shards', keyed by a hash of the IUID of
+the blob. The leading underscore protects the shards from collisions
+with blob filenames. While files are being migrated from one layout
+to the other, a file not yet moved is found in its old location.
+
+The content of a blob smaller than STORAGE_INLINE_LIMIT is instead stored
+inline in the database, in the table 'blobs_inline', and has no file.
+
+A blob file may be compressed; its encoding and seek index are recorded
+in the table 'blobs_compressed'. See the module 'compression'.
+
+Variants of uncompressed blob files, compressed in advance for downloads,
+are kept in the directory '_variants'. The name of a variant file contains
+the sha256 digest of the content, so a variant becomes invalid as soon as
+the content changes.
+"""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import os
+import os.path
+
+import flask
+
+from blobserver import compression
+
+SHARDS_DIRNAME = "_shards"
+INLINE_LOCK_FILENAME = "_inline.lock"
+VARIANTS_DIRNAME = "_variants"
+
+
+def get_filepath(data):
+    """Return the path of the file for the blob, given its IUID and filename.
+    This is its current location, if it exists in either layout,
+    otherwise its location in the configured layout.
+    """
+    filepath = get_layout_filepath(data, flask.current_app.config["STORAGE_SHARDED"])
+    if os.path.exists(filepath):
+        return filepath
+    other = get_layout_filepath(data, not flask.current_app.config["STORAGE_SHARDED"])
+    if os.path.exists(other):
+        return other
+    return filepath
+
+
+def get_new_filepath(data):
+    """Return the path for a new file for the blob in the configured layout.
+    Create the shard directory if required.
+    """
+    filepath = get_layout_filepath(data, flask.current_app.config["STORAGE_SHARDED"])
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return filepath
+
+
+def get_layout_filepath(data, sharded):
+    "Return the path of the file for the blob in the given layout."
+    dirpath = flask.current_app.config["STORAGE_DIRPATH"]
+    if sharded:
+        digest = hashlib.md5(data["iuid"].encode("utf-8")).hexdigest()
+        dirpath = os.path.join(dirpath, SHARDS_DIRNAME, digest[0:2], digest[2:4])
+    return os.path.join(dirpath, data["filename"])
+
+
+def get_filepaths():
+    "Return the paths of all blob files in the storage directory, in any layout."
+    dirpath = flask.current_app.config["STORAGE_DIRPATH"]
+    result = []
+    for entry in os.scandir(dirpath):
+        if entry.is_file() and not entry.name.startswith("_"):
+            result.append(entry.path)
+    for dirpath, dirnames, filenames in os.walk(os.path.join(dirpath, SHARDS_DIRNAME)):
+        result.extend([os.path.join(dirpath, f) for f in filenames])
+    return result
+
+
+def is_inline_size(size):
+    "Should content of the given size be stored inline in the database?"
+    return size < flask.current_app.config["STORAGE_INLINE_LIMIT"]
+
+
+def get_inline(data):
+    """Return the content of the blob if it is stored inline in the database.
+    Return None if it is stored in a file.
+    """
+    rows = list(
+        flask.g.db.execute(
+            "SELECT content FROM blobs_inline WHERE iuid=?", (data["iuid"],)
+        )
+    )
+    if rows:
+        return rows[0][0]
+    else:
+        return None
+
+
+def set_inline(data, content):
+    """Store the content of the blob inline in the database.
+    Committed along with the blob data.
+    """
+    flask.g.db.execute(
+        "INSERT OR REPLACE INTO blobs_inline (iuid, content) VALUES (?, ?)",
+        (data["iuid"], content),
+    )
+
+
+def delete_inline(data):
+    """Remove the content of the blob stored inline in the database, if any.
+    Committed along with the blob data.
+    """
+    flask.g.db.execute("DELETE FROM blobs_inline WHERE iuid=?", (data["iuid"],))
+
+
+def get_compression(data):
+    """Return the encoding and the seek index of the file for the blob,
+    if it is compressed, otherwise None.
+    """
+    rows = list(
+        flask.g.db.execute(
+            "SELECT encoding, offsets FROM blobs_compressed WHERE iuid=?",
+            (data["iuid"],),
+        )
+    )
+    if rows:
+        return (rows[0][0], json.loads(rows[0][1]))
+    else:
+        return None
+
+
+def set_compression(data, compressed):
+    """Record the encoding and the seek index of the file for the blob,
+    or that it is not compressed if None. Committed along with the blob data.
+    """
+    if compressed:
+        flask.g.db.execute(
+            "INSERT OR REPLACE INTO blobs_compressed (iuid, encoding, offsets)"
+            " VALUES (?, ?, ?)",
+            (data["iuid"], compressed[0], json.dumps(compressed[1])),
+        )
+    else:
+        flask.g.db.execute("DELETE FROM blobs_compressed WHERE iuid=?", (data["iuid"],))
+
+
+def open_content(data):
+    """Return a file object for reading the original content of the blob,
+    decompressing the file if required, or from the database if inline.
+    """
+    inline = get_inline(data)
+    if inline is not None:
+        return io.BytesIO(inline)
+    infile = open(get_filepath(data), "rb")
+    compressed = get_compression(data)
+    if compressed:
+        return compression.Reader(infile, *compressed)
+    else:
+        return infile
+
+
+def get_variant_filepath(data, encoding):
+    "Return the path of the variant file for the blob compressed in the encoding."
+    return os.path.join(
+        flask.current_app.config["STORAGE_DIRPATH"],
+        VARIANTS_DIRNAME,
+        f"{data['iuid']}.{data['sha256']}.{encoding}",
+    )
+
+
+def remove_variants(data):
+    "Remove all variant files for the blob."
+    for filepath in glob.glob(
+        os.path.join(
+            flask.current_app.config["STORAGE_DIRPATH"],
+            VARIANTS_DIRNAME,
+            f"{data['iuid']}.*",
+        )
+    ):
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+
+
+@contextlib.contextmanager
+def locked_file(data):
+    """Context manager holding an exclusive lock on the file for the blob.
+    Since the file may be replaced or moved while waiting for the lock,
+    make sure that the locked file is still the current one.
+    If the content is stored inline in the database, a lock file shared
+    by all such blobs is locked instead, and None is yielded.
+    """
+    while True:
+        filepath = get_filepath(data)
+        try:
+            lockfile = open(filepath, "rb")
+        except FileNotFoundError:
+            if get_filepath(data) != filepath:
+                continue  # Was moved just now.
+            if get_inline(data) is None:
+                raise
+            filepath = None
+            lockfile = open(
+                os.path.join(
+                    flask.current_app.config["STORAGE_DIRPATH"], INLINE_LOCK_FILENAME
+                ),
+                "ab",
+            )
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            if filepath is None:
+                if get_inline(data) is not None:
+                    break
+            elif os.stat(filepath).st_ino == os.fstat(lockfile.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lockfile.close()
+    try:
+        yield filepath
+    finally:
+        lockfile.close()  # Releases the lock.
+
+
+def move_file(data, sharded):
+    """Move the file for the blob to its location in the given layout.
+    The file is locked and hard-linked into place before being unlinked
+    from its old location, so that it can always be found.
+    Content stored inline in the database is not moved.
+    Return True if the file was moved.
+    """
+    with locked_file(data) as filepath:
+        newpath = get_layout_filepath(data, sharded)
+        if filepath is None or filepath == newpath:
+            return False
+        os.makedirs(os.path.dirname(newpath), exist_ok=True)
+        os.link(filepath, newpath)
+        os.remove(filepath)
+    return True
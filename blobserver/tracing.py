@@ -0,0 +1,220 @@
+"""Tracing of requests, recording the time of the stages of handling them.
+
+Each request gets a trace identifier and a root span, within which the
+code marks stages, such as database lookups, computing digests and
+writing files, as nested spans. A trace is recorded if the request was
+sampled, if an admin forced it by the header 'x-trace', or if the request
+took longer than the configured threshold.
+
+Recorded traces are appended to a file in the Chrome trace event format,
+which can be opened in Perfetto (https://ui.perfetto.dev) or in
+'chrome://tracing'. The file is a JSON array which is not terminated,
+as the format allows, so that events can be appended to it. When it
+would exceed the configured size, it is renamed with the suffix '.1',
+replacing the previous such file, and a new file is started.
+"""
+
+import fcntl
+import functools
+import json
+import logging
+import os
+import os.path
+import random
+import threading
+import time
+import uuid
+
+import flask
+
+TRACES_FILENAME = "_traces.json"
+
+_lock = threading.Lock()
+
+
+def init(app):
+    "Trace the requests of the app, if enabled."
+    if not app.config["TRACING"]:
+        return
+    app.before_request(start_trace)
+    app.after_request(add_trace_header)
+    app.teardown_request(end_trace)
+
+
+class Trace:
+    "The spans recorded for a request."
+
+    def __init__(self, sampled):
+        self.id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.epoch = time.time()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.status = None
+
+    def add(self, name, started, finished, args):
+        "Add the span as an event in the Chrome trace event format."
+        event = dict(
+            name=name,
+            cat="blobserver",
+            ph="X",
+            ts=round(1e6 * (self.epoch + started - self.origin), 1),
+            dur=round(1e6 * (finished - started), 1),
+            pid=os.getpid(),
+            tid=threading.get_native_id(),
+        )
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+
+class Span:
+    """Context manager timing a stage of the request as a span of its trace.
+    Does nothing if the request is not traced, or outside of a request.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.trace = None
+
+    def __enter__(self):
+        if flask.has_app_context():
+            self.trace = flask.g.get("trace")
+            if self.trace is not None:
+                self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        if self.trace is not None:
+            if etyp is not None:
+                self.args["error"] = etyp.__name__
+            self.trace.add(self.name, self.started, time.perf_counter(), self.args)
+        return False
+
+    def set(self, key, value):
+        "Set an argument of the span, e.g. a result of the stage."
+        self.args[key] = value
+
+
+def span(name, **args):
+    "Return a context manager recording a span with the name and arguments."
+    return Span(name, args)
+
+
+def traced(f):
+    "Decorator recording a span, named by the function, for each call."
+
+    @functools.wraps(f)
+    def wrap(*args, **kwargs):
+        with Span(f.__name__, {}):
+            return f(*args, **kwargs)
+
+    return wrap
+
+
+def record(name, started, **args):
+    """Record a span with the name and arguments, from the given start,
+    a value of 'time.perf_counter()', until now.
+    """
+    if flask.has_app_context():
+        trace = flask.g.get("trace")
+        if trace is not None:
+            trace.add(name, started, time.perf_counter(), args)
+
+
+def start_trace():
+    "Start the trace of the request; decide whether it is sampled."
+    rate = flask.current_app.config["TRACE_SAMPLE_RATE"]
+    flask.g.trace = Trace(sampled=random.random() < rate)
+
+
+def is_forced():
+    "Has an admin asked for the request to be traced?"
+    return bool(flask.request.headers.get("x-trace")) and flask.g.get("am_admin")
+
+
+def add_trace_header(response):
+    """Record the status of the response. Return the trace identifier
+    in a header if the trace is sure to be recorded.
+    """
+    trace = flask.g.get("trace")
+    if trace is not None:
+        trace.status = response.status_code
+        if trace.sampled or is_forced():
+            response.headers["X-Trace-Id"] = trace.id
+    return response
+
+
+def end_trace(exception):
+    """Finish the root span of the request, and record the trace
+    if sampled, forced or slow.
+    """
+    trace = flask.g.pop("trace", None)
+    if trace is None:
+        return
+    finished = time.perf_counter()
+    config = flask.current_app.config
+    request = flask.request
+    if trace.sampled:
+        reason = "sampled"
+    elif is_forced():
+        reason = "forced"
+    elif config["TRACE_SLOW_MS"] and (
+        1000 * (finished - trace.origin) >= config["TRACE_SLOW_MS"]
+    ):
+        reason = "slow"
+    else:
+        return
+    args = dict(
+        trace_id=trace.id,
+        reason=reason,
+        method=request.method,
+        path=request.path,
+        endpoint=request.endpoint,
+        status=trace.status,
+    )
+    if exception is not None:
+        args["error"] = type(exception).__name__
+    trace.add("request", trace.origin, finished, args)
+    try:
+        write_events(trace.events)
+    except OSError as error:
+        logger = logging.getLogger(config["LOG_NAME"])
+        logger.warning(f"Could not record trace: {error}")
+
+
+def get_filepath():
+    "Return the path of the file to which traces are appended."
+    config = flask.current_app.config
+    return config["TRACE_FILEPATH"] or os.path.join(
+        config["STORAGE_DIRPATH"], TRACES_FILENAME
+    )
+
+
+def write_events(events):
+    """Append the events to the file in one write, locked with respect
+    to other threads and processes. Rotate the file first if it would
+    become too large. Start the JSON array if the file is new.
+    """
+    data = "".join([json.dumps(event) + ",\n" for event in events])
+    filepath = get_filepath()
+    max_size = flask.current_app.config["TRACE_FILE_SIZE"]
+    with _lock:
+        while True:
+            with open(filepath, "a") as outfile:
+                fcntl.flock(outfile, fcntl.LOCK_EX)
+                # Another process may have rotated the file while waiting.
+                try:
+                    if os.stat(filepath).st_ino != os.fstat(outfile.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                size = os.fstat(outfile.fileno()).st_size
+                if max_size and size and size + len(data) > max_size:
+                    os.replace(filepath, f"{filepath}.1")
+                    continue
+                if size == 0:
+                    data = "[\n" + data
+                outfile.write(data)
+                return  # Closing the file flushes it and releases the lock.
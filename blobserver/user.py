@@ -1,9 +1,13 @@
 "User display and login/logout HTMl endpoints."
 
+import hashlib
+
 import flask
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from blobserver import cache
 from blobserver import constants
+from blobserver import tracing
 from blobserver import utils
 
 KEYS = [
@@ -19,6 +23,9 @@ KEYS = [
     "modified",
 ]
 
+# Credentials are not copied into the cache shared by all server processes.
+CACHE_EXCLUDE_KEYS = ["password", "accesskey"]
+
 
 def init(app):
     "Initialize the database: create user table."
@@ -215,6 +222,7 @@ def edit(username):
             flask.g.db.execute(
                 "DELETE FROM users " " WHERE username=? COLLATE NOCASE", (username,)
             )
+        cache.invalidate("users")
         utils.flash_message(f"Deleted user {username}.")
         utils.get_logger().info(f"deleted user {username}")
         if flask.g.am_admin:
@@ -281,6 +289,7 @@ class UserSaver(utils.BaseSaver):
     "User document saver context."
 
     LOG_HIDE_VALUE_PATHS = [["password"], ["accesskey"]]
+    CACHE_NAMESPACES = ["users"]
 
     def initialize(self):
         "Set the status and API key for a new user."
@@ -397,6 +406,49 @@ def get_user(username=None, email=None, accesskey=None):
         return user
 
 
+@tracing.traced
+def get_cached_user(username=None, accesskey=None):
+    """Return the user for the given username or accesskey, using the cache
+    shared by all server processes. Return None if no such user.
+    The password and access key are not included, except the access key
+    if given. The cache is keyed by a digest of the access key.
+    """
+    if username:
+        key = f"username {username.lower()}"
+    elif accesskey:
+        key = f"accesskey {hashlib.sha256(accesskey.encode('utf-8')).hexdigest()}"
+    else:
+        return None
+    user = cache.get_shared("users", key, lambda: load_cached_user(username, accesskey))
+    if user and not username:
+        user["accesskey"] = accesskey
+    return user
+
+
+def load_cached_user(username, accesskey):
+    "Return the user to be cached, without the credentials, or None."
+    user = get_user(username=username, accesskey=accesskey)
+    if user:
+        for key in CACHE_EXCLUDE_KEYS:
+            user.pop(key)
+    return user
+
+
+def get_accesskey(user):
+    "Return the access key of the user, which may not have been cached."
+    if user.get("accesskey"):
+        return user["accesskey"]
+    rows = list(
+        flask.g.db.execute(
+            "SELECT accesskey FROM users WHERE username=?", (user["username"],)
+        )
+    )
+    if rows:
+        return rows[0][0]
+    else:
+        return None
+
+
 def get_users(role=None, status=None):
     """Get the users optionally specified by role and status.
     Add total blobs count and size.
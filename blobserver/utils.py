@@ -1,15 +1,25 @@
 "Various utility functions and classes."
 
+import atexit
+import collections
 import copy
 import datetime
 import functools
+import hashlib
 import html
 import http.client
 import json
 import logging
+import logging.handlers
+import os
 import os.path
+import queue
+import random
+import re
 import sqlite3
 import sys
+import threading
+import time
 import uuid
 
 import flask
@@ -17,7 +27,9 @@ import marko
 import markupsafe
 import werkzeug.routing
 
+from blobserver import cache
 from blobserver import constants
+from blobserver import tracing
 
 
 def init(app):
@@ -42,11 +54,18 @@ def init(app):
         db.execute("CREATE INDEX IF NOT EXISTS" " logs_iuid_index ON logs (iuid)")
 
 
-# Global logger instance.
+# Global logger instances.
 _logger = None
+_access_logger = None
+
+# Queue handlers of the loggers, and the listeners writing their records.
+_log_listeners = []
 
 
 def get_logger(app=None):
+    """Return the logger for the app, creating it if required.
+    The records are written by a separate thread.
+    """
     global _logger
     if _logger is None:
         if app is None:
@@ -59,7 +78,7 @@ def get_logger(app=None):
             _logger.setLevel(logging.WARNING)
         if config["LOG_FILEPATH"]:
             if config["LOG_ROTATING"]:
-                loghandler = logging.TimedRotatingFileHandler(
+                loghandler = logging.handlers.TimedRotatingFileHandler(
                     config["LOG_FILEPATH"],
                     when="midnight",
                     backupCount=config["LOG_ROTATING"],
@@ -69,20 +88,121 @@ def get_logger(app=None):
         else:
             loghandler = logging.StreamHandler()
         loghandler.setFormatter(logging.Formatter(config["LOG_FORMAT"]))
-        _logger.addHandler(loghandler)
+        _logger.addHandler(get_queue_handler(loghandler))
     return _logger
 
 
+def get_access_logger(app=None):
+    """Return the logger for the access log, creating it if required,
+    or None if no access log file is configured. The records are
+    formatted as JSON and written by a separate thread.
+    """
+    global _access_logger
+    if _access_logger is None:
+        if app is None:
+            app = flask.current_app
+        config = app.config
+        if not config["ACCESS_LOG_FILEPATH"]:
+            return None
+        _access_logger = logging.getLogger(f"{config['LOG_NAME']}.access")
+        _access_logger.setLevel(logging.INFO)
+        _access_logger.propagate = False
+        loghandler = logging.FileHandler(config["ACCESS_LOG_FILEPATH"])
+        loghandler.setFormatter(JsonFormatter())
+        _access_logger.addHandler(get_queue_handler(loghandler, RecordQueueHandler))
+    return _access_logger
+
+
+def get_queue_handler(handler, cls=logging.handlers.QueueHandler):
+    """Return a handler passing the records via a queue to a thread,
+    which writes them using the given handler.
+    """
+    queue_handler = cls(queue.SimpleQueue())
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    listener.start()
+    _log_listeners.append((queue_handler, listener))
+    return queue_handler
+
+
+def restart_log_listeners():
+    """Start new threads for the listeners in a forked process,
+    which does not inherit the threads of its parent.
+    """
+    for pos, (queue_handler, listener) in enumerate(_log_listeners):
+        queue_handler.queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            queue_handler.queue, *listener.handlers
+        )
+        listener.start()
+        _log_listeners[pos] = (queue_handler, listener)
+
+
+def stop_log_listeners():
+    "Stop the listeners, after they have written all records in the queues."
+    while _log_listeners:
+        queue_handler, listener = _log_listeners.pop()
+        listener.stop()
+
+
+os.register_at_fork(after_in_child=restart_log_listeners)
+atexit.register(stop_log_listeners)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler which leaves all formatting to the listener thread.
+    The message must not refer to objects that may change.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    "Format a record whose message is a dict as a line of JSON."
+
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False)
+
+
 def log_access(response):
-    "Record access using the logger."
-    if flask.g.current_user:
-        username = flask.g.current_user["username"]
-    else:
-        username = None
-    get_logger().debug(
-        f"{flask.request.remote_addr} {username}"
-        f" {flask.request.method} {flask.request.path}"
-        f" {response.status_code}"
+    """Record access using the logger, if at level debug.
+    Record it also in the access log, if configured. Successful GET and HEAD
+    requests are recorded only for the configured fraction of them.
+    """
+    logger = get_logger()
+    if logger.isEnabledFor(logging.DEBUG):
+        if flask.g.current_user:
+            username = flask.g.current_user["username"]
+        else:
+            username = None
+        logger.debug(
+            f"{flask.request.remote_addr} {username}"
+            f" {flask.request.method} {flask.request.path}"
+            f" {response.status_code}"
+        )
+    access_logger = get_access_logger()
+    if access_logger is None:
+        return response
+    request = flask.request
+    if request.method in ("GET", "HEAD") and response.status_code < 400:
+        rate = flask.current_app.config["ACCESS_LOG_SAMPLE_RATE"]
+        if rate < 1.0 and random.random() >= rate:
+            return response
+    started = flask.g.get("started")
+    access_logger.info(
+        dict(
+            time=get_time(),
+            remote_addr=request.remote_addr,
+            user=flask.g.current_user and flask.g.current_user["username"],
+            method=request.method,
+            path=request.path,
+            endpoint=request.endpoint,
+            status=response.status_code,
+            bytes_in=request.content_length,
+            bytes_out=response.content_length,
+            latency_ms=started and round(1000 * (time.perf_counter() - started), 3),
+            user_agent=request.user_agent.string,
+        )
     )
     return response
 
@@ -115,6 +235,68 @@ def admin_required(f):
     return wrap
 
 
+def page_cached(f):
+    """Decorator for caching the page shown to anonymous users by a GET,
+    keyed by the URL, if so configured. The page is cached in the shared
+    cache, unless its rendering modified the session, e.g. by a flashed
+    message. ETag and Cache-Control headers are added to let browsers
+    and proxies cache it as well.
+    """
+
+    @functools.wraps(f)
+    def wrap(*args, **kwargs):
+        config = flask.current_app.config
+        if (
+            not config["PAGE_CACHE"]
+            or not http_GET()
+            or flask.g.current_user
+            or "_flashes" in flask.session
+        ):
+            return f(*args, **kwargs)
+        rendered = []
+
+        def load():
+            response = flask.make_response(f(*args, **kwargs))
+            rendered.append(response)
+            if response.status_code != http.client.OK or flask.session.modified:
+                return None
+            page = response.get_data(as_text=True)
+            return {
+                "page": page,
+                "content_type": response.content_type,
+                "etag": hashlib.md5(page.encode("utf-8")).hexdigest(),
+            }
+
+        cached = cache.get_shared("pages", flask.request.url, load, cache_none=False)
+        if cached is None:
+            return rendered[0]
+        response = flask.Response(cached["page"], content_type=cached["content_type"])
+        response.set_etag(cached["etag"])
+        response.cache_control.public = True
+        response.cache_control.max_age = config["PAGE_CACHE_MAX_AGE"]
+        response.vary.add("Cookie")
+        return response.make_conditional(flask.request)
+
+    return wrap
+
+
+def get_etag(*parts):
+    "Return an ETag for the request URL and the given parts of the state."
+    state = json.dumps([flask.request.url, *parts])
+    return hashlib.md5(state.encode("utf-8")).hexdigest()
+
+
+def check_not_modified(etag):
+    """Return a '304 Not Modified' response if the client has the current
+    version, according to the ETag. Otherwise return None.
+    """
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=http.client.NOT_MODIFIED)
+        response.set_etag(etag)
+        return response
+    return None
+
+
 class IdentifierConverter(werkzeug.routing.BaseConverter):
     "URL route converter for an identifier."
 
@@ -184,6 +366,11 @@ def http_PUT():
     return flask.request.method == "PUT"
 
 
+def http_PATCH():
+    "Is the HTTP method PATCH? Is not tunneled."
+    return flask.request.method == "PATCH"
+
+
 def http_DELETE(csrf=True):
     "Is the HTTP method DELETE? Check for method tunneling."
     if flask.request.method == "DELETE":
@@ -259,14 +446,175 @@ def tojson2(value, indent=2):
 
 
 def get_db(app=None):
-    "Get the connection to the Sqlite3 database file."
+    """Get the connection to the Sqlite3 database file.
+    If metrics are enabled, the statements executed are counted.
+    If query tracing is enabled, the statements are also recorded.
+    """
     if app is None:
         app = flask.current_app
-    db = sqlite3.connect(app.config["SQLITE3_FILEPATH"])
+    if app.config["METRICS"] or app.config["SQL_TRACE"]:
+        factory = Connection
+    else:
+        factory = sqlite3.Connection
+    db = sqlite3.connect(app.config["SQLITE3_FILEPATH"], factory=factory)
     db.row_factory = sqlite3.Row
+    if app.config["SQL_TRACE"]:
+        db.tracer = QueryTracer()
+        db.set_trace_callback(db.tracer.trace)
+        db.set_progress_handler(db.tracer.progress, QueryTracer.PROGRESS_STEPS)
     return db
 
 
+class Connection(sqlite3.Connection):
+    """Connection which counts the statements executed via its cursors,
+    and the time taken by that. For a SELECT, this includes finding
+    the first row, but not fetching the others.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+        self.query_time = 0.0
+        self.tracer = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or Cursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def begin_execute(self):
+        "Note that a call executing statements is starting."
+        if self.tracer is not None:
+            self.tracer.begin()
+
+    def end_execute(self, elapsed):
+        "Count the call executing statements, which took the given time."
+        self.queries += 1
+        self.query_time += elapsed
+        if self.tracer is not None:
+            self.tracer.end(elapsed)
+
+
+class Cursor(sqlite3.Cursor):
+    "Cursor which counts the statements in its connection."
+
+    def execute(self, sql, parameters=()):
+        self.connection.begin_execute()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.end_execute(time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        self.connection.begin_execute()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self.connection.end_execute(time.perf_counter() - started)
+
+
+class QueryTracer:
+    """Record the statements executed by a connection, as reported by
+    the trace callback of Sqlite3, with the time taken by the call that
+    executed them, and the number of virtual machine steps counted by
+    the progress handler. Statements executed implicitly, such as COMMIT,
+    have no time.
+    """
+
+    PROGRESS_STEPS = 1000
+    TEXT_LIMIT = 1000  # Longer statements, e.g. with content, are truncated.
+
+    def __init__(self):
+        self.statements = []  # Items [sql, time, steps].
+        self.begun = 0
+
+    def trace(self, sql):
+        self.statements.append([sql[: self.TEXT_LIMIT], 0.0, 0])
+
+    def progress(self):
+        if self.statements:
+            self.statements[-1][2] += self.PROGRESS_STEPS
+        return 0
+
+    def begin(self):
+        self.begun = len(self.statements)
+
+    def end(self, elapsed):
+        "Divide the time between the statements executed since 'begin'."
+        statements = self.statements[self.begun :]
+        for statement in statements:
+            statement[1] += elapsed / len(statements)
+
+    def get_summary(self, slowest=5, repeated=10):
+        """Return the number of statements, their total time, the slowest
+        statements, and the shapes of statements executed at least
+        the given number of times, which may indicate N+1 queries.
+        """
+        shapes = collections.Counter([get_sql_shape(s[0]) for s in self.statements])
+        statements = sorted(self.statements, key=lambda s: s[1], reverse=True)
+        return dict(
+            count=len(self.statements),
+            time=sum([s[1] for s in self.statements]),
+            slowest=statements[:slowest],
+            repeated={s: n for s, n in shapes.items() if n >= repeated},
+        )
+
+
+def get_sql_shape(sql):
+    "Return the SQL statement with literal values replaced by '?'."
+    sql = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", "?", sql)
+    return re.sub(r"\(\?(?:\s*,\s*\?)+\)", "(?, ...)", sql)
+
+
+# Summaries of the statements of the most recent requests. Per-process.
+_recent_queries = collections.deque(maxlen=20)
+_recent_queries_lock = threading.Lock()
+
+
+def report_queries(response):
+    """Log the slow statements, and the repeated ones, of the request.
+    Add a Server-Timing header for admin.
+    """
+    tracer = getattr(flask.g.get("db"), "tracer", None)
+    if tracer is None:
+        return response
+    config = flask.current_app.config
+    summary = tracer.get_summary(repeated=config["SQL_TRACE_REPEATED"])
+    summary["request"] = f"{flask.request.method} {flask.request.path}"
+    with _recent_queries_lock:
+        _recent_queries.append(summary)
+    logger = get_logger()
+    if config["SQL_TRACE_SLOW_MS"]:
+        for sql, elapsed, steps in summary["slowest"]:
+            if 1000 * elapsed < config["SQL_TRACE_SLOW_MS"]:
+                break
+            logger.warning(
+                f"Slow query {1000 * elapsed:.1f} ms, {steps} steps,"
+                f" {summary['request']}: {sql}"
+            )
+    if logger.isEnabledFor(logging.DEBUG):
+        for shape, count in summary["repeated"].items():
+            logger.debug(f"Repeated query {count} times, {summary['request']}: {shape}")
+    if flask.g.get("am_admin"):
+        response.headers.add(
+            "Server-Timing",
+            f'db;dur={1000 * summary["time"]:.1f};desc="{summary["count"]} queries"',
+        )
+    return response
+
+
+def get_recent_queries():
+    "Return the summaries of the statements of the most recent requests."
+    with _recent_queries_lock:
+        return list(_recent_queries)
+
+
 def get_logs(iuid):
     """Return the list of log entries for the given iuid,
     sorted by reverse timestamp.
@@ -291,6 +639,7 @@ class BaseSaver:
 
     LOG_EXCLUDE_PATHS = [["modified"]]  # Exclude from log info.
     LOG_HIDE_VALUE_PATHS = []  # Do not show value in log.
+    CACHE_NAMESPACES = []  # Cache namespaces to invalidate when saved.
 
     def __init__(self, doc=None):
         if doc is None:
@@ -308,10 +657,17 @@ class BaseSaver:
     def __exit__(self, etyp, einst, etb):
         if etyp is not None:
             return False
-        self.finalize()
+        name = type(self).__name__
+        with tracing.span(f"{name}.finalize"):
+            self.finalize()
         self.doc["modified"] = get_time()
-        self.upsert()
-        self.add_log()
+        with tracing.span(f"{name}.upsert"):
+            self.upsert()
+        with tracing.span(f"{name}.add_log"):
+            self.add_log()
+        with tracing.span("invalidate", namespaces=self.CACHE_NAMESPACES):
+            for namespace in self.CACHE_NAMESPACES:
+                cache.invalidate(namespace)
 
     def __getitem__(self, key):
         return self.doc[key]
@@ -0,0 +1,387 @@
+"""Test API blob handling on a server started by the tests.
+
+The server runs in a subprocess with a temporary storage directory,
+so no 'settings.json' file is required.
+"""
+
+import glob
+import hashlib
+import http.client
+import itertools
+import os.path
+import random
+import threading
+import time
+
+import pytest
+import requests
+
+import utils
+
+
+@pytest.fixture(scope="module")
+def server():
+    "Start a server with default settings."
+    with utils.Server() as server:
+        yield server
+
+
+def test_blob_copy(server):
+    "Copy a blob; the copy has the same content and digests, and counts for quota."
+    headers = server.create_user("copier", quota=25)
+    url = f"{server.base_url}/blob/original.txt"
+    response = requests.put(url, headers=headers, data=b"0123456789")
+    assert response.status_code == http.client.CREATED
+
+    session = requests.Session()
+    session.headers.update(headers)
+    token = utils.get_csrf_token(session, f"{url}/copy")
+    response = session.post(
+        f"{url}/copy",
+        data={"_csrf_token": token, "filename": "copy.txt", "description": "A copy."},
+    )
+    assert response.status_code == http.client.OK
+    response = requests.get(f"{server.base_url}/blob/copy.txt")
+    assert response.status_code == http.client.OK
+    assert response.content == b"0123456789"
+    original = requests.get(f"{url}/info.json").json()
+    copy = requests.get(f"{server.base_url}/blob/copy.txt/info.json").json()
+    assert copy["sha256"] == original["sha256"]
+    assert copy["md5"] == original["md5"]
+    assert copy["size"] == 10
+    assert copy["description"] == "A copy."
+    # Copied to a temporary file, which was moved into place.
+    with open(os.path.join(server.dirpath, "copy.txt"), "rb") as infile:
+        assert infile.read() == b"0123456789"
+    assert not glob.glob(os.path.join(server.dirpath, "_upload_*"))
+
+    # Writing into the original does not change the copy.
+    response = requests.patch(url, headers=headers, data=b"x")
+    assert response.status_code == http.client.OK
+    response = requests.get(f"{server.base_url}/blob/copy.txt")
+    assert response.content == b"0123456789"
+
+    # A further copy would exceed the quota.
+    response = session.post(
+        f"{url}/copy", data={"_csrf_token": token, "filename": "copy2.txt"}
+    )
+    assert "quota cannot accommodate" in response.text
+    response = requests.get(f"{server.base_url}/blob/copy2.txt")
+    assert response.status_code == http.client.NOT_FOUND
+
+
+def wait_for_reservation(server):
+    "Wait until an upload has reserved quota. Return the reserved size."
+    for attempt in range(100):
+        db = server.connect()
+        try:
+            size = db.execute("SELECT SUM(size) FROM reservations").fetchone()[0]
+        finally:
+            db.close()
+        if size:
+            return size
+        time.sleep(0.05)
+    raise AssertionError("No reservation.")
+
+
+def test_blob_quota(server):
+    "Uploads exceeding the quota are rejected, also while others are ongoing."
+    headers = server.create_user("limited", quota=1000)
+    url = f"{server.base_url}/blob/quota.bin"
+
+    # Rejected on the declared size, without a blob being created.
+    response = requests.put(url, headers=headers, data=b"x" * 1001)
+    assert response.status_code == http.client.REQUEST_ENTITY_TOO_LARGE
+    response = requests.get(url)
+    assert response.status_code == http.client.NOT_FOUND
+
+    # Rejected when a body of undeclared size exceeds the quota.
+    chunks = (b"x" * 100 for i in range(11))
+    response = requests.put(url, headers=headers, data=chunks)
+    assert response.status_code == http.client.REQUEST_ENTITY_TOO_LARGE
+    response = requests.get(url)
+    assert response.status_code == http.client.NOT_FOUND
+
+    # An ongoing upload reserves its size, also when it is undeclared.
+    for declared in (True, False):
+        connection = http.client.HTTPConnection("localhost", server.port)
+        connection.putrequest("PUT", "/blob/ongoing.bin")
+        connection.putheader("x-accesskey", headers["x-accesskey"])
+        if declared:
+            connection.putheader("Content-Length", "600")
+        else:
+            connection.putheader("Transfer-Encoding", "chunked")
+        connection.endheaders()
+        try:
+            assert wait_for_reservation(server) == (600 if declared else 1000)
+            response = requests.put(url, headers=headers, data=b"x" * 600)
+            assert response.status_code == http.client.REQUEST_ENTITY_TOO_LARGE
+        finally:
+            if declared:
+                connection.send(b"x" * 600)
+            else:
+                connection.send(b"258\r\n" + b"x" * 600 + b"\r\n0\r\n\r\n")
+            response = connection.getresponse()
+            connection.close()
+        assert response.status == http.client.CREATED
+        response = requests.delete(
+            f"{server.base_url}/blob/ongoing.bin", headers=headers
+        )
+        assert response.status_code == http.client.NO_CONTENT
+
+    # The reservations are released; the upload now fits.
+    response = requests.put(url, headers=headers, data=b"x" * 600)
+    assert response.status_code == http.client.CREATED
+
+
+def test_patch_concurrent(server):
+    "Appends conditional on the entity tag never go into a replaced file."
+    headers = server.create_user("patcher")
+    url = f"{server.base_url}/blob/concurrent.txt"
+    response = requests.put(url, headers=headers, data=b"a" * 100000)
+    assert response.status_code == http.client.CREATED
+    letters = b"bcdefghijklmnopqrstu"
+
+    # Assertions in the threads would not fail the test.
+    statuses = []
+
+    def put():
+        for i, letter in enumerate(letters):
+            response = requests.put(
+                url, headers=headers, data=bytes([letter]) * (100000 + 1000 * i)
+            )
+            statuses.append(response.status_code)
+
+    def patch():
+        while writer.is_alive():
+            etag = requests.head(url).headers["ETag"]
+            response = requests.patch(
+                url, headers={**headers, "If-Match": etag}, data=b"z" * 10
+            )
+            statuses.append(response.status_code)
+
+    writer = threading.Thread(target=put)
+    patchers = [threading.Thread(target=patch) for i in range(4)]
+    writer.start()
+    for patcher in patchers:
+        patcher.start()
+    for thread in [writer] + patchers:
+        thread.join()
+    assert set(statuses) <= {http.client.OK, http.client.PRECONDITION_FAILED}
+    content = requests.get(url).content
+    size = 100000 + 1000 * (len(letters) - 1)
+    assert content[:size] == letters[-1:] * size
+    assert content[size:] == b"z" * (len(content) - size)
+    assert requests.get(f"{url}/info.json").json()["size"] == len(content)
+
+
+def test_patch_digests(server):
+    "Digests cleared by writes into a blob are recomputed for the final content."
+    headers = server.create_user("rehasher")
+    url = f"{server.base_url}/blob/rehashed.bin"
+    content = bytearray(random.Random(2).randbytes(4 * 1024 * 1024))
+    response = requests.put(url, headers=headers, data=bytes(content))
+    assert response.status_code == http.client.CREATED
+    for i in range(20):
+        start = 1000 * i
+        content[start : start + 10] = b"x" * 10
+        response = requests.patch(
+            url,
+            headers={
+                **headers,
+                "Content-Range": f"bytes {start}-{start + 9}/{len(content)}",
+            },
+            data=b"x" * 10,
+        )
+        assert response.status_code == http.client.OK
+    for attempt in range(100):
+        info = requests.get(f"{url}/info.json").json()
+        if info["sha256"]:
+            break
+        time.sleep(0.05)
+    assert info["sha256"] == hashlib.sha256(content).hexdigest()
+    assert info["md5"] == hashlib.md5(content).hexdigest()
+    response = requests.get(url)
+    assert response.headers["ETag"] == f'"{info["sha256"]}"'
+
+
+def test_etags(server):
+    "The blob and the JSON listings are not sent again until changed."
+    headers = server.create_user("tagger")
+    url = f"{server.base_url}/blob/tagged.txt"
+    response = requests.put(url, headers=headers, data=b"tagged")
+    assert response.status_code == http.client.CREATED
+    urls = [
+        url,
+        f"{url}/info.json",
+        f"{server.base_url}/blobs/all.json",
+        f"{server.base_url}/blobs/user/tagger.json",
+        f"{server.base_url}/status",
+    ]
+    etags = {}
+    for link in urls:
+        response = requests.get(link)
+        assert response.status_code == http.client.OK
+        etags[link] = response.headers["ETag"]
+        response = requests.get(link, headers={"If-None-Match": etags[link]})
+        assert response.status_code == http.client.NOT_MODIFIED
+        assert response.content == b""
+
+    # Any change of the blob gives new entity tags.
+    response = requests.patch(url, headers=headers, data=b", changed")
+    assert response.status_code == http.client.OK
+    for link in urls:
+        response = requests.get(link, headers={"If-None-Match": etags[link]})
+        assert response.status_code == http.client.OK
+        assert response.headers["ETag"] != etags[link]
+    response = requests.get(url)
+    assert response.content == b"tagged, changed"
+
+    # A change of the description only gives a new entity tag for the info.
+    link = f"{url}/info.json"
+    response = requests.get(link)
+    etag = response.headers["ETag"]
+    response = requests.put(f"{url}/description", headers=headers, data="Tagged.")
+    assert response.status_code == http.client.OK
+    response = requests.get(link, headers={"If-None-Match": etag})
+    assert response.status_code == http.client.OK
+    assert response.headers["ETag"] != etag
+    assert response.json()["description"] == "Tagged."
+
+
+def test_asgi():
+    "Blobs uploaded and downloaded via the ASGI application served by uvicorn."
+    with utils.Server(asgi=True, ASGI_THREADS=1) as server:
+        headers = server.create_user("asgi", quota=2 * 1024 * 1024)
+        url = f"{server.base_url}/blob/asgi.bin"
+        content = random.Random(0).randbytes(1024 * 1024)
+        response = requests.put(url, headers=headers, data=content)
+        assert response.status_code == http.client.CREATED
+        response = requests.get(url)
+        assert response.status_code == http.client.OK
+        assert response.content == content
+        response = requests.get(url, headers={"Range": "bytes=100000-199999"})
+        assert response.status_code == http.client.PARTIAL_CONTENT
+        assert response.content == content[100000:200000]
+
+        # A body of undeclared size is received as the app reads it.
+        chunks = (content[i : i + 65536] for i in range(0, len(content), 65536))
+        response = requests.put(url, headers=headers, data=chunks)
+        assert response.status_code == http.client.OK
+        response = requests.get(url)
+        assert response.content == content
+
+        # Rejected before the client has sent all of a body exceeding the quota.
+        connection = http.client.HTTPConnection("localhost", server.port)
+        connection.putrequest("PUT", "/blob/toolarge.bin")
+        connection.putheader("x-accesskey", headers["x-accesskey"])
+        connection.putheader("Content-Length", str(10 * 1024 * 1024))
+        connection.endheaders()
+        connection.send(content[:100000])
+        response = connection.getresponse()
+        assert response.status == http.client.REQUEST_ENTITY_TOO_LARGE
+        connection.close()
+        chunks = (content[i : i + 65536] for i in range(0, len(content), 65536))
+        response = requests.put(
+            f"{server.base_url}/blob/toolarge.bin",
+            headers=headers,
+            data=itertools.chain(chunks, [content]),
+        )
+        assert response.status_code == http.client.REQUEST_ENTITY_TOO_LARGE
+
+        # A slow upload does not occupy the only thread for the Flask app.
+        connection = http.client.HTTPConnection("localhost", server.port)
+        connection.putrequest("PUT", "/blob/slow.bin")
+        connection.putheader("x-accesskey", headers["x-accesskey"])
+        connection.putheader("Content-Length", str(len(content)))
+        connection.endheaders()
+        connection.send(content[:200000])
+        try:
+            response = requests.get(f"{server.base_url}/status", timeout=5)
+            assert response.status_code == http.client.OK
+        finally:
+            connection.send(content[200000:])
+            response = connection.getresponse()
+            connection.close()
+        assert response.status == http.client.CREATED
+        response = requests.get(f"{server.base_url}/blob/slow.bin")
+        assert response.content == content
+
+        # The session cookie is found also when sent in a separate header.
+        session = requests.Session()
+        token = utils.get_csrf_token(session, f"{server.base_url}/user/login")
+        response = session.post(
+            f"{server.base_url}/user/login",
+            data={"_csrf_token": token, "username": "asgi", "password": utils.PASSWORD},
+        )
+        assert response.status_code == http.client.OK
+        cookie = "; ".join(f"{c.name}={c.value}" for c in session.cookies)
+        connection = http.client.HTTPConnection("localhost", server.port)
+        connection.putrequest("GET", "/user/display/asgi")
+        connection.putheader("Cookie", "other=1")
+        connection.putheader("Cookie", cookie)
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == http.client.OK
+        assert b"asgi@example.com" in response.read()
+        connection.close()
+
+
+def test_range(server):
+    "Byte ranges of a blob file, conditional on its entity tag."
+    headers = server.create_user("ranger")
+    url = f"{server.base_url}/blob/range.bin"
+    content = random.Random(1).randbytes(300000)
+    response = requests.put(url, headers=headers, data=content)
+    assert response.status_code == http.client.CREATED
+    response = requests.head(url)
+    assert response.status_code == http.client.OK
+    assert int(response.headers["Content-Length"]) == len(content)
+    etag = response.headers["ETag"]
+
+    for value, start, end in [
+        ("bytes=0-0", 0, 1),
+        ("bytes=1000-199999", 1000, 200000),
+        ("bytes=299990-", 299990, 300000),
+        ("bytes=-10", 299990, 300000),
+        ("bytes=299000-400000", 299000, 300000),
+    ]:
+        response = requests.get(url, headers={"Range": value})
+        assert response.status_code == http.client.PARTIAL_CONTENT
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["Content-Range"] == f"bytes {start}-{end - 1}/300000"
+        assert response.content == content[start:end]
+    response = requests.get(url, headers={"Range": "bytes=300000-"})
+    assert response.status_code == http.client.REQUESTED_RANGE_NOT_SATISFIABLE
+
+    # The range is sent only if the client has the current version.
+    response = requests.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == http.client.PARTIAL_CONTENT
+    assert response.content == content[:10]
+    response = requests.patch(url, headers=headers, data=b"x")
+    assert response.status_code == http.client.OK
+    response = requests.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == http.client.OK
+    assert response.content == content + b"x"
+
+    # Also when the pages of large files are dropped from the page cache.
+    with utils.Server(dirpath=server.dirpath, DOWNLOAD_DROP_CACHE_SIZE=1) as other:
+        url = f"{other.base_url}/blob/range.bin"
+        response = requests.get(url)
+        assert response.content == content + b"x"
+        response = requests.get(url, headers={"Range": "bytes=1000-1999"})
+        assert response.status_code == http.client.PARTIAL_CONTENT
+        assert response.content == content[1000:2000]
+
+
+def test_missing_file(server):
+    "A blob whose file is missing is not found, also for a range."
+    headers = server.create_user("loser")
+    url = f"{server.base_url}/blob/missing.bin"
+    response = requests.put(url, headers=headers, data=b"x" * 1000)
+    assert response.status_code == http.client.CREATED
+    os.remove(os.path.join(server.dirpath, "missing.bin"))
+    response = requests.get(url)
+    assert response.status_code == http.client.NOT_FOUND
+    response = requests.get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == http.client.NOT_FOUND
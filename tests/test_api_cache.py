@@ -0,0 +1,192 @@
+"""Test the caches, and their invalidation across server processes.
+
+Two servers sharing a temporary storage directory are run in subprocesses,
+as are the processes of a production server, so no 'settings.json' file
+is required.
+"""
+
+import http.client
+import os.path
+import re
+import sqlite3
+
+import requests
+
+import utils
+
+
+def get_cache_stats(base_url, headers, name):
+    "Return the statistics of the named cache from the admin debug page."
+    response = requests.get(f"{base_url}/debug", headers=headers)
+    assert response.status_code == http.client.OK
+    match = re.search(f"<tr><td>{name}</td><td>([^<]*)</td></tr>", response.text)
+    return dict(item.split("=") for item in match.group(1).split(", "))
+
+
+def test_blob_cache():
+    "Content of hot blobs cached in each process; invalidated on any change."
+    settings = dict(BLOB_CACHE_SIZE=1024 * 1024)
+    with utils.Server(**settings) as server:
+        with utils.Server(dirpath=server.dirpath, **settings) as other:
+            admin = server.create_user("cacheadmin", admin=True)
+            headers = server.create_user("cacher")
+            url = "/blob/cached.txt"
+            response = requests.put(server.base_url + url, headers=headers, data=b"1")
+            assert response.status_code == http.client.CREATED
+            for base_url in [server.base_url, other.base_url]:
+                for attempt in range(3):
+                    response = requests.get(base_url + url)
+                    assert response.status_code == http.client.OK
+                    assert response.content == b"1"
+            for base_url in [server.base_url, other.base_url]:
+                stats = get_cache_stats(base_url, admin, "blobs")
+                assert int(stats["hits"]) >= 2
+
+            # Changed in one process; the other does not serve the old content.
+            response = requests.put(server.base_url + url, headers=headers, data=b"2")
+            assert response.status_code == http.client.OK
+            response = requests.get(other.base_url + url)
+            assert response.content == b"2"
+            response = requests.patch(other.base_url + url, headers=headers, data=b"3")
+            assert response.status_code == http.client.OK
+            response = requests.get(server.base_url + url)
+            assert response.content == b"23"
+            response = requests.delete(server.base_url + url, headers=headers)
+            assert response.status_code == http.client.NO_CONTENT
+            response = requests.get(other.base_url + url)
+            assert response.status_code == http.client.NOT_FOUND
+
+
+def test_blob_data_cache():
+    "Blob data, also of missing names, cached in each process; invalidated."
+    settings = dict(BLOB_DATA_CACHE_ENTRIES=100)
+    with utils.Server(**settings) as server:
+        with utils.Server(dirpath=server.dirpath, **settings) as other:
+            admin = server.create_user("dataadmin", admin=True)
+            headers = server.create_user("datacacher")
+            url = "/blob/data.txt"
+            for attempt in range(3):
+                response = requests.get(f"{other.base_url}{url}/info.json")
+                assert response.status_code == http.client.NOT_FOUND
+            stats = get_cache_stats(other.base_url, admin, "blob_data")
+            assert int(stats["hits"]) >= 2
+
+            # Created in one process; no longer missing in the other.
+            response = requests.put(server.base_url + url, headers=headers, data=b"1")
+            assert response.status_code == http.client.CREATED
+            response = requests.get(f"{other.base_url}{url}/info.json")
+            assert response.status_code == http.client.OK
+            assert response.json()["description"] is None
+
+            response = requests.put(
+                f"{server.base_url}{url}/description", headers=headers, data="Data."
+            )
+            assert response.status_code == http.client.OK
+            response = requests.get(f"{other.base_url}{url}/info.json")
+            assert response.json()["description"] == "Data."
+            response = requests.delete(other.base_url + url, headers=headers)
+            assert response.status_code == http.client.NO_CONTENT
+            response = requests.get(f"{server.base_url}{url}/info.json")
+            assert response.status_code == http.client.NOT_FOUND
+
+
+def test_shared_cache():
+    "User accounts cached for all processes, without credentials; invalidated."
+    settings = dict(SHARED_CACHE_SIZE=1024 * 1024)
+    with utils.Server(**settings) as server:
+        with utils.Server(dirpath=server.dirpath, **settings) as other:
+            admin = server.create_user("sharedadmin", admin=True)
+            headers = server.create_user("sharer")
+            url = "/blob/shared.txt"
+            response = requests.put(server.base_url + url, headers=headers, data=b"1")
+            assert response.status_code == http.client.CREATED
+            # Looked up by the other process in the cache filled by the first.
+            for base_url in [server.base_url, other.base_url]:
+                response = requests.get(
+                    f"{base_url}/blobs/user/sharer.json", headers=headers
+                )
+                assert response.status_code == http.client.OK
+            stats = get_cache_stats(other.base_url, admin, "shared users")
+            assert int(stats["hits"]) >= 1
+
+            # The cache contains neither the access key nor the password.
+            db = server.connect()
+            try:
+                (password,) = db.execute(
+                    "SELECT password FROM users WHERE username='sharer'"
+                ).fetchone()
+            finally:
+                db.close()
+            db = sqlite3.connect(os.path.join(server.dirpath, "_cache.sqlite3"))
+            try:
+                entries = db.execute("SELECT key, value FROM entries").fetchall()
+            finally:
+                db.close()
+            assert entries
+            for key, value in entries:
+                assert headers["x-accesskey"] not in key + value
+                assert password not in value
+
+            # Disabled via one process; rejected at once by the other.
+            session = requests.Session()
+            session.headers.update(admin)
+            token = utils.get_csrf_token(
+                session, f"{server.base_url}/user/display/sharer"
+            )
+            response = session.post(
+                f"{server.base_url}/user/disable/sharer", data={"_csrf_token": token}
+            )
+            assert response.status_code == http.client.OK
+            response = requests.put(other.base_url + url, headers=headers, data=b"2")
+            assert response.status_code == http.client.UNAUTHORIZED
+
+
+def test_page_cache():
+    "Pages for anonymous users in the shared cache; invalidated by any process."
+    settings = dict(
+        SHARED_CACHE_SIZE=1024 * 1024, PAGE_CACHE=True, PAGE_CACHE_MAX_AGE=60
+    )
+    with utils.Server(**settings) as server:
+        with utils.Server(dirpath=server.dirpath, **settings) as other:
+            admin = server.create_user("pageadmin", admin=True)
+            headers = server.create_user("pager")
+            url = "/blob/page.txt"
+            response = requests.put(server.base_url + url, headers=headers, data=b"1")
+            assert response.status_code == http.client.CREATED
+            for attempt in range(2):
+                response = requests.get(f"{other.base_url}{url}/info")
+                assert response.status_code == http.client.OK
+                assert "public" in response.headers["Cache-Control"]
+                assert "max-age=60" in response.headers["Cache-Control"]
+            etag = response.headers["ETag"]
+            stats = get_cache_stats(other.base_url, admin, "shared pages")
+            assert int(stats["hits"]) >= 1
+            response = requests.get(
+                f"{other.base_url}{url}/info", headers={"If-None-Match": etag}
+            )
+            assert response.status_code == http.client.NOT_MODIFIED
+
+            # Not cached for logged-in users.
+            response = requests.get(f"{other.base_url}{url}/info", headers=headers)
+            assert response.status_code == http.client.OK
+            assert "public" not in response.headers.get("Cache-Control", "")
+
+            # Changed via one process; the other shows the new page.
+            response = requests.put(
+                f"{server.base_url}{url}/description", headers=headers, data="Paged."
+            )
+            assert response.status_code == http.client.OK
+            response = requests.get(
+                f"{other.base_url}{url}/info", headers={"If-None-Match": etag}
+            )
+            assert response.status_code == http.client.OK
+            assert response.headers["ETag"] != etag
+            assert "Paged." in response.text
+            response = requests.get(f"{other.base_url}/")
+            assert "new.txt" not in response.text
+            response = requests.put(
+                f"{server.base_url}/blob/new.txt", headers=headers, data=b"2"
+            )
+            assert response.status_code == http.client.CREATED
+            response = requests.get(f"{other.base_url}/")
+            assert "new.txt" in response.text
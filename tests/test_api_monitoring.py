@@ -0,0 +1,257 @@
+"""Test the monitoring of the server: metrics, traces, profiling and logs.
+
+The servers run in subprocesses with temporary storage directories
+and the settings to test, so no 'settings.json' file is required.
+"""
+
+import http.client
+import json
+import os.path
+import re
+import time
+
+import requests
+
+import utils
+
+
+def get_metrics(server):
+    "Return the metrics as a dictionary of the sample names with labels."
+    response = requests.get(f"{server.base_url}/metrics")
+    assert response.status_code == http.client.OK
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    result = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            result[name] = float(value)
+    return result
+
+
+def test_metrics():
+    "Metrics of requests and content, summed for all processes."
+    with utils.Server(METRICS=True) as server:
+        with utils.Server(dirpath=server.dirpath, METRICS=True) as other:
+            headers = server.create_user("measured")
+            url = "/blob/measured.txt"
+            response = requests.put(
+                server.base_url + url, headers=headers, data=b"x" * 1000
+            )
+            assert response.status_code == http.client.CREATED
+            for attempt in range(2):
+                response = requests.get(other.base_url + url)
+                assert response.status_code == http.client.OK
+            response = requests.get(other.base_url + "/blob/missing.txt")
+            assert response.status_code == http.client.NOT_FOUND
+
+            # Each process writes its counts at most once per second.
+            time.sleep(1.1)
+            for base_url in [server.base_url, other.base_url]:
+                response = requests.get(f"{base_url}/status")
+                assert response.status_code == http.client.OK
+            for metrics in [get_metrics(server), get_metrics(other)]:
+                name = (
+                    "blobserver_requests_total"
+                    '{endpoint="blob.blob",method="%s",status="%s"}'
+                )
+                assert metrics[name % ("PUT", 201)] == 1
+                assert metrics[name % ("GET", 200)] == 2
+                assert metrics[name % ("GET", 404)] == 1
+                name = 'blobserver_request_duration_seconds_count{endpoint="blob.blob"}'
+                assert metrics[name] == 4
+                assert metrics["blobserver_upload_bytes_total"] == 1000
+                assert metrics["blobserver_download_bytes_total"] == 2000
+                assert metrics["blobserver_hash_bytes_total"] == 1000
+                assert metrics['blobserver_db_queries_total{endpoint="blob.blob"}'] > 0
+
+    # Not available unless enabled.
+    with utils.Server() as server:
+        response = requests.get(f"{server.base_url}/metrics")
+        assert response.status_code == http.client.NOT_FOUND
+
+
+def wait_for_text(filepath, text):
+    "Wait until the text is written to the file. Return the contents."
+    for attempt in range(100):
+        try:
+            with open(filepath) as infile:
+                contents = infile.read()
+        except FileNotFoundError:
+            contents = ""
+        if text in contents:
+            return contents
+        time.sleep(0.05)
+    raise AssertionError(f"No {text!r} in {filepath}.")
+
+
+def test_sql_trace(tmp_path):
+    "Statements of requests timed for admins, shown in debug, repeated logged."
+    logpath = tmp_path / "log.txt"
+    settings = dict(
+        SQL_TRACE=True, SQL_TRACE_REPEATED=2, DEBUG=True, LOG_FILEPATH=logpath
+    )
+    with utils.Server(**settings) as server:
+        admin = server.create_user("traceadmin", admin=True)
+        for username in ["tracer1", "tracer2"]:
+            headers = server.create_user(username)
+            response = requests.put(
+                f"{server.base_url}/blob/{username}.txt", headers=headers, data=b"x"
+            )
+            assert response.status_code == http.client.CREATED
+
+        response = requests.get(f"{server.base_url}/status", headers=admin)
+        assert response.status_code == http.client.OK
+        match = re.fullmatch(
+            r'db;dur=[0-9.]+;desc="([0-9]+) queries"', response.headers["Server-Timing"]
+        )
+        assert int(match.group(1)) >= 3
+        response = requests.get(f"{server.base_url}/status", headers=headers)
+        assert "Server-Timing" not in response.headers
+
+        # A user is looked up for each row of the list of users.
+        response = requests.get(f"{server.base_url}/blobs/users")
+        assert response.status_code == http.client.OK
+        contents = wait_for_text(logpath, "Repeated query 2 times, GET /blobs/users")
+        assert "FROM users" in contents
+        response = requests.get(f"{server.base_url}/debug", headers=admin)
+        assert response.status_code == http.client.OK
+        assert "GET /blobs/users" in response.text
+        assert "repeated 2 times" in response.text
+
+
+def read_traces(filepath):
+    "Return the events in the trace file, an unterminated JSON array."
+    with open(filepath) as infile:
+        return json.loads(infile.read().rstrip().rstrip(",") + "]")
+
+
+def test_tracing():
+    "Traces recorded when forced by admins, in a file rotated at a size."
+    settings = dict(
+        TRACING=True, TRACE_SAMPLE_RATE=0, TRACE_SLOW_MS=0, TRACE_FILE_SIZE=4000
+    )
+    with utils.Server(**settings) as server:
+        admin = server.create_user("tracingadmin", admin=True)
+        headers = server.create_user("traced")
+        filepath = os.path.join(server.dirpath, "_traces.json")
+        url = f"{server.base_url}/blob/traced.txt"
+        response = requests.put(url, headers={**headers, "x-trace": "1"}, data=b"x")
+        assert response.status_code == http.client.CREATED
+        assert "X-Trace-Id" not in response.headers
+        assert not os.path.exists(filepath)
+
+        response = requests.put(url, headers={**admin, "x-trace": "1"}, data=b"xy")
+        assert response.status_code == http.client.OK
+        trace_id = response.headers["X-Trace-Id"]
+        events = read_traces(filepath)
+        (request,) = [e for e in events if e["name"] == "request"]
+        assert request["args"]["trace_id"] == trace_id
+        assert request["args"]["reason"] == "forced"
+        assert request["args"]["method"] == "PUT"
+        assert request["args"]["status"] == http.client.OK
+        # The stages are spans within the request.
+        assert len(events) > 1
+        for event in events:
+            assert event["ph"] == "X"
+            # Allow for the rounding to tenths of microseconds.
+            assert event["ts"] >= request["ts"] - 1
+            assert event["ts"] + event["dur"] <= request["ts"] + request["dur"] + 1
+
+        # The file is rotated when it would exceed the size.
+        trace_ids = {trace_id}
+        while not os.path.exists(f"{filepath}.1"):
+            response = requests.get(url, headers={**admin, "x-trace": "1"})
+            trace_ids.add(response.headers["X-Trace-Id"])
+        recorded = set()
+        for path in [filepath, f"{filepath}.1"]:
+            assert os.path.getsize(path) <= 4000
+            for event in read_traces(path):
+                if event["name"] == "request":
+                    recorded.add(event["args"]["trace_id"])
+        assert recorded == trace_ids
+
+
+def test_profiling():
+    "Admins profile the CPU and trace the memory allocations of a process."
+    with utils.Server() as server:
+        admin = server.create_user("profileadmin", admin=True)
+        headers = server.create_user("profiled")
+        url = f"{server.base_url}/debug/profile"
+        response = requests.put(url, headers=headers)
+        assert response.status_code == http.client.UNAUTHORIZED
+        response = requests.get(url, headers=admin)
+        assert response.status_code == http.client.NOT_FOUND
+        response = requests.put(url, headers=admin, params={"seconds": 0})
+        assert response.status_code == http.client.BAD_REQUEST
+
+        response = requests.put(
+            url, headers=admin, params={"seconds": 60, "interval": 1}
+        )
+        assert response.status_code == http.client.OK
+        assert response.json()["active"]
+        response = requests.put(url, headers=admin)
+        assert response.status_code == http.client.BAD_REQUEST
+        for attempt in range(20):
+            response = requests.put(
+                f"{server.base_url}/blob/profiled.txt", headers=headers, data=b"x"
+            )
+            assert response.status_code in (http.client.CREATED, http.client.OK)
+        response = requests.delete(url, headers=admin)
+        assert response.status_code == http.client.OK
+        status = response.json()
+        assert not status["active"]
+        assert status["samples"] > 0
+        response = requests.get(url, headers=admin)
+        assert response.status_code == http.client.OK
+        assert "attachment" in response.headers["Content-Disposition"]
+        lines = response.text.splitlines()
+        assert lines
+        for line in lines:
+            assert re.fullmatch(r"[^ ].* [0-9]+", line)
+
+        url = f"{server.base_url}/debug/memory"
+        response = requests.get(url, headers=admin)
+        assert response.status_code == http.client.BAD_REQUEST
+        response = requests.put(url, headers=admin, params={"frames": 5})
+        assert response.status_code == http.client.OK
+        assert response.json()["tracing"]
+        response = requests.get(url, headers=admin)
+        assert response.status_code == http.client.OK
+        assert "Largest allocations" in response.text
+        response = requests.get(url, headers=admin, params={"key": "filename"})
+        assert "Largest growth" in response.text
+        response = requests.get(url, headers=admin, params={"key": "nonsense"})
+        assert response.status_code == http.client.BAD_REQUEST
+        response = requests.delete(url, headers=admin)
+        assert response.status_code == http.client.OK
+        assert not response.json()["tracing"]
+
+
+def test_access_log(tmp_path):
+    "Requests logged as JSON lines; successful GETs only for the sample rate."
+    logpath = tmp_path / "access.log"
+    settings = dict(ACCESS_LOG_FILEPATH=logpath, ACCESS_LOG_SAMPLE_RATE=0)
+    with utils.Server(**settings) as server:
+        headers = server.create_user("logged")
+        url = f"{server.base_url}/blob/logged.txt"
+        response = requests.put(url, headers=headers, data=b"x" * 100)
+        assert response.status_code == http.client.CREATED
+        response = requests.get(url)
+        assert response.status_code == http.client.OK
+        response = requests.get(f"{server.base_url}/blob/missing.txt")
+        assert response.status_code == http.client.NOT_FOUND
+
+        contents = wait_for_text(logpath, "/blob/missing.txt")
+        records = [json.loads(line) for line in contents.splitlines()]
+        assert len(records) == 2
+        assert records[0]["user"] == "logged"
+        assert records[0]["method"] == "PUT"
+        assert records[0]["path"] == "/blob/logged.txt"
+        assert records[0]["endpoint"] == "blob.blob"
+        assert records[0]["status"] == http.client.CREATED
+        assert records[0]["bytes_in"] == 100
+        assert records[0]["latency_ms"] > 0
+        assert records[0]["user_agent"].startswith("python-requests")
+        assert records[1]["user"] is None
+        assert records[1]["method"] == "GET"
+        assert records[1]["status"] == http.client.NOT_FOUND
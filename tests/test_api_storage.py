@@ -0,0 +1,205 @@
+"""Test the storage of blob content in the configured ways.
+
+The servers run in subprocesses with temporary storage directories
+and the settings to test, so no 'settings.json' file is required.
+"""
+
+import glob
+import gzip
+import http.client
+import os.path
+import random
+import time
+
+import requests
+
+import utils
+
+
+def test_storage_sharded():
+    "Blob files in the sharded layout; migrate them to the flat layout."
+    with utils.Server(STORAGE_SHARDED=True) as server:
+        headers = server.create_user("sharder")
+        url = f"{server.base_url}/blob/sharded.txt"
+        response = requests.put(url, headers=headers, data=b"sharded")
+        assert response.status_code == http.client.CREATED
+        pattern = os.path.join(server.dirpath, "_shards", "*", "*", "sharded.txt")
+        assert len(glob.glob(pattern)) == 1
+        assert not os.path.exists(os.path.join(server.dirpath, "sharded.txt"))
+        response = requests.patch(url, headers=headers, data=b", appended")
+        assert response.status_code == http.client.OK
+        response = requests.get(url)
+        assert response.status_code == http.client.OK
+        assert response.content == b"sharded, appended"
+
+        # Migrate to the flat layout; the blob is served from either.
+        server.env["STORAGE_SHARDED"] = "false"
+        output = server.cli("migrate", "--pause", 0)
+        assert "Moved 1 files." in output
+        assert glob.glob(pattern) == []
+        assert os.path.exists(os.path.join(server.dirpath, "sharded.txt"))
+        response = requests.get(url)
+        assert response.content == b"sharded, appended"
+        server.stop()
+        server.start()
+        response = requests.get(url)
+        assert response.content == b"sharded, appended"
+        response = requests.delete(url, headers=headers)
+        assert response.status_code == http.client.NO_CONTENT
+        assert not os.path.exists(os.path.join(server.dirpath, "sharded.txt"))
+
+
+def get_inline_count(server):
+    "Return the number of blobs with their content stored in the database."
+    db = server.connect()
+    try:
+        return db.execute("SELECT COUNT(*) FROM blobs_inline").fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_storage_inline():
+    "Small content in the database; moved to and from a file when resized."
+    with utils.Server(STORAGE_INLINE_LIMIT=100) as server:
+        headers = server.create_user("inliner")
+        url = f"{server.base_url}/blob/inline.txt"
+        filepath = os.path.join(server.dirpath, "inline.txt")
+        response = requests.put(url, headers=headers, data=b"small")
+        assert response.status_code == http.client.CREATED
+        assert get_inline_count(server) == 1
+        assert not os.path.exists(filepath)
+        response = requests.get(url)
+        assert response.status_code == http.client.OK
+        assert response.content == b"small"
+
+        # Appending beyond the limit moves the content to a file.
+        response = requests.patch(url, headers=headers, data=b"x" * 100)
+        assert response.status_code == http.client.OK
+        assert get_inline_count(server) == 0
+        with open(filepath, "rb") as infile:
+            assert infile.read() == b"small" + b"x" * 100
+        response = requests.get(url)
+        assert response.content == b"small" + b"x" * 100
+        info = requests.get(f"{url}/info.json").json()
+        assert info["size"] == 105
+
+        # Updating to small content moves it back into the database.
+        response = requests.put(url, headers=headers, data=b"small again")
+        assert response.status_code == http.client.OK
+        assert get_inline_count(server) == 1
+        assert not os.path.exists(filepath)
+        response = requests.get(url)
+        assert response.content == b"small again"
+        response = requests.delete(url, headers=headers)
+        assert response.status_code == http.client.NO_CONTENT
+        assert get_inline_count(server) == 0
+
+
+def test_storage_compressed():
+    "Compressible files are compressed; served decompressed, or as is."
+    with utils.Server(STORAGE_COMPRESSION="gzip") as server:
+        headers = server.create_user("compressor")
+        url = f"{server.base_url}/blob/compressed.txt"
+        content = b"".join(
+            b"line %d of the compressible text\n" % i for i in range(10**5)
+        )
+        response = requests.put(url, headers=headers, data=content)
+        assert response.status_code == http.client.CREATED
+        with open(os.path.join(server.dirpath, "compressed.txt"), "rb") as infile:
+            stored = infile.read()
+        assert gzip.decompress(stored) == content
+        assert len(stored) < len(content) / 2
+
+        # Decompressed for a client not accepting the encoding.
+        identity = {"Accept-Encoding": "identity"}
+        response = requests.get(url, headers=identity)
+        assert response.status_code == http.client.OK
+        assert "Content-Encoding" not in response.headers
+        assert response.content == content
+        response = requests.get(
+            url, headers={**identity, "Range": "bytes=500000-500099"}
+        )
+        assert response.status_code == http.client.PARTIAL_CONTENT
+        assert response.content == content[500000:500100]
+
+        # Sent as is to a client accepting the encoding.
+        response = requests.get(url, headers={"Accept-Encoding": "gzip"}, stream=True)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.raw.read() == stored
+        response.close()
+
+        # Appending to the compressed file.
+        response = requests.patch(url, headers=headers, data=b"the end\n")
+        assert response.status_code == http.client.OK
+        response = requests.get(url, headers=identity)
+        assert response.content == content + b"the end\n"
+
+        # Content that does not compress well is stored as is.
+        url = f"{server.base_url}/blob/random.bin"
+        content = random.Random(0).randbytes(100000)
+        response = requests.put(url, headers=headers, data=content)
+        assert response.status_code == http.client.CREATED
+        with open(os.path.join(server.dirpath, "random.bin"), "rb") as infile:
+            assert infile.read() == content
+        response = requests.get(url)
+        assert "Content-Encoding" not in response.headers
+        assert response.content == content
+
+
+def test_download_compressed():
+    "Text-like blobs are compressed for clients accepting it; variants are made."
+    with utils.Server(DOWNLOAD_COMPRESSION=True, DOWNLOAD_PRECOMPRESS_HITS=2) as server:
+        headers = server.create_user("downloader")
+        url = f"{server.base_url}/blob/download.txt"
+        content = b"".join(
+            b"line %d of the downloaded text\n" % i for i in range(10**4)
+        )
+        response = requests.put(url, headers=headers, data=content)
+        assert response.status_code == http.client.CREATED
+
+        response = requests.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == http.client.OK
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert response.content == content
+        response = requests.get(url, headers={"Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in response.headers
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert response.content == content
+
+        # A range is served from the original content.
+        response = requests.get(
+            url, headers={"Accept-Encoding": "gzip", "Range": "bytes=100-199"}
+        )
+        assert response.status_code == http.client.PARTIAL_CONTENT
+        assert "Content-Encoding" not in response.headers
+        assert response.content == content[100:200]
+
+        # After frequent downloads, a variant is compressed in advance.
+        pattern = os.path.join(server.dirpath, "_variants", "*.gzip")
+        for attempt in range(100):
+            response = requests.get(url, headers={"Accept-Encoding": "gzip"})
+            assert response.content == content
+            if glob.glob(pattern):
+                break
+            time.sleep(0.05)
+        (variant,) = glob.glob(pattern)
+        with open(variant, "rb") as infile:
+            assert gzip.decompress(infile.read()) == content
+        response = requests.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.content == content
+
+        # The variant is not used once the content has changed.
+        response = requests.patch(url, headers=headers, data=b"the end\n")
+        assert response.status_code == http.client.OK
+        response = requests.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.content == content + b"the end\n"
+
+        # Content not text-like is not compressed.
+        url = f"{server.base_url}/blob/download.bin"
+        response = requests.put(url, headers=headers, data=content)
+        assert response.status_code == http.client.CREATED
+        response = requests.get(url, headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+        assert response.content == content
@@ -101,3 +101,42 @@ def test_user_blob(settings, page):
     response = requests.get(url, headers=headers)
     assert response.status_code == http.client.OK
     assert len(response.json()["blobs"]) == count
+
+
+def test_user_blob_patch(settings, page):
+    "Create a blob, append to it, overwrite a byte range, and delete it."
+    headers = {"x-accesskey": settings["ACCESSKEY"]}
+    url = f"{settings['BASE_URL']}/blob/patch_{os.path.basename(__file__)}"
+
+    response = requests.put(url, headers=headers, data=b"0123456789")
+    assert response.status_code == http.client.CREATED
+    response = requests.get(url)
+    assert response.status_code == http.client.OK
+    etag = response.headers["ETag"]
+
+    # Append at the end of the blob.
+    response = requests.patch(url, headers=headers, data=b"abc")
+    assert response.status_code == http.client.OK
+    response = requests.get(url)
+    assert response.content == b"0123456789abc"
+
+    # The entity tag has changed; a write conditional on the old one must fail.
+    response = requests.patch(url, headers={**headers, "If-Match": etag}, data=b"x")
+    assert response.status_code == http.client.PRECONDITION_FAILED
+
+    # Overwrite a byte range.
+    response = requests.patch(
+        url, headers={**headers, "Content-Range": "bytes 2-4/*"}, data=b"XYZ"
+    )
+    assert response.status_code == http.client.OK
+    response = requests.get(url)
+    assert response.content == b"01XYZ56789abc"
+
+    # A range starting beyond the end is not allowed.
+    response = requests.patch(
+        url, headers={**headers, "Content-Range": "bytes 100-100/*"}, data=b"x"
+    )
+    assert response.status_code == http.client.REQUESTED_RANGE_NOT_SATISFIABLE
+
+    response = requests.delete(url, headers=headers)
+    assert response.status_code == http.client.NO_CONTENT
@@ -0,0 +1,62 @@
+"""Test that the benchmarks run, with tiny parameters.
+
+The benchmarks create their own temporary storage directories,
+so no 'settings.json' file is required.
+"""
+
+import json
+import os.path
+import subprocess
+import sys
+
+import utils
+
+
+def run_benchmark(name, tmp_path, args):
+    "Run the benchmark script with the arguments. Return its JSON results."
+    output = tmp_path / f"{name}.json"
+    subprocess.run(
+        [sys.executable, os.path.join("benchmarks", f"{name}.py")]
+        + args
+        + ["--output", output],
+        cwd=utils.ROOT,
+        check=True,
+        capture_output=True,
+    )
+    with open(output) as infile:
+        return json.load(infile)
+
+
+def test_benchmark_e2e(tmp_path):
+    "Every endpoint is requested the given number of times, without errors."
+    args = "--users 1 --blobs 4 --sizes 1024:1,65536:1 --requests 3 --warmup 1"
+    args = args.split() + ["--setting", "BLOB_CACHE_SIZE=1048576"]
+    results = run_benchmark("e2e", tmp_path, args)
+    assert results["meta"]["parameters"]["settings"] == {"BLOB_CACHE_SIZE": "1048576"}
+    for name in ["download", "upload", "info_json", "all_json", "search", "home"]:
+        assert results["endpoints"][name]["requests"] == 3
+        assert results["endpoints"][name]["errors"] == 0
+        assert results["endpoints"][name]["p50_ms"] > 0
+
+
+def test_benchmark_micro(tmp_path):
+    "The chosen cases are timed, each on a number of calls."
+    args = "--users 1 --blobs 4 --repeat 2 --case get_user --case get_blob_data"
+    results = run_benchmark("micro", tmp_path, args.split())
+    assert set(results["cases"]) == {"get_user", "get_blob_data"}
+    for result in results["cases"].values():
+        assert result["calls"] > 0
+        assert 0 < result["best_us"] <= result["median_us"]
+
+
+def test_benchmark_download(tmp_path):
+    "Whole files and ranges are sent, with and without the server's file wrapper."
+    for option in ["--file-wrapper", "--no-file-wrapper"]:
+        args = f"--blobs 2 --size 200000 --requests 3 {option}"
+        results = run_benchmark("download", tmp_path, args.split())
+        assert results["meta"]["parameters"]["file_wrapper"] == (
+            option == "--file-wrapper"
+        )
+        for name, size in [("full", 200000), ("range_head", 100000)]:
+            assert results["cases"][name]["requests"] == 3
+            assert results["cases"][name]["bytes"] >= 3 * size
@@ -0,0 +1,191 @@
+"""Test the command-line interface on the storage of a server started by the tests.
+
+The server runs in a subprocess with a temporary storage directory,
+so no 'settings.json' file is required.
+"""
+
+import hashlib
+import http.client
+import io
+import json
+import os
+import os.path
+import tarfile
+
+import pytest
+import requests
+
+import utils
+
+
+@pytest.fixture(scope="module")
+def server():
+    "Start a server with default settings."
+    with utils.Server() as server:
+        yield server
+
+
+def put_blobs(server, headers, blobs):
+    "Create or update the blobs given as a dictionary of filename to content."
+    for filename, content in blobs.items():
+        response = requests.put(
+            f"{server.base_url}/blob/{filename}", headers=headers, data=content
+        )
+        assert response.status_code in (http.client.CREATED, http.client.OK)
+
+
+def get_dumped(tarpath):
+    "Return a dictionary of the blob files in the dump file and their content."
+    result = {}
+    with tarfile.open(tarpath) as archive:
+        for item in archive:
+            if item.name.startswith("_"):
+                result[item.name] = None
+            else:
+                result[item.name] = archive.extractfile(item).read()
+    return result
+
+
+def test_dump(server, tmp_path):
+    "Dump all blobs, and then only those changed since a manifest or a time."
+    headers = server.create_user("dumper")
+    put_blobs(server, headers, {"dump1.txt": b"one", "dump2.txt": b"two"})
+    base = tmp_path / "base.tar.gz"
+    server.cli("dump", "--tarname", base)
+    dumped = get_dumped(base)
+    assert dumped["dump1.txt"] == b"one"
+    assert dumped["dump2.txt"] == b"two"
+    assert "_data.sqlite3" in dumped
+    with open(f"{base}.manifest.json") as infile:
+        manifest = json.load(infile)
+    info = requests.get(f"{server.base_url}/blob/dump1.txt/info.json").json()
+    assert manifest["dump1.txt"] == info["sha256"]
+
+    # Only changed and new blobs are in the incremental dump.
+    put_blobs(server, headers, {"dump2.txt": b"two, changed", "dump3.txt": b"three"})
+    incremental = tmp_path / "incremental.tar.gz"
+    server.cli("dump", "--tarname", incremental, "--manifest", f"{base}.manifest.json")
+    dumped = get_dumped(incremental)
+    assert "dump1.txt" not in dumped
+    assert dumped["dump2.txt"] == b"two, changed"
+    assert dumped["dump3.txt"] == b"three"
+    assert "_data.sqlite3" in dumped
+
+    # Only blobs modified at or after the given time.
+    info = requests.get(f"{server.base_url}/blob/dump3.txt/info.json").json()
+    since = tmp_path / "since.tar.gz"
+    server.cli("dump", "--tarname", since, "--since", info["modified"])
+    dumped = get_dumped(since)
+    assert "dump2.txt" not in dumped
+    assert dumped["dump3.txt"] == b"three"
+
+
+def test_undump(server, tmp_path):
+    "Restore an incremental dump and its base; detect corrupt files."
+    headers = server.create_user("undumper")
+    put_blobs(server, headers, {"undump1.txt": b"one", "undump2.txt": b"two"})
+    base = tmp_path / "base.tar.gz"
+    server.cli("dump", "--tarname", base)
+    put_blobs(server, headers, {"undump2.txt": b"two, changed", "undump3.txt": b"3"})
+    incremental = tmp_path / "incremental.tar.gz"
+    server.cli("dump", "--tarname", incremental, "--manifest", f"{base}.manifest.json")
+
+    # The incremental dump first, and then its base.
+    with utils.Server() as target:
+        target.cli("undump", incremental)
+        target.cli("undump", base, "--resume")
+        for filename, content in [
+            ("undump1.txt", b"one"),
+            ("undump2.txt", b"two, changed"),
+            ("undump3.txt", b"3"),
+        ]:
+            response = requests.get(f"{target.base_url}/blob/{filename}")
+            assert response.status_code == http.client.OK
+            assert response.content == content
+
+    # A file whose content does not match its digest is reported.
+    corrupt = tmp_path / "corrupt.tar.gz"
+    with tarfile.open(base) as infile:
+        with tarfile.open(corrupt, "w:gz") as outfile:
+            for item in infile:
+                content = infile.extractfile(item).read()
+                if item.name == "undump1.txt":
+                    content = b"eno"
+                outfile.addfile(item, io.BytesIO(content))
+    with utils.Server() as target:
+        with pytest.raises(RuntimeError, match="1 corrupt files"):
+            target.cli("undump", corrupt)
+        response = requests.get(f"{target.base_url}/blob/undump2.txt")
+        assert response.content == b"two"
+
+
+def test_verify(tmp_path):
+    "Verify the files; report corrupt, missing and orphan files."
+    with utils.Server() as server:
+        headers = server.create_user("verifier")
+        blobs = {"verify1.txt": b"one", "verify2.txt": b"two", "verify3.txt": b"3"}
+        put_blobs(server, headers, blobs)
+        report = tmp_path / "report.json"
+        server.cli("verify", "--report", report)
+        with open(report) as infile:
+            result = json.load(infile)
+        assert result["ok"] == 3
+        assert result["corrupt"] == result["missing"] == result["orphans"] == []
+
+        with open(os.path.join(server.dirpath, "orphan"), "wb") as outfile:
+            outfile.write(b"orphan")
+        with open(os.path.join(server.dirpath, "verify2.txt"), "wb") as outfile:
+            outfile.write(b"owt")
+        os.remove(os.path.join(server.dirpath, "verify3.txt"))
+        with pytest.raises(RuntimeError, match="1 corrupt and 1 missing files"):
+            server.cli("verify", "--report", report)
+        with open(report) as infile:
+            result = json.load(infile)
+        assert result["ok"] == 1
+        assert result["corrupt"] == ["verify2.txt"]
+        assert result["missing"] == ["verify3.txt"]
+        assert result["orphans"] == ["orphan"]
+
+        # Only the blobs not verified OK recently are verified again.
+        for filename in ["verify2.txt", "verify3.txt"]:
+            with open(os.path.join(server.dirpath, filename), "wb") as outfile:
+                outfile.write(blobs[filename])
+        server.cli("verify", "--days", 1, "--report", report)
+        with open(report) as infile:
+            result = json.load(infile)
+        assert result["ok"] == 2
+        assert result["corrupt"] == result["missing"] == []
+
+
+def test_import(server, tmp_path):
+    "Import the files of a directory as blobs; skip invalid and conflicting names."
+    headers = server.create_user("importer")
+    put_blobs(server, headers, {"import1.txt": b"existing"})
+    files = {
+        "import1.txt": b"conflict",
+        "import2.txt": b"two",
+        "import3.bin": bytes(range(256)) * 100,
+        "_import4.txt": b"invalid",
+    }
+    for filename, content in files.items():
+        (tmp_path / filename).write_bytes(content)
+    output = server.cli("import", tmp_path, "--username", "importer", "--dry-run")
+    assert "Would import 2 files." in output
+    response = requests.get(f"{server.base_url}/blob/import2.txt")
+    assert response.status_code == http.client.NOT_FOUND
+
+    server.cli("import", tmp_path, "--username", "importer", "--mode", "move")
+    for filename in ["import2.txt", "import3.bin"]:
+        response = requests.get(f"{server.base_url}/blob/{filename}")
+        assert response.status_code == http.client.OK
+        assert response.content == files[filename]
+        info = requests.get(f"{server.base_url}/blob/{filename}/info.json").json()
+        assert info["username"] == "importer"
+        assert info["size"] == len(files[filename])
+        assert info["sha256"] == hashlib.sha256(files[filename]).hexdigest()
+        assert not (tmp_path / filename).exists()
+    response = requests.get(f"{server.base_url}/blob/import1.txt")
+    assert response.content == b"existing"
+    assert (tmp_path / "import1.txt").exists()
+    response = requests.get(f"{server.base_url}/blob/_import4.txt")
+    assert response.status_code == http.client.NOT_FOUND
@@ -2,9 +2,36 @@
 
 import http.client
 import json
+import os
+import os.path
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
 
 BLOBSERVER_VERSION = "1.1.1"
 
+# The top directory of the repository.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = "test-password"
+
+# Not 'flask run', which would override the DEBUG setting.
+SERVE_SCRIPT = """
+import sys
+import werkzeug.serving
+import blobserver.main
+werkzeug.serving.run_simple(
+    "localhost", int(sys.argv[1]), blobserver.main.app, threaded=True
+)
+"""
+
 
 def get_settings(**defaults):
     "Update the default settings by the contents of the 'settings.json' file."
@@ -23,6 +50,129 @@ def get_settings(**defaults):
     return result
 
 
+def get_csrf_token(session, url):
+    "Get the form page, and return the CSRF token in it."
+    response = session.get(url)
+    assert response.status_code == http.client.OK
+    return re.search(r'name="_csrf_token" value="([^"]+)"', response.text).group(1)
+
+
+class Server:
+    """A blobserver run by the Werkzeug development server in a subprocess,
+    with a new, empty temporary storage directory and the given settings,
+    for testing features that must be enabled by settings.
+    Use as a context manager; the server is started on entry.
+    Given the storage directory of another server, the servers share it,
+    as the processes of a production server do. With 'asgi', the ASGI
+    application is served by uvicorn instead.
+    """
+
+    def __init__(self, dirpath=None, asgi=False, **settings):
+        self.asgi = asgi
+        self.own_dirpath = dirpath is None
+        if self.own_dirpath:
+            self.dirpath = tempfile.mkdtemp(prefix="blobserver-test-")
+        else:
+            self.dirpath = dirpath
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            self.port = sock.getsockname()[1]
+        self.base_url = f"http://localhost:{self.port}"
+        self.env = os.environ.copy()
+        self.env["PYTHONPATH"] = ROOT
+        self.env["SECRET_KEY"] = "test-secret-key"
+        self.env["STORAGE_DIRPATH"] = self.dirpath
+        self.env["SERVER_NAME"] = f"localhost:{self.port}"
+        for key, value in settings.items():
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            self.env[key] = str(value)
+        self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stop()
+        if self.own_dirpath:
+            shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    def start(self):
+        "Start the server, and wait until it responds."
+        if self.asgi:
+            args = ["-m", "uvicorn", "blobserver.asgi:app", "--port", str(self.port)]
+        else:
+            args = ["-c", SERVE_SCRIPT, str(self.port)]
+        self.process = subprocess.Popen(
+            [sys.executable] + args,
+            cwd=ROOT,
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for attempt in range(100):
+            try:
+                response = requests.get(f"{self.base_url}/status")
+            except requests.ConnectionError:
+                if self.process.poll() is not None:
+                    raise RuntimeError("The server failed to start.")
+                time.sleep(0.1)
+            else:
+                if response.status_code == http.client.OK:
+                    return
+        self.stop()
+        raise RuntimeError("The server did not respond.")
+
+    def stop(self):
+        "Stop the server, if running."
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def cli(self, *args):
+        "Run the command-line interface with the settings. Return the output."
+        process = subprocess.run(
+            [sys.executable, "-m", "blobserver.cli"] + [str(a) for a in args],
+            cwd=ROOT,
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr)
+        return process.stdout
+
+    def create_user(self, username, admin=False, quota=None):
+        "Create a user account with the quota. Return the headers for access."
+        self.cli(
+            "create-admin" if admin else "create-user",
+            "--username",
+            username,
+            "--email",
+            f"{username}@example.com",
+            "--password",
+            PASSWORD,
+        )
+        db = self.connect()
+        try:
+            with db:
+                db.execute(
+                    "UPDATE users SET quota=? WHERE username=?", (quota, username)
+                )
+            rows = db.execute(
+                "SELECT accesskey FROM users WHERE username=?", (username,)
+            )
+            return {"x-accesskey": rows.fetchone()[0]}
+        finally:
+            db.close()
+
+    def connect(self):
+        "Return a connection to the database of the server."
+        return sqlite3.connect(os.path.join(self.dirpath, "_data.sqlite3"))
+
+
 class Writer:
     def __init__(self):
         self.outfile = open("out.txt", "w")